@@ -0,0 +1,95 @@
+"""Benchmark step5's geography rollups: merge-based functions vs the integer-coded engine.
+
+Both paths build LAD gross flows plus region, country and inner/outer London
+OD matrices and gross flows from the same synthetic LAD flows.
+
+    python benchmarks/bench_od_aggregation.py --rows 5000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from od_aggregation import aggregate_geographies, hierarchy_map
+from step5_converting_geographies import aggregate_to_region, create_gross_flows
+
+def synthetic_lookups(n_lads=360):
+    lads = [f"E0{6 + i % 3}{i:06d}" for i in range(n_lads - 33)] + [f"E09{i:06d}" for i in range(1, 34)]
+    regions = [f"E1200000{i % 9 + 1}" if not lad.startswith("E09") else "E12000007" for i, lad in enumerate(lads)]
+    region = pd.DataFrame({"lad_code": lads, "region_code": regions})
+    country = pd.DataFrame({"lad_code": lads, "country_code": "E92000001"})
+    inner_outer = pd.DataFrame({
+        "lad_code": lads,
+        "io_london": ["E13000001" if lad.startswith("E09") and int(lad[3:]) <= 14 else
+                      "E13000002" if lad.startswith("E09") else "other" for lad in lads],
+    })
+    return lads, {"region": (region, "region_code"), "country": (country, "country_code"),
+                  "inner_outer": (inner_outer, "io_london")}
+
+def synthetic_flows(rows, lads, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "gss_in": pd.Categorical.from_codes(rng.integers(0, len(lads), rows), lads).astype(str),
+        "gss_out": pd.Categorical.from_codes(rng.integers(0, len(lads), rows), lads).astype(str),
+        "year": rng.integers(2002, 2024, rows),
+        "age": rng.integers(0, 91, rows),
+        "sex": rng.choice(["female", "male"], rows),
+        "value": rng.random(rows),
+    })
+
+def merge_based(df, lookup_paths):
+    results = {"lad_gross": create_gross_flows(df)}
+    for name, (path, column) in lookup_paths.items():
+        od = aggregate_to_region(df, path, name=column)
+        results[name] = {"od": od, "gross": create_gross_flows(od)}
+    return results
+
+def engine(df, lookups):
+    hierarchies = {name: hierarchy_map(pd.read_csv(path), column) for name, (path, column) in lookups.items()}
+    return aggregate_geographies(df, hierarchies)
+
+def measure(fn):
+    """Wall time of one run, then peak traced allocation of a second (tracemalloc skews timings)"""
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5_000_000)
+    args = parser.parse_args()
+
+    lads, lookups = synthetic_lookups()
+    df = synthetic_flows(args.rows, lads)
+    print(f"LAD flows: {len(df)} rows, {df.memory_usage(deep=True).sum() / 1e6:.0f} MB")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        lookup_paths = {}
+        for name, (lookup, column) in lookups.items():
+            path = os.path.join(tmp, f"{name}.csv")
+            lookup.to_csv(path, index=False)
+            lookup_paths[name] = (path, column)
+
+        base_time, base_peak, expected = measure(lambda: merge_based(df, lookup_paths))
+        print(f"merge-based: {base_time:7.2f}s  peak {base_peak / 1e6:7.0f} MB")
+
+        new_time, new_peak, result = measure(lambda: engine(df, lookup_paths))
+        print(f"bincount:    {new_time:7.2f}s  peak {new_peak / 1e6:7.0f} MB"
+              f"  ({base_time / new_time:.1f}x faster, {base_peak / new_peak:.1f}x less memory)")
+
+    for name in lookups:
+        pd.testing.assert_frame_equal(result[name]["od"], expected[name]["od"], check_dtype=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Benchmark the single-pass OD recoder against the two recode_gss calls it replaced in step4.
+
+    python benchmarks/bench_od_recoder.py --rows 2000000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from gsscoder_python import recode_gss
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from od_recoder import recode_od
+
+GSS_OLD_YEAR = 2021
+GSS_NEW_YEAR = 2023
+
+def two_call_recode(df_old):
+    """The previous step4 recode: split on E0|W0 and recode_gss each end in turn"""
+    df_in_gss = df_old[df_old['gss_in'].str.contains("E0|W0")]
+    df_not_in_gss = df_old[~df_old['gss_in'].str.contains("E0|W0")]
+    df_in_gss = recode_gss(df_in=df_in_gss, col_code='gss_in', col_data='value', fun='sum',
+                           recode_from_year=GSS_OLD_YEAR, recode_to_year=GSS_NEW_YEAR)
+    df_old_recoded_in = pd.concat([df_in_gss, df_not_in_gss], ignore_index=True)
+
+    df_out_gss = df_old_recoded_in[df_old_recoded_in['gss_out'].str.contains("E0|W0")]
+    df_not_out_gss = df_old_recoded_in[~df_old_recoded_in['gss_out'].str.contains("E0|W0")]
+    df_out_gss = recode_gss(df_in=df_out_gss, col_code='gss_out', col_data='value', fun='sum',
+                            recode_from_year=GSS_OLD_YEAR, recode_to_year=GSS_NEW_YEAR)
+    return pd.concat([df_out_gss, df_not_out_gss], ignore_index=True)
+
+def synthetic_old_series(rows, seed=0):
+    """OD rows over ~340 English/Welsh LADs (including the 2023 merges) plus Scotland and NI"""
+    rng = np.random.default_rng(seed)
+    codes = ([f"E06{i:06d}" for i in range(1, 60)] + [f"E07{i:06d}" for i in range(26, 200)]
+             + [f"E08{i:06d}" for i in range(1, 37)] + [f"E09{i:06d}" for i in range(1, 34)]
+             + [f"W06{i:06d}" for i in range(1, 23)] + ["S92000003", "N92000002"])
+    return pd.DataFrame({
+        "gss_in": rng.choice(codes, rows),
+        "gss_out": rng.choice(codes, rows),
+        "year": rng.integers(2002, 2012, rows),
+        "age": rng.integers(0, 91, rows),
+        "sex": rng.choice(["female", "male"], rows),
+        "value": rng.random(rows),
+    })
+
+def measure(fn, df):
+    """Wall time of one run, then peak traced allocation of a second (tracemalloc skews timings)"""
+    start = time.perf_counter()
+    result = fn(df)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    args = parser.parse_args()
+
+    df = synthetic_old_series(args.rows)
+    print(f"Old series: {len(df)} rows, {df.memory_usage(deep=True).sum() / 1e6:.0f} MB")
+
+    base_time, base_peak, expected = measure(two_call_recode, df)
+    print(f"two recode_gss calls: {base_time:7.2f}s  peak {base_peak / 1e6:7.0f} MB")
+
+    new_time, new_peak, result = measure(lambda d: recode_od(d, GSS_OLD_YEAR, GSS_NEW_YEAR), df)
+    print(f"recode_od:            {new_time:7.2f}s  peak {new_peak / 1e6:7.0f} MB"
+          f"  ({base_time / new_time:.1f}x faster, {base_peak / new_peak:.1f}x less memory)")
+
+    assert len(result) == len(expected)
+
+if __name__ == "__main__":
+    main()
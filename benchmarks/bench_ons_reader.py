@@ -0,0 +1,64 @@
+"""Benchmark the streaming detailed-estimates reader against pd.read_excel.
+
+Builds a synthetic workbook in the ONS layout (the OD table, wide by age, on
+sheet 4 with a few footnote rows) and times reading and cleaning it both ways.
+
+    python benchmarks/bench_ons_reader.py --rows 20000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import pandas as pd
+from openpyxl import Workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ons_workbook_reader import CalamineWorkbook, read_detailed_estimates
+
+AGES = range(91)
+
+def write_workbook(path, rows, seed=0):
+    """Write a synthetic detailed estimates workbook with `rows` OD rows on sheet 4"""
+    rng = random.Random(seed)
+    codes = [f"E0{6 + i % 4}{i:06d}" for i in range(360)]
+    workbook = Workbook(write_only=True)
+    for i in range(4):
+        workbook.create_sheet(f"Contents {i}").append(["Notes"])
+    sheet = workbook.create_sheet("Table 4")
+    sheet.append(["OutLA", "InLA", "Sex", "Year"] + [f"Age_{age}" for age in AGES])
+    for _ in range(rows):
+        sheet.append([rng.choice(codes), rng.choice(codes), rng.choice("FM"), 2022]
+                     + [round(rng.random() * 3, 3) for _ in AGES])
+    sheet.append([])
+    sheet.append(["Source: Office for National Statistics"])
+    workbook.save(path)
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "detailedestimates2022on2023las.xlsx")
+        write_workbook(path, args.rows)
+        print(f"Workbook: {args.rows} rows, {os.path.getsize(path) / 1e6:.1f} MB")
+
+        baseline, df = timed(lambda: pd.read_excel(path, sheet_name=4).dropna())
+        print(f"pd.read_excel + dropna: {baseline:8.2f}s  ({len(df)} rows)")
+
+        engines = ["openpyxl"] + (["calamine"] if CalamineWorkbook is not None else [])
+        for engine in engines:
+            elapsed, table = timed(lambda: read_detailed_estimates(path, engine=engine).read_all())
+            assert table.num_rows == len(df)
+            print(f"streaming ({engine:9}): {elapsed:8.2f}s  ({table.num_rows} rows, {baseline / elapsed:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""Time and memory-profile the pipeline handlers on synthetic data at several sizes.
+
+For each size the synthetic inputs are generated once (synthetic_data.py),
+then every case runs in a fresh Python process so its peak RSS is its own:
+
+- step2: step2_clean_data.handler over the ONS workbooks (long Parquet output)
+- step3: step3_combine_clean_data.handler over the cleaned Parquet files
+- step4: step4_combine_series.handler (cold recode cache, needs gsscoder_python)
+- step5: step5_converting_geographies.convert_geographies over the OD flows
+- step7: step7_create_borough_children_flows.build_children_flows over the OD flows
+
+S3 is moto's in-process stand-in, so no AWS account is touched. Because
+its state lives in one process, step2's worker pool runs as threads and
+step4 writes in "staged" mode and reads the backseries from the local ZIP
+(pyarrow's own S3 client cannot see moto). Results are written as JSON;
+with --baseline, cases slower or larger than the baseline by more than
+--tolerance are reported and the exit status is 1.
+
+    python benchmarks/run_suite.py --sizes small medium --output benchmark_results.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+import synthetic_data
+
+# n_lads x density of LAD pairs; "full" is the complete 360 x 360 OD matrix every year
+SIZES = {
+    "small": {"n_lads": 40, "density": 0.5, "workbook_years": None},
+    "medium": {"n_lads": 120, "density": 0.25, "workbook_years": 4},
+    "large": {"n_lads": 360, "density": 0.1, "workbook_years": 2},
+    "full": {"n_lads": 360, "density": 1.0, "workbook_years": 1},
+}
+CASES = ["step2", "step3", "step4", "step5", "step7"]
+DEFAULT_TOLERANCE = 0.25
+BUCKET = "dpa-population-projection-data"
+RAW_PREFIX = "bench/raw/"
+CLEANED_PREFIX = "bench/cleaned/"
+COMBINED_KEY = "bench/combined/cleaned_data_combined.parquet"
+
+# ----------------------------- Cases (run in a child process) -----------------------------
+def start_s3():
+    """Start moto's S3 stand-in and create the pipeline bucket"""
+    for name, value in (("AWS_ACCESS_KEY_ID", "testing"), ("AWS_SECRET_ACCESS_KEY", "testing"),
+                        ("AWS_DEFAULT_REGION", "us-east-1")):
+        os.environ[name] = value
+    from moto import mock_aws
+    mock = mock_aws()
+    mock.start()
+    import boto3
+    client = boto3.client("s3")
+    client.create_bucket(Bucket=BUCKET)
+    return client
+
+def upload_dir(client, local_dir, prefix):
+    for name in sorted(os.listdir(local_dir)):
+        client.upload_file(os.path.join(local_dir, name), BUCKET, f"{prefix}{name}")
+
+def setup_step2(data_dir, work_dir):
+    client = start_s3()
+    upload_dir(client, os.path.join(data_dir, synthetic_data.WORKBOOK_DIR), RAW_PREFIX)
+    from concurrent.futures import ThreadPoolExecutor
+    import step2_clean_data
+    step2_clean_data.ProcessPoolExecutor = ThreadPoolExecutor  # moto state is per process
+    event = {"input_path": f"s3://{BUCKET}/{RAW_PREFIX}", "output_path": f"s3://{BUCKET}/{CLEANED_PREFIX}",
+             "output_format": "parquet", "force": True}
+    return lambda: step2_clean_data.handler(event, None)
+
+def setup_step3(data_dir, work_dir):
+    client = start_s3()
+    upload_dir(client, os.path.join(data_dir, synthetic_data.CLEANED_DIR), CLEANED_PREFIX)
+    import step3_combine_clean_data
+    event = {"input_path": f"s3://{BUCKET}/{CLEANED_PREFIX}", "output_path": f"s3://{BUCKET}/{COMBINED_KEY}",
+             "input_format": "parquet"}
+    return lambda: step3_combine_clean_data.handler(event, None)
+
+def setup_step4(data_dir, work_dir):
+    client = start_s3()
+    import step4_combine_series
+    client.upload_file(os.path.join(data_dir, synthetic_data.COMBINED_FILE), BUCKET, step4_combine_series.S3_NEW_SERIES_PATH)
+    step4_combine_series.S3_PARQUET_ZIP_S3_URI = os.path.join(data_dir, synthetic_data.BACKSERIES_ZIP)
+    event = {"recode_cache_uri": os.path.join(work_dir, "recode_cache"), "write_mode": "staged"}
+    return lambda: step4_combine_series.handler(event, None)
+
+def use_synthetic_lookups(data_dir):
+    """Point the geography registry at the generated lookups; it compiles them once, outside the timed runs"""
+    import geography_registry
+    for name in ("LOOKUP_REGION", "LOOKUP_COUNTRY", "LOOKUP_INNER_OUTER"):
+        path = os.path.join(data_dir, synthetic_data.LOOKUP_DIR, os.path.basename(getattr(geography_registry, name)))
+        setattr(geography_registry, name, path)
+    geography_registry.load_registry()
+
+def setup_step5(data_dir, work_dir):
+    import step5_converting_geographies as step5
+    from flow_scan import open_flows
+    use_synthetic_lookups(data_dir)
+    dataset = open_flows(os.path.join(data_dir, synthetic_data.FLOWS_DIR))
+    return lambda: summarise(step5.convert_geographies(dataset, step5.load_hierarchies()))
+
+def setup_step7(data_dir, work_dir):
+    import step7_create_borough_children_flows as step7
+    from flow_scan import open_flows
+    use_synthetic_lookups(data_dir)
+    dataset = open_flows(os.path.join(data_dir, synthetic_data.FLOWS_DIR))
+    return lambda: {"net_rows": len(step7.build_children_flows(dataset, step7.load_hierarchies())[0])}
+
+def summarise(results):
+    """Row counts of an aggregate_geographies-style result, for the JSON report"""
+    return {name: len(value) if not isinstance(value, dict) else {kind: len(df) for kind, df in value.items()}
+            for name, value in results.items()}
+
+SETUPS = {"step2": setup_step2, "step3": setup_step3, "step4": setup_step4, "step5": setup_step5, "step7": setup_step7}
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+
+def run_case(case, data_dir):
+    """Set up one case, then time it and record the peak RSS it adds over its setup"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            run = SETUPS[case](data_dir, work_dir)
+        except ImportError as e:
+            return {"skipped": f"missing dependency: {e}"}
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        result = run()
+        elapsed = time.perf_counter() - start
+        rss_after = peak_rss_mb()
+    return {"seconds": round(elapsed, 3), "peak_rss_mb": round(rss_after, 1),
+            "peak_rss_increase_mb": round(max(rss_after - rss_before, 0.0), 1), "result": result}
+
+# ----------------------------- Suite (parent process) -----------------------------
+def run_in_subprocess(case, data_dir, verbose=False):
+    with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+        command = [sys.executable, os.path.abspath(__file__), "--run-case", case,
+                   "--data-dir", data_dir, "--result-file", result_file.name]
+        completed = subprocess.run(command, cwd=REPO_DIR, capture_output=not verbose, text=True)
+        if completed.returncode != 0:
+            return {"error": (completed.stderr or "").strip().splitlines()[-1:] or [f"exit {completed.returncode}"]}
+        with open(result_file.name) as f:
+            return json.load(f)
+
+def compare(results, baseline, tolerance):
+    """(size, case, metric, baseline, current) for every metric worse than baseline by more than tolerance"""
+    previous = {(r["size"], r["case"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        before = previous.get((result["size"], result["case"]))
+        if not before:
+            continue
+        for metric in ("seconds", "peak_rss_increase_mb"):
+            if metric in result and metric in before and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append((result["size"], result["case"], metric, before[metric], result[metric]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["small", "medium"])
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--data-root", help="keep generated data here instead of a temp directory")
+    parser.add_argument("--verbose", action="store_true", help="show handler output")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--data-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        result = run_case(args.run_case, args.data_dir)
+        with open(args.result_file, "w") as f:
+            json.dump(result, f, default=str)
+        return
+
+    import pandas as pd
+    import pyarrow as pa
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(), "platform": platform.platform(),
+        "pandas": pd.__version__, "pyarrow": pa.__version__, "cpu_count": os.cpu_count(),
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            data_dir = os.path.join(args.data_root or tmp, size)
+            start = time.perf_counter()
+            summary = synthetic_data.generate(data_dir, **SIZES[size])
+            print(f"📦 {size}: {summary['long_rows']} OD rows over {summary['n_lads']} LADs "
+                  f"generated in {time.perf_counter() - start:.0f}s")
+            for case in args.cases:
+                result = {"size": size, "case": case, **SIZES[size], "long_rows": summary["long_rows"],
+                          **run_in_subprocess(case, data_dir, args.verbose)}
+                report["results"].append(result)
+                if "seconds" in result:
+                    print(f"  {case}: {result['seconds']:8.2f}s  peak RSS {result['peak_rss_mb']:7.0f} MB "
+                          f"(+{result['peak_rss_increase_mb']:.0f} MB)")
+                else:
+                    print(f"  {case}: {result.get('skipped') or result.get('error')}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"📝 Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report["results"], json.load(f), args.tolerance)
+        for size, case, metric, before, after in regressions:
+            print(f"⚠️ {size}/{case}: {metric} {before} -> {after}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
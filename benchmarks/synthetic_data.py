@@ -0,0 +1,170 @@
+"""Synthetic pipeline inputs at realistic scale for the benchmark suite.
+
+Writes, for a set of LADs, every input steps 2-7 read:
+
+- ONS-format workbooks (the wide-by-age OD table on sheet 4) for the new series
+- the cleaned long-format Parquet files step2 would produce from them
+- step3's combined new series
+- the modelled backseries as a zipped Parquet file
+- the year-partitioned OD flows step5 and step7 read
+- the region, country and inner/outer London lookup CSVs
+
+Every year is a random subset of LAD pairs (``density``) with all 91 ages
+and both sexes, so 360 LADs at density 1.0 over 2002-2023 is the full
+360 x 360 x 91 x 2 x 22 scale. Data is generated and written one year at a
+time.
+
+    python benchmarks/synthetic_data.py --n-lads 120 --density 0.25 --out /tmp/synthetic
+"""
+import argparse
+import os
+import sys
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from openpyxl import Workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ons_workbook_reader import LONG_SCHEMA, to_long_format
+
+AGES = range(91)
+FIRST_YEAR = 2002
+LAST_YEAR = 2023
+START_YR_NEW_SERIES = 2012  # step4: older years come from the backseries
+LAST_BACKSERIES_YEAR = 2020
+LONDON_BOROUGHS = 33
+INNER_LONDON_BOROUGHS = 14
+ENGLISH_REGIONS = [f"E1200000{i}" for i in range(1, 10) if i != 7]  # London (E12000007) is the E09 boroughs
+
+# File layout inside the output directory
+WORKBOOK_DIR = "raw"
+CLEANED_DIR = "cleaned"
+COMBINED_FILE = "cleaned_data_combined.parquet"
+BACKSERIES_ZIP = "origin_destination_2002_to_2020.parquet.zip"
+FLOWS_DIR = "domestic_od_flows"
+LOOKUP_DIR = "lookups"
+
+def lad_codes(n_lads):
+    """London boroughs (E09) first, then unitary, district, metropolitan and Welsh authorities"""
+    boroughs = [f"E09{i:06d}" for i in range(1, min(n_lads, LONDON_BOROUGHS) + 1)]
+    prefixes = ["E06", "E07", "E08", "W06"]
+    others = [f"{prefixes[i % 4]}{i // 4 + 1:06d}" for i in range(n_lads - len(boroughs))]
+    return boroughs + others
+
+def synthetic_lookups(lads):
+    """lookup_lad_rgn_ctry, lookup_lad_ctry and lookup_lad_inner_outer_london tables"""
+    def region(lad):
+        if lad.startswith("E09"):
+            return "E12000007"
+        if lad.startswith("W"):
+            return "W92000004"
+        return ENGLISH_REGIONS[int(lad[3:]) % len(ENGLISH_REGIONS)]
+
+    countries = ["W92000004" if lad.startswith("W") else "E92000001" for lad in lads]
+    io_london = ["E13000001" if lad.startswith("E09") and int(lad[3:]) <= INNER_LONDON_BOROUGHS else
+                 "E13000002" if lad.startswith("E09") else "other" for lad in lads]
+    return {
+        "lookup_lad_rgn_ctry.csv": pd.DataFrame({"lad_code": lads, "region_code": [region(lad) for lad in lads],
+                                                 "country_code": countries}),
+        "lookup_lad_ctry.csv": pd.DataFrame({"lad_code": lads, "country_code": countries}),
+        "lookup_lad_inner_outer_london.csv": pd.DataFrame({"lad_code": lads, "io_london": io_london}),
+    }
+
+def wide_year(lads, year, density, rng):
+    """One year's OD table in the ONS sheet-4 layout: OutLA, InLA, Sex, Year, Age_0 ... Age_90"""
+    n = len(lads)
+    pairs = rng.choice(n * n, size=max(1, int(n * n * density)), replace=False)
+    pairs.sort()
+    out_index, in_index = np.divmod(np.repeat(pairs, 2), n)
+    rows = len(out_index)
+    counts = rng.poisson(0.6, size=(rows, len(AGES))).astype(np.float64)
+    columns = {
+        "OutLA": pa.array(np.asarray(lads, dtype=object)[out_index]),
+        "InLA": pa.array(np.asarray(lads, dtype=object)[in_index]),
+        "Sex": pa.array(np.tile(["F", "M"], rows // 2)),
+        "Year": pa.array(np.full(rows, year, dtype=np.int64)),
+    }
+    columns.update({f"Age_{age}": pa.array(counts[:, age]) for age in AGES})
+    return pa.RecordBatch.from_pydict(columns)
+
+def write_workbook(path, batch):
+    """Write a wide batch as an ONS workbook: contents sheets, the table on sheet 4, then footnotes"""
+    workbook = Workbook(write_only=True)
+    for i in range(4):
+        workbook.create_sheet(f"Contents {i}").append(["Notes"])
+    sheet = workbook.create_sheet("Table 4")
+    sheet.append(batch.schema.names)
+    for row in zip(*(column.to_pylist() for column in batch.columns)):
+        sheet.append(row)
+    sheet.append([])
+    sheet.append(["Source: Office for National Statistics"])
+    workbook.save(path)
+
+def write_backseries_zip(parquet_path, zip_path):
+    """Zip the backseries Parquet file (stored, as step4 reads it in place)"""
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as z:
+        z.write(parquet_path, arcname=os.path.basename(parquet_path))
+    os.remove(parquet_path)
+
+def generate(out_dir, n_lads=120, density=0.25, workbook_years=None, seed=0):
+    """Write every synthetic input under out_dir. Returns a summary of what was written.
+
+    ``workbook_years`` limits how many of the latest new-series years also
+    get an .xlsx workbook (writing workbooks dominates generation time at
+    full scale); the cleaned Parquet files cover every new-series year.
+    """
+    rng = np.random.default_rng(seed)
+    lads = lad_codes(n_lads)
+    for directory in (WORKBOOK_DIR, CLEANED_DIR, FLOWS_DIR, LOOKUP_DIR):
+        os.makedirs(os.path.join(out_dir, directory), exist_ok=True)
+    for name, lookup in synthetic_lookups(lads).items():
+        lookup.to_csv(os.path.join(out_dir, LOOKUP_DIR, name), index=False)
+
+    new_years = list(range(START_YR_NEW_SERIES, LAST_YEAR + 1))
+    workbook_years = new_years[-workbook_years:] if workbook_years else new_years
+    backseries_path = os.path.join(out_dir, BACKSERIES_ZIP[:-len(".zip")])
+    summary = {"n_lads": n_lads, "density": density, "long_rows": 0, "workbooks": 0}
+
+    with pq.ParquetWriter(backseries_path, LONG_SCHEMA) as backseries, \
+         pq.ParquetWriter(os.path.join(out_dir, COMBINED_FILE), LONG_SCHEMA) as combined:
+        for year in range(FIRST_YEAR, LAST_YEAR + 1):
+            batch = wide_year(lads, year, density, rng)
+            long_batch = to_long_format(batch)
+            long_table = pa.Table.from_batches([long_batch])
+            summary["long_rows"] += long_batch.num_rows
+
+            if year <= LAST_BACKSERIES_YEAR:
+                backseries.write_batch(long_batch)
+            if year >= START_YR_NEW_SERIES:
+                combined.write_batch(long_batch)
+                pq.write_table(long_table, os.path.join(out_dir, CLEANED_DIR, f"detailedestimates{year}on2023las.parquet"))
+            if year in workbook_years:
+                write_workbook(os.path.join(out_dir, WORKBOOK_DIR, f"detailedestimates{year}on2023las.xlsx"), batch)
+                summary["workbooks"] += 1
+
+            # Step5/7 read the combined series without self-flows, partitioned by year
+            flows = long_table.filter(pc.not_equal(long_table["gss_in"].cast(pa.string()),
+                                                   long_table["gss_out"].cast(pa.string())))
+            partition = os.path.join(out_dir, FLOWS_DIR, f"year={year}")
+            os.makedirs(partition, exist_ok=True)
+            pq.write_table(flows.drop_columns(["year"]), os.path.join(partition, "part-0.parquet"))
+
+    write_backseries_zip(backseries_path, os.path.join(out_dir, BACKSERIES_ZIP))
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--n-lads", type=int, default=120)
+    parser.add_argument("--density", type=float, default=0.25)
+    parser.add_argument("--workbook-years", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.out, args.n_lads, args.density, args.workbook_years, args.seed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import pytest
+
+import instrumentation
+
+@pytest.fixture(autouse=True)
+def report_dir(monkeypatch, tmp_path):
+    """Every test's perf reports go to its own temp directory instead of ./perf_reports"""
+    monkeypatch.setattr(instrumentation, "REPORT_DIR", str(tmp_path / "perf_reports"))
+    return tmp_path / "perf_reports"
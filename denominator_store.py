@@ -0,0 +1,120 @@
+import hashlib
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Step 6 download and its columnar copy
+POPULATION_PATH = "data/processed/population_coc.rds"
+STORE_PATH = "data/processed/population_coc.parquet"
+
+# Sort order of the store; lookups filter on these so row-group statistics can skip most of the file
+KEY_COLUMNS = ["gss_code", "year", "age", "sex"]
+ROW_GROUP_SIZE = 100_000
+
+# Parquet key-value metadata recording which source the store was built from
+SOURCE_SIZE_KEY = b"source_size"
+SOURCE_SHA256_KEY = b"source_sha256"
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+def read_rds(path):
+    """The single data frame in an RDS file (pyreadr is only needed when the store is rebuilt)"""
+    import pyreadr
+    return pyreadr.read_r(path)[None]
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_current(source, path):
+    """True if the store at path was built from source as it is now: same size, then same hash"""
+    if not os.path.exists(path):
+        return False
+    metadata = pq.read_schema(path).metadata or {}
+    if metadata.get(SOURCE_SIZE_KEY) != str(os.path.getsize(source)).encode():
+        return False
+    return metadata.get(SOURCE_SHA256_KEY) == file_sha256(source).encode()
+
+def build_store(source, path, read_source=read_rds):
+    """Convert the population table to Parquet sorted by KEY_COLUMNS, tagged with the source's size and hash"""
+    df = read_source(source)
+    for column in ("year", "age"):
+        df[column] = pd.to_numeric(df[column], downcast="integer")
+    df = df.sort_values(KEY_COLUMNS, ignore_index=True)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        SOURCE_SIZE_KEY: str(os.path.getsize(source)).encode(),
+        SOURCE_SHA256_KEY: file_sha256(source).encode(),
+    })
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    pq.write_table(table, tmp_path, row_group_size=ROW_GROUP_SIZE, write_statistics=True)
+    os.replace(tmp_path, path)
+    print(f"🗃️ Built population store {path} ({table.num_rows} rows)")
+
+def ensure_store(source=POPULATION_PATH, path=STORE_PATH, read_source=read_rds):
+    """Path of an up-to-date store for source, rebuilding it only if the source changed"""
+    if is_current(source, path):
+        print(f"♻️ Population store {path} is up to date")
+    else:
+        build_store(source, path, read_source)
+    return path
+
+class DenominatorStore:
+    """Memory-mapped lookups into the population store.
+
+    Only the row groups whose statistics can match a lookup are read, so a
+    join against a few areas and years touches a small part of the file.
+    """
+
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        self.schema = pq.read_schema(path)
+
+    @property
+    def value_columns(self):
+        return [name for name in self.schema.names if name not in KEY_COLUMNS]
+
+    def lookup(self, gss_codes=None, years=None, ages=None, sexes=None, columns=None):
+        """Population rows matching every given key, as a DataFrame sorted by KEY_COLUMNS"""
+        filters = [(column, "in", list(values))
+                   for column, values in zip(KEY_COLUMNS, (gss_codes, years, ages, sexes))
+                   if values is not None]
+        if columns is not None:
+            columns = KEY_COLUMNS + [column for column in columns if column not in KEY_COLUMNS]
+        table = pq.read_table(self.path, columns=columns, filters=filters or None, memory_map=True)
+        return table.to_pandas()
+
+    def join(self, df, on=("gss_code", "year", "age", "sex"), left_on=None, columns=None, how="left"):
+        """Merge population onto df, reading only the codes and years df contains.
+
+        ``on`` names the store keys to match; ``left_on`` the matching
+        columns of df if they are named differently. Keys left out of ``on``
+        (e.g. sex) are summed over.
+        """
+        on = list(on)
+        left_on = list(left_on) if left_on is not None else on
+        keys = dict(zip(on, left_on))
+        population = self.lookup(
+            gss_codes=pd.unique(df[keys["gss_code"]]) if "gss_code" in keys else None,
+            years=pd.unique(df[keys["year"]]) if "year" in keys else None,
+            columns=columns,
+        )
+        values = [column for column in population.columns if column not in KEY_COLUMNS]
+        population = population.groupby(on, as_index=False, sort=False)[values].sum()
+        return df.merge(population, left_on=left_on, right_on=on, how=how,
+                        suffixes=("", "_population")).drop(columns=[c for c in on if c not in left_on])
+
+def migration_rates(df, store, flow_col="value", population_col=None, on=("gss_code", "year", "age", "sex"), left_on=None):
+    """df with its population and flow_col / population as "rate" (NaN where population is missing or zero)"""
+    population_col = population_col or store.value_columns[0]
+    joined = store.join(df, on=on, left_on=left_on, columns=[population_col])
+    population = joined[population_col].where(joined[population_col] > 0)
+    joined["rate"] = joined[flow_col] / population
+    return joined
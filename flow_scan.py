@@ -0,0 +1,70 @@
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from flow_schema import conform
+
+# Rows per record batch when a scan is streamed
+SCAN_BATCH_SIZE = 1_000_000
+
+def open_flows(path, filesystem=None):
+    """Lazy dataset over the year-partitioned OD flows written by step4; nothing is read yet"""
+    return ds.dataset(path, format="parquet", partitioning="hive", filesystem=filesystem)
+
+def flow_filter(years=None, min_age=None, max_age=None, codes_in=None, codes_out=None):
+    """pyarrow filter expression for the given constraints, or None if there are none.
+
+    The year test prunes whole partitions; the age and code tests are
+    checked against row-group statistics before any rows are decoded.
+    """
+    conditions = []
+    if years is not None:
+        conditions.append(ds.field("year").isin(list(years)))
+    if min_age is not None:
+        conditions.append(ds.field("age") >= min_age)
+    if max_age is not None:
+        conditions.append(ds.field("age") <= max_age)
+    if codes_in is not None:
+        conditions.append(ds.field("gss_in").isin(list(codes_in)))
+    if codes_out is not None:
+        conditions.append(ds.field("gss_out").isin(list(codes_out)))
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+def scan_flows(dataset, columns=None, batch_size=SCAN_BATCH_SIZE, **filters):
+    """Scanner reading only `columns` of the rows matching `filters` (see flow_filter)"""
+    return dataset.scanner(columns=columns, filter=flow_filter(**filters), batch_size=batch_size)
+
+def partition_years(dataset, years=None):
+    """Sorted year= partition values of a dataset, optionally restricted to years.
+
+    A dataset that is not partitioned by year (such as an in-memory table)
+    gets the distinct values of its year column instead, read on their own.
+    Returns [None] when there is no year at all, meaning "scan everything
+    as one partition".
+    """
+    found = set()
+    for fragment in dataset.get_fragments():
+        year = ds.get_partition_keys(fragment.partition_expression).get("year")
+        if year is None:
+            found = None
+            break
+        found.add(year)
+    if found is None:
+        if "year" not in dataset.schema.names:
+            return [None]
+        found = set(pc.unique(dataset.to_table(columns=["year"])["year"]).drop_null().to_pylist())
+    if years is not None:
+        found &= set(years)
+    return sorted(found)
+
+def iter_year_partitions(dataset, columns=None, years=None, **filters):
+    """Yield (year, DataFrame) one year partition at a time, with filters and projection pushed into the scan.
+
+    Frames come out in the compact flow_schema types (categorical GSS codes, int16 year, uint8 age).
+    """
+    for year in partition_years(dataset, years):
+        partition_filters = dict(filters, years=[year] if year is not None else years)
+        table = scan_flows(dataset, columns=columns, **partition_filters).to_table()
+        yield year, conform(table).to_pandas()
@@ -0,0 +1,209 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from od_aggregation import append_missing, hierarchy_map
+
+# Source lookups: level -> (CSV path, parent column). Compiled together into one artifact.
+LOOKUP_REGION = "lookups/lookup_lad_rgn_ctry.csv"
+LOOKUP_COUNTRY = "lookups/lookup_lad_ctry.csv"
+LOOKUP_INNER_OUTER = "lookups/lookup_lad_inner_outer_london.csv"
+LEVELS = ("region", "country", "inner_outer")
+
+# Compiled artifact, written next to the lookups (ship it in the Lambda package). Bump the
+# format version when the artifact's layout changes so old files are recompiled.
+REGISTRY_FILE = "geography_registry.arrow"
+REGISTRY_FORMAT_VERSION = 3
+
+# GSS code classes are the 3-character entity code (E06 unitary, E07 district, E08 metropolitan,
+# E09 London borough, W06 Welsh UA, E12 region, ...). English and Welsh local authority classes
+# (E0x, W0x) are the ones step4 recodes between geography years.
+RECODABLE_CLASS_PREFIXES = ("E0", "W0")
+CLASS_TYPE = pa.dictionary(pa.int8(), pa.string())
+
+PARENT_INDEX_TYPE = pa.int16()
+
+# Compiled registries kept for the life of the process, keyed by the lookups' fingerprint,
+# so warm Lambda invocations and later steps in one run never re-read the lookups.
+_registries = {}
+_lookups = {}
+
+def lookup_sources():
+    return {
+        "region": (LOOKUP_REGION, "region_code"),
+        "country": (LOOKUP_COUNTRY, "country_code"),
+        "inner_outer": (LOOKUP_INNER_OUTER, "io_london"),
+    }
+
+def registry_path():
+    return os.path.join(os.path.dirname(LOOKUP_REGION), REGISTRY_FILE)
+
+def gss_class(codes):
+    """Entity code (first three characters) of each code, None for missing codes"""
+    return pd.Series(np.asarray(codes, dtype=object)).str[:3].to_numpy()
+
+def prefix_recodable(codes):
+    """is_recodable from the codes' own prefixes, for codes the registry does not hold"""
+    prefixes = pd.Series(np.asarray(codes, dtype=object)).str[:2]
+    return prefixes.isin(RECODABLE_CLASS_PREFIXES).to_numpy()
+
+def is_recodable(codes):
+    """Boolean array: which codes are English or Welsh local authorities (the E0/W0 codes step4 recodes).
+
+    Goes through the registry's GSS classes when a registry (lookups or
+    a shipped artifact) is available, else falls back to the prefixes.
+    """
+    registry = available_registry()
+    return prefix_recodable(codes) if registry is None else registry.is_recodable(codes)
+
+def sources_fingerprint(sources):
+    """Path, size and mtime of every lookup, or None if any is missing (a shipped artifact is then used as is)"""
+    parts = []
+    for level, (path, column) in sorted(sources.items()):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        parts.append([level, os.path.abspath(path), column, stat.st_size, stat.st_mtime_ns])
+    return json.dumps(parts)
+
+class GeographyRegistry:
+    """LAD hierarchies compiled to integer arrays.
+
+    ``codes`` are the sorted LAD codes; each level holds every LAD's
+    position in that level's sorted parent codes (-1 where unmapped), so
+    mapping any array of codes is one hash lookup plus a take.
+    """
+
+    def __init__(self, table):
+        self.codes = pd.Index(table["lad_code"].to_numpy(zero_copy_only=False))
+        classes = table["gss_class"].combine_chunks()
+        self.classes = classes.indices.to_numpy()
+        self.class_names = pd.Index(classes.dictionary.to_numpy(zero_copy_only=False))
+        # Recodable is decided once per class, then taken per code
+        self.recodable = np.append(self.class_names.str[:2].isin(RECODABLE_CLASS_PREFIXES)[self.classes], False)
+        self.levels = {}
+        for level in table.column_names:
+            if level in ("lad_code", "gss_class"):
+                continue
+            column = table[level].combine_chunks()
+            positions = column.indices.fill_null(-1).to_numpy().astype(np.int64)
+            self.levels[level] = (positions, pd.Index(column.dictionary.to_numpy(zero_copy_only=False)))
+        self._hierarchies = {}
+
+    def parent_index(self, codes, level):
+        """(parent position of each code, -1 if unknown or unmapped; sorted parent codes)"""
+        return self.hierarchy(level).parent_index(codes)
+
+    def is_recodable(self, codes):
+        """is_recodable through the code index; only codes outside the registry are checked by prefix"""
+        index = self.codes.get_indexer(codes)
+        flags = self.recodable[index]
+        unknown = index < 0
+        if unknown.any():
+            flags[unknown] = prefix_recodable(np.asarray(codes, dtype=object)[unknown])
+        return flags
+
+    def hierarchy(self, level, exclude=()):
+        """A level as a Hierarchy for od_aggregation, without excluded parents; built once per level and exclusion"""
+        key = (level, tuple(exclude))
+        if key not in self._hierarchies:
+            positions, parents = self.levels[level]
+            kept = ~parents.isin(exclude)
+            renumbered = append_missing(np.where(kept, np.cumsum(kept) - 1, -1))
+            self._hierarchies[key] = Hierarchy(self.codes, renumbered[positions], parents[kept])
+        return self._hierarchies[key]
+
+class Hierarchy:
+    """One compiled level, accepted wherever od_aggregation takes a child -> parent map"""
+
+    def __init__(self, codes, positions, parents):
+        self.codes = codes
+        self.positions = append_missing(positions)
+        self.parents = parents
+
+    def parent_index(self, codes):
+        """(parent position of each code, -1 if unknown or unmapped; sorted parent codes)"""
+        return self.positions[self.codes.get_indexer(codes)], self.parents
+
+    def nunique(self):
+        return len(self.parents)
+
+def compile_registry(sources, fingerprint=None):
+    """Arrow table holding every LAD, its GSS class and one dictionary-encoded parent column per level"""
+    maps = {level: hierarchy_map(pd.read_csv(path), column) for level, (path, column) in sources.items()}
+    codes = pd.Index(sorted(set().union(*(m.index for m in maps.values()))))
+    columns = {"lad_code": pa.array(codes.to_numpy(dtype=object), type=pa.string()),
+               "gss_class": pa.array(gss_class(codes), type=pa.string()).dictionary_encode().cast(CLASS_TYPE)}
+    for level, parent_map in maps.items():
+        mapped = parent_map.reindex(codes)
+        parents = pd.Index(mapped.dropna().unique()).sort_values()
+        positions = parents.get_indexer(mapped)
+        columns[level] = pa.DictionaryArray.from_arrays(
+            pa.array(positions, type=PARENT_INDEX_TYPE, mask=positions < 0),
+            pa.array(parents.to_numpy(dtype=object), type=pa.string()),
+        )
+    metadata = {"registry_format": str(REGISTRY_FORMAT_VERSION), "sources": fingerprint or ""}
+    return pa.table(columns).replace_schema_metadata(metadata)
+
+def write_registry(table, path):
+    """Write the artifact atomically; a read-only package directory just leaves it in memory"""
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with pa.OSFile(f"{path}.tmp", "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        print(f"⚠️ Could not write geography registry to {path}: {e}")
+
+def read_registry(path, fingerprint):
+    """The artifact at path if it matches the current format and lookups, else None"""
+    if not os.path.exists(path):
+        return None
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    metadata = table.schema.metadata or {}
+    if metadata.get(b"registry_format") != str(REGISTRY_FORMAT_VERSION).encode():
+        return None
+    if fingerprint is not None and metadata.get(b"sources") != fingerprint.encode():
+        return None
+    return table
+
+def load_registry():
+    """The geography registry, compiled from the lookups only when they changed since the artifact was written.
+
+    Kept at module level, so each process (or warm Lambda container)
+    loads it once.
+    """
+    sources = lookup_sources()
+    fingerprint = sources_fingerprint(sources)
+    if fingerprint in _registries:
+        return _registries[fingerprint]
+
+    path = registry_path()
+    table = read_registry(path, fingerprint)
+    if table is None:
+        print(f"🧭 Compiling geography registry to {path}")
+        table = compile_registry(sources, fingerprint)
+        write_registry(table, path)
+    _registries.clear()
+    _registries[fingerprint] = GeographyRegistry(table)
+    return _registries[fingerprint]
+
+def available_registry():
+    """load_registry(), or None when there are neither lookups nor a compiled artifact to load it from"""
+    if sources_fingerprint(lookup_sources()) is None and not os.path.exists(registry_path()):
+        return None
+    return load_registry()
+
+def read_lookup(path):
+    """A lookup CSV as a DataFrame, parsed once per process while the file is unchanged"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _lookups:
+        _lookups[key] = pd.read_csv(path)
+    return _lookups[key]
+
+if __name__ == "__main__":
+    compiled = compile_registry(lookup_sources(), sources_fingerprint(lookup_sources()))
+    write_registry(compiled, registry_path())
+    print(f"✅ {compiled.num_rows} LADs, levels {list(LEVELS)}, written to {registry_path()}")
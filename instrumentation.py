@@ -0,0 +1,164 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# CloudWatch namespace for the Embedded Metric Format records emitted in Lambda
+METRIC_NAMESPACE = "PopulationPipeline"
+
+# Outside Lambda, each run's stages are written here as <pipeline>-<timestamp>.json
+REPORT_DIR = os.environ.get("PERF_REPORT_DIR", "perf_reports")
+
+METRIC_UNITS = {
+    "duration_ms": "Milliseconds",
+    "peak_rss_mb": "Megabytes",
+    "peak_rss_increase_mb": "Megabytes",
+    "rows": "Count",
+    "s3_bytes_in": "Bytes",
+    "s3_bytes_out": "Bytes",
+}
+
+# Recorders currently running, innermost last; stage() attaches to the innermost one
+_active = []
+
+def in_lambda():
+    return "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+
+def peak_rss_mb():
+    """High-water resident set size of this process so far"""
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is KiB on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+
+class Stage:
+    """Counters for one named stage; safe to update from worker threads"""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.s3_bytes_in = 0
+        self.s3_bytes_out = 0
+        self.duration_ms = None
+        self.peak_rss_mb = None
+        self.peak_rss_increase_mb = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    def add_rows(self, count):
+        with self._lock:
+            self.rows += int(count)
+
+    def add_bytes_in(self, count):
+        with self._lock:
+            self.s3_bytes_in += int(count)
+
+    def add_bytes_out(self, count):
+        with self._lock:
+            self.s3_bytes_out += int(count)
+
+    def metrics(self):
+        return {name: getattr(self, name) for name in METRIC_UNITS}
+
+class StageRecorder:
+    """Per-stage wall time, peak RSS, rows and S3 bytes for one handler run.
+
+    Use it as a context manager around the handler body; stages are opened
+    with ``recorder.stage(name)`` or the module-level ``stage(name)``. On
+    exit the stages are emitted as CloudWatch EMF in Lambda, or written to
+    a JSON report under REPORT_DIR otherwise.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.stages = []
+        self.report_path = None
+
+    def __enter__(self):
+        _active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _active.remove(self)
+        self.emit()
+        return False
+
+    @contextmanager
+    def stage(self, name):
+        current = Stage(name)
+        self.stages.append(current)
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield current
+        except Exception as e:
+            current.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            current.duration_ms = round((time.perf_counter() - start) * 1000, 1)
+            current.peak_rss_mb = round(peak_rss_mb(), 1)
+            current.peak_rss_increase_mb = round(max(current.peak_rss_mb - rss_before, 0.0), 1)
+
+    def emit(self):
+        if in_lambda():
+            for record in self.emf_records():
+                print(json.dumps(record))
+            return
+        os.makedirs(REPORT_DIR, exist_ok=True)
+        now = time.time()
+        name = f"{self.pipeline}-{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}{int(now * 1000) % 1000:03d}.json"
+        self.report_path = os.path.join(REPORT_DIR, name)
+        with open(self.report_path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"📊 Stage report written to {self.report_path}")
+
+    def report(self):
+        return {
+            "pipeline": self.pipeline,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "stages": [{"stage": s.name, **s.metrics(), **({"error": s.error} if s.error else {})} for s in self.stages],
+        }
+
+    def emf_records(self):
+        """One Embedded Metric Format record per stage, dimensioned by pipeline and stage"""
+        timestamp = int(time.time() * 1000)
+        records = []
+        for s in self.stages:
+            metrics = {name: value for name, value in s.metrics().items() if value is not None}
+            records.append({
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": METRIC_NAMESPACE,
+                        "Dimensions": [["Pipeline", "Stage"]],
+                        "Metrics": [{"Name": name, "Unit": METRIC_UNITS[name]} for name in metrics],
+                    }],
+                },
+                "Pipeline": self.pipeline,
+                "Stage": s.name,
+                **metrics,
+                **({"Error": s.error} if s.error else {}),
+            })
+        return records
+
+@contextmanager
+def stage(name):
+    """A stage of the innermost running recorder, or an unrecorded Stage if none is running"""
+    if not _active:
+        yield Stage(name)
+        return
+    with _active[-1].stage(name) as current:
+        yield current
+
+class CountingReader:
+    """File-like wrapper counting the bytes read through it, for streamed uploads"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.bytes_read += len(data)
+        return data
@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+
+class EncodedFlows:
+    """OD flows with GSS codes and years factorized to integer positions once.
+
+    ``codes`` and ``years`` are sorted, so results built from these
+    positions come out in the same order as a pandas groupby.
+    """
+
+    def __init__(self, in_index, out_index, year_index, values, codes, years, age_index=None, ages=None):
+        self.in_index = in_index
+        self.out_index = out_index
+        self.year_index = year_index
+        self.values = values
+        self.codes = codes
+        self.years = years
+        self.age_index = age_index
+        self.ages = ages
+
+def encode_flows(df, col_in="gss_in", col_out="gss_out", col_year="year", col_value="value", col_age=None):
+    """Factorize both code columns against one shared, sorted vocabulary (and ages, if col_age is given)"""
+    codes = pd.Index(pd.unique(np.concatenate([pd.unique(df[col_in]), pd.unique(df[col_out])]))).dropna().sort_values()
+    year_index, years = pd.factorize(df[col_year], sort=True)
+    age_index, ages = pd.factorize(df[col_age], sort=True) if col_age is not None else (None, None)
+    values = df[col_value].to_numpy(dtype=np.float64, na_value=np.nan)
+    return EncodedFlows(
+        in_index=codes.get_indexer(df[col_in]),
+        out_index=codes.get_indexer(df[col_out]),
+        year_index=year_index,
+        values=np.where(np.isnan(values), 0.0, values),  # groupby sum skips NaN
+        codes=codes,
+        years=pd.Index(years),
+        age_index=age_index,
+        ages=pd.Index(ages) if ages is not None else None,
+    )
+
+def hierarchy_map(lookup, parent_col, child_col="lad_code"):
+    """child code -> parent code Series from a lookup table"""
+    return lookup.drop_duplicates(child_col).set_index(child_col)[parent_col]
+
+def parent_index(codes, parent_map):
+    """Index array giving each code's parent position (-1 if unmapped), and the sorted parent codes.
+
+    ``parent_map`` is a child -> parent Series, or a compiled
+    geography_registry.Hierarchy, which maps the codes itself.
+    """
+    if parent_map is None:
+        return np.arange(len(codes)), codes
+    if hasattr(parent_map, "parent_index"):
+        return parent_map.parent_index(codes)
+    mapped = parent_map.reindex(codes)
+    parents = pd.Index(mapped.dropna().unique()).sort_values()
+    return parents.get_indexer(mapped), parents
+
+def od_matrix(flows, parent_map=None):
+    """Sum flows by (origin parent, destination parent, year) with np.bincount.
+
+    Same rows as merging both ends against the lookup (rows with either end
+    unmapped dropped) and grouping by gss_in, gss_out, year.
+    """
+    index, parents = parent_index(flows.codes, parent_map)
+    p_in, p_out = append_missing(index)[flows.in_index], append_missing(index)[flows.out_index]
+    keep = (p_in >= 0) & (p_out >= 0) & (flows.year_index >= 0)
+
+    n_parents, n_years = len(parents), len(flows.years)
+    cell = (p_in[keep] * n_parents + p_out[keep]) * n_years + flows.year_index[keep]
+    size = n_parents * n_parents * n_years
+    sums = np.bincount(cell, weights=flows.values[keep], minlength=size)
+    present = np.flatnonzero(np.bincount(cell, minlength=size))
+
+    pair, year = np.divmod(present, n_years)
+    origin, destination = np.divmod(pair, n_parents)
+    return pd.DataFrame({
+        "gss_in": parents[origin],
+        "gss_out": parents[destination],
+        "year": flows.years[year],
+        "value": sums[present],
+    })
+
+def gross_flows(flows, parent_map=None, rounding=1):
+    """Total inflow and outflow for each area and year, like create_gross_flows.
+
+    With a parent_map the flows are first rolled up as in od_matrix, so
+    rows with either end unmapped are dropped.
+    """
+    index, parents = parent_index(flows.codes, parent_map)
+    p_in, p_out = append_missing(index)[flows.in_index], append_missing(index)[flows.out_index]
+    keep_in = (p_in >= 0) & (flows.year_index >= 0)
+    keep_out = (p_out >= 0) & (flows.year_index >= 0)
+    if parent_map is not None:
+        keep_in = keep_out = keep_in & keep_out
+
+    n_years = len(flows.years)
+    size = len(parents) * n_years
+    in_cell = p_in[keep_in] * n_years + flows.year_index[keep_in]
+    out_cell = p_out[keep_out] * n_years + flows.year_index[keep_out]
+    present = np.flatnonzero(np.bincount(in_cell, minlength=size) + np.bincount(out_cell, minlength=size))
+
+    area, year = np.divmod(present, n_years)
+    return pd.DataFrame({
+        "gss_code": parents[area],
+        "year": flows.years[year],
+        "inflow": np.bincount(in_cell, weights=flows.values[keep_in], minlength=size)[present].round(rounding),
+        "outflow": np.bincount(out_cell, weights=flows.values[keep_out], minlength=size)[present].round(rounding),
+    })
+
+def aggregate_geographies(df, hierarchies, rounding=1):
+    """Every rollup step5 needs from one encoding of the flows.
+
+    ``hierarchies`` maps a geography name to a child -> parent Series (see
+    hierarchy_map) or a compiled registry Hierarchy.
+    Returns {"lad_gross": ..., name: {"od": ..., "gross": ...}}.
+    """
+    flows = encode_flows(df)
+    results = {"lad_gross": gross_flows(flows, rounding=rounding)}
+    for name, parent_map in hierarchies.items():
+        results[name] = {
+            "od": od_matrix(flows, parent_map),
+            "gross": gross_flows(flows, parent_map, rounding=rounding),
+        }
+    return results
+
+def append_missing(index):
+    # Position -1 (a code missing from the vocabulary) picks up the trailing -1 and stays unmapped
+    return np.append(index, -1)
+
+def concat_results(parts):
+    """Join aggregate_geographies results computed on year-disjoint slices of the flows"""
+    def concat(frames, keys):
+        return pd.concat(frames, ignore_index=True).sort_values(keys, ignore_index=True)
+
+    if not parts:
+        return {}
+    combined = {"lad_gross": concat([part["lad_gross"] for part in parts], ["gss_code", "year"])}
+    for name in parts[0]:
+        if name == "lad_gross":
+            continue
+        combined[name] = {
+            "od": concat([part[name]["od"] for part in parts], ["gss_in", "gss_out", "year"]),
+            "gross": concat([part[name]["gross"] for part in parts], ["gss_code", "year"]),
+        }
+    return combined
+
+TOTAL_CODE = "total"
+DIRECTIONS = ["inflow", "outflow", "netflow"]
+DIRECTIONAL_COLUMNS = ["gss_code", "origin_destination_code", "year", "age"] + DIRECTIONS
+
+# Largest cell space directional_flows counts into a dense array; beyond it, occupied cells are sorted out with np.unique
+DENSE_CELL_LIMIT = 50_000_000
+
+def directional_flows(flows, hierarchies):
+    """Inflow, outflow and netflow by area, counterpart, year and age for every hierarchy at once.
+
+    ``flows`` must be encoded with ages. Each hierarchy contributes flows
+    between its parents plus a "total" counterpart that counts every flow
+    into or out of a parent, whether or not the other end is mapped. All
+    hierarchies share one integer key space, so a single grouped sum builds
+    every OD cell; outflows are then the same sums read at the transposed
+    (destination, origin) key. Returns gss_code, origin_destination_code,
+    year, age, inflow, outflow, netflow.
+    """
+    labels, origins, destinations, keep_rows = [], [], [], []
+    offset = 0
+    for parent_map in hierarchies.values():
+        index, parents = parent_index(flows.codes, parent_map)
+        total = offset + len(parents)
+        p_in = append_missing(np.where(index >= 0, index + offset, -1))[flows.in_index]
+        p_out = append_missing(np.where(index >= 0, index + offset, -1))[flows.out_index]
+        # Parent to parent, parent to total (inflows) and total to parent (outflows)
+        origins += [p_out, np.full_like(p_out, total), p_out]
+        destinations += [p_in, p_in, np.full_like(p_in, total)]
+        keep_rows += [(p_in >= 0) & (p_out >= 0), p_in >= 0, p_out >= 0]
+        labels += list(parents) + [TOTAL_CODE]
+        offset = total + 1
+
+    n_codes, n_years, n_ages = offset, len(flows.years), len(flows.ages)
+    rows = np.tile(np.arange(len(flows.values)), len(keep_rows))
+    keep = np.concatenate(keep_rows) & (flows.year_index[rows] >= 0) & (flows.age_index[rows] >= 0)
+    rows = rows[keep]
+    time = flows.year_index[rows] * n_ages + flows.age_index[rows]
+    cell = (np.concatenate(destinations)[keep] * n_codes + np.concatenate(origins)[keep]) * (n_years * n_ages) + time
+
+    size = n_codes * n_codes * n_years * n_ages
+    if size <= DENSE_CELL_LIMIT:
+        # Few enough cells to count into directly, as od_matrix does
+        keys = np.flatnonzero(np.bincount(cell, minlength=size))
+        sums = np.bincount(cell, weights=flows.values[rows], minlength=size)[keys]
+    else:
+        keys, inverse = np.unique(cell, return_inverse=True)
+        sums = np.bincount(inverse, weights=flows.values[rows], minlength=len(keys))
+
+    # Transpose-join: the outflow of (area, counterpart) is the inflow of (counterpart, area)
+    pair, time = np.divmod(keys, n_years * n_ages)
+    destination, origin = np.divmod(pair, n_codes)
+    transposed = (origin * n_codes + destination) * (n_years * n_ages) + time
+    all_keys = np.union1d(keys, transposed)
+    inflow = np.zeros(len(all_keys))
+    outflow = np.zeros(len(all_keys))
+    inflow[np.searchsorted(all_keys, keys)] = sums
+    outflow[np.searchsorted(all_keys, transposed)] = sums
+
+    pair, time = np.divmod(all_keys, n_years * n_ages)
+    area, counterpart = np.divmod(pair, n_codes)
+    year, age = np.divmod(time, n_ages)
+    labels = np.array(labels, dtype=object)
+    real_area = labels[area] != TOTAL_CODE  # "total" rows only mirror the area rows
+    return pd.DataFrame({
+        "gss_code": labels[area][real_area],
+        "origin_destination_code": labels[counterpart][real_area],
+        "year": flows.years[year[real_area]],
+        "age": flows.ages[age[real_area]],
+        "inflow": inflow[real_area],
+        "outflow": outflow[real_area],
+        "netflow": (inflow - outflow)[real_area],
+    })
+
+def concat_directional_flows(parts):
+    """Join directional_flows results computed on year-disjoint slices of the flows, as concat_results does"""
+    if not parts:
+        return pd.DataFrame(columns=DIRECTIONAL_COLUMNS)
+    return pd.concat(parts, ignore_index=True).sort_values(DIRECTIONAL_COLUMNS[:4], ignore_index=True)
+
+def wide_by_age(net, ages=None):
+    """One row per gss_code, origin_destination_code, direction and year with a column per age.
+
+    Same table as melting ``net`` on DIRECTIONS and pivoting age to columns
+    with fill_value=0, built by writing values straight into a 2-d array.
+    """
+    keys = ["gss_code", "origin_destination_code", "year"]
+    row_index, rows = pd.MultiIndex.from_frame(net[keys]).factorize(sort=True)
+    ages = pd.Index(sorted(net["age"].unique()) if ages is None else ages)
+    age_index = ages.get_indexer(net["age"])
+    in_band = age_index >= 0
+
+    values = np.zeros((len(DIRECTIONS), len(rows), len(ages)))
+    for position, direction in enumerate(DIRECTIONS):
+        values[position, row_index[in_band], age_index[in_band]] = net[direction].to_numpy()[in_band]
+
+    labels = pd.DataFrame({key: rows.get_level_values(level) for level, key in enumerate(keys)})
+    wide = pd.concat([labels] * len(DIRECTIONS), ignore_index=True)
+    wide.insert(2, "direction", np.repeat(DIRECTIONS, len(rows)))
+    wide = pd.concat([wide, pd.DataFrame(values.reshape(-1, len(ages)), columns=list(ages))], axis=1)
+    return wide.sort_values(["gss_code", "origin_destination_code", "direction", "year"], ignore_index=True)
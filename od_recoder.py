@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+from gsscoder_python import recode_gss
+from geography_registry import is_recodable
+
+def build_recode_lookup(codes, recode_from_year, recode_to_year):
+    """Map each code to its code in recode_to_year geography.
+
+    gsscoder_python is run once over the unique codes rather than over the
+    data: each code is carried through as an extra (grouping) column, so the
+    output pairs every source code with its recoded code.
+    """
+    codes = list(codes)
+    if not codes:
+        return {}
+    probe = pd.DataFrame({"gss_code": codes, "source_code": codes, "value": 1.0})
+    recoded = recode_gss(
+        df_in=probe,
+        col_code="gss_code",
+        col_data="value",
+        fun="sum",
+        recode_from_year=recode_from_year,
+        recode_to_year=recode_to_year,
+    )
+    return dict(zip(recoded["source_code"], recoded["gss_code"]))
+
+def recode_od(df, recode_from_year, recode_to_year, col_in="gss_in", col_out="gss_out", col_data="value", lookup=None):
+    """Recode both ends of an OD frame in one pass.
+
+    Gives the same rows as recoding ``col_in`` and then ``col_out`` with
+    recode_gss on their E0/W0 rows. Codes are factorized, mapped through an
+    integer lookup built from the unique codes, and every row with at least
+    one recodable end is aggregated with a single grouped sum. Rows with
+    neither end recodable pass through untouched.
+
+    ``lookup`` (code -> recoded code) can be given to skip building it.
+    """
+    in_index, in_codes = pd.factorize(df[col_in])
+    out_index, out_codes = pd.factorize(df[col_out])
+    in_codes, out_codes = pd.Index(in_codes), pd.Index(out_codes)
+
+    if lookup is None:
+        codes = in_codes.union(out_codes)
+        lookup = build_recode_lookup(sorted(codes[is_recodable(codes)]), recode_from_year, recode_to_year)
+
+    targets = pd.Index(sorted({lookup.get(code, code) for code in in_codes.union(out_codes)}))
+
+    def integer_lookup(codes):
+        # Position of each factorized code's target; the trailing -1 keeps missing codes (index -1) missing
+        positions = targets.get_indexer([lookup.get(code, code) for code in codes])
+        flags = np.append(is_recodable(codes), False)
+        return np.append(positions, -1), flags
+
+    in_lookup, in_flags = integer_lookup(in_codes)
+    out_lookup, out_flags = integer_lookup(out_codes)
+    touched = in_flags[in_index] | out_flags[out_index]
+
+    recoded = df.loc[touched].copy()
+    recoded[col_in] = pd.Categorical.from_codes(in_lookup[in_index[touched]], categories=targets)
+    recoded[col_out] = pd.Categorical.from_codes(out_lookup[out_index[touched]], categories=targets)
+
+    group_cols = [col for col in df.columns if col != col_data]
+    aggregated = recoded.groupby(group_cols, as_index=False, observed=True, sort=False)[col_data].sum()
+    untouched = df.loc[~touched]
+    for col in (col_in, col_out):
+        dtype = df[col].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            # Categorical (compact) codes keep one shared set of categories, so the concat stays categorical
+            dtype = pd.CategoricalDtype(dtype.categories.union(targets))
+            untouched = untouched.astype({col: dtype})
+        aggregated[col] = aggregated[col].astype(dtype)
+
+    return pd.concat([aggregated[df.columns], untouched], ignore_index=True)
@@ -0,0 +1,158 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from itertools import chain
+from openpyxl import load_workbook
+from flow_schema import FLOW_SCHEMA
+
+# python-calamine (Rust) parses .xlsx several times faster than openpyxl; used when installed
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
+# The detailed internal migration estimates workbooks keep the OD table on the fifth sheet
+DETAILED_ESTIMATES_SHEET = 4
+BATCH_SIZE = 50_000
+
+# Whole-number columns; other numeric columns are flow counts and read as float64
+INTEGER_COLUMNS = ("year", "age")
+
+def read_detailed_estimates(path, sheet_index=DETAILED_ESTIMATES_SHEET, batch_size=BATCH_SIZE, engine=None):
+    """Stream the detailed estimates sheet of an ONS workbook as typed Arrow record batches.
+
+    Equivalent to ``pd.read_excel(path, sheet_name=4).dropna()``: the first
+    non-blank row is the header and rows with any empty cell are skipped as
+    they are read. Column types are fixed from the first batch: text columns
+    are strings, ``year``/``age`` are int64 and all other numbers float64.
+
+    Returns a ``pyarrow.RecordBatchReader``.
+    """
+    engine = engine or ("calamine" if CalamineWorkbook is not None else "openpyxl")
+    rows = iter_sheet_rows(path, sheet_index, engine)
+
+    header = next((row for row in rows if any(not is_missing(v) for v in row)), None)
+    if header is None:
+        return pa.RecordBatchReader.from_batches(pa.schema([]), [])
+    names = [str(name).strip() if not is_missing(name) else f"Unnamed: {i}" for i, name in enumerate(header)]
+
+    batches = iter_batches(rows, names, batch_size)
+    first = next(batches, None)
+    if first is None:
+        schema = pa.schema([(name, pa.string()) for name in names])
+        return pa.RecordBatchReader.from_batches(schema, [])
+    return pa.RecordBatchReader.from_batches(first.schema, chain([first], batches))
+
+def iter_sheet_rows(path, sheet_index, engine):
+    """Yield each row of one sheet as a tuple of cell values"""
+    if engine == "calamine":
+        if CalamineWorkbook is None:
+            raise ImportError("python-calamine is not installed")
+        workbook = CalamineWorkbook.from_path(path)
+        try:
+            yield from workbook.get_sheet_by_index(sheet_index).iter_rows()
+        finally:
+            workbook.close()
+    elif engine == "openpyxl":
+        # Read-only mode parses the sheet XML lazily instead of building every cell object
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            yield from workbook.worksheets[sheet_index].iter_rows(values_only=True)
+        finally:
+            workbook.close()
+    else:
+        raise ValueError(f"Unknown engine: {engine}")
+
+def iter_batches(rows, names, batch_size):
+    """Group complete rows into record batches with a schema fixed by the first batch"""
+    width = len(names)
+    schema = None
+    buffer = []
+    for row in rows:
+        row = tuple(row[:width])
+        if len(row) < width or any(is_missing(v) for v in row):
+            continue
+        buffer.append(row)
+        if len(buffer) == batch_size:
+            batch = to_batch(buffer, names, schema)
+            schema = batch.schema
+            buffer = []
+            yield batch
+    if buffer:
+        yield to_batch(buffer, names, schema)
+
+def to_batch(rows, names, schema=None):
+    columns = list(zip(*rows))
+    if schema is None:
+        schema = pa.schema([(name, column_type(name, values)) for name, values in zip(names, columns)])
+    arrays = [to_array(values, field.type) for values, field in zip(columns, schema)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def column_type(name, values):
+    """Arrow type for a column, inferred from its first batch of values"""
+    if any(isinstance(v, str) for v in values):
+        return pa.string()
+    if name.lower() in INTEGER_COLUMNS:
+        return pa.int64()
+    return pa.float64()
+
+def to_array(values, arrow_type):
+    if pa.types.is_string(arrow_type):
+        return pa.array([str(v) for v in values], type=arrow_type)
+    # Excel stores every number as a double; the cast to int64 fails on any fractional year or age
+    return pa.array(values, type=pa.float64()).cast(arrow_type)
+
+def is_missing(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+# ------------------------- Long format -------------------------
+SEX_LABELS = {"F": "female", "M": "male"}
+
+# Long OD layout shared with the modelled backseries (flow_schema.FLOW_SCHEMA)
+LONG_SCHEMA = FLOW_SCHEMA
+
+def to_long_format(batch, year=None):
+    """Melt a wide-by-age batch (``OutLA, InLA, Sex, [Year,] Age_0 … Age_90``) into long OD rows.
+
+    The melt is vectorised: the age columns are stacked into one matrix and
+    only its non-zero cells are kept, as ``convert_age_data`` did. ``year``
+    is used when the sheet has no Year column. Rows come out in the compact
+    LONG_SCHEMA types.
+    """
+    lower = {name.lower(): i for i, name in enumerate(batch.schema.names)}
+    missing = [name for name in ("outla", "inla", "sex") if name not in lower]
+    if missing:
+        raise ValueError(f"Detailed estimates sheet is missing columns: {missing}")
+    if "year" not in lower and year is None:
+        raise ValueError("Sheet has no Year column and no year was given")
+
+    age_columns = [(int(name[4:]), i) for name, i in lower.items() if name.startswith("age_") and name[4:].isdigit()]
+    if not age_columns:
+        raise ValueError("Detailed estimates sheet has no Age_<n> columns")
+    ages = np.array([age for age, _ in age_columns], dtype=np.int64)
+
+    values = np.column_stack([
+        batch.column(i).cast(pa.float64()).to_numpy(zero_copy_only=False) for _, i in age_columns
+    ]).ravel()
+    keep = np.flatnonzero(values)
+    rows = pa.array(keep // len(ages))
+
+    def key_column(name):
+        return batch.column(lower[name])
+
+    arrays = {
+        "gss_out": pc.dictionary_encode(key_column("outla")).take(rows),
+        "gss_in": pc.dictionary_encode(key_column("inla")).take(rows),
+        "sex": sex_labels(key_column("sex")).take(rows),
+        "year": (key_column("year").cast(pa.int64()).take(rows) if "year" in lower
+                 else pa.array(np.full(len(keep), year, dtype=np.int64))),
+        "age": pa.array(ages[keep % len(ages)]),
+        "value": pa.array(values[keep]),
+    }
+    return pa.RecordBatch.from_arrays([arrays[field.name].cast(field.type) for field in LONG_SCHEMA], schema=LONG_SCHEMA)
+
+def sex_labels(column):
+    """Map ONS F/M sex codes to female/male, leaving anything else unchanged"""
+    encoded = pc.dictionary_encode(column.cast(pa.string()))
+    labels = pa.array([SEX_LABELS.get(code, code) for code in encoded.dictionary.to_pylist()], type=pa.string())
+    return labels.take(encoded.indices)
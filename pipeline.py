@@ -0,0 +1,235 @@
+import argparse
+import os
+import shutil
+import pyarrow as pa
+import pyarrow.dataset as ds
+from instrumentation import StageRecorder, stage
+from ons_workbook_reader import LONG_SCHEMA, read_detailed_estimates, to_long_format
+from run_manifest import release_name
+from storage import TMP_DIR, LocalStorage, make_storage
+
+# Layout under the pipeline root, a local directory or an s3://bucket/prefix/
+PIPELINE_ROOT = "data/pipeline"
+RAW_PREFIX = "raw/"
+CHECKPOINT_PREFIX = "checkpoints/"
+RECODE_CACHE_PREFIX = "cache/recoded_old_series/"
+DENOMINATOR_PREFIX = "denominator/"
+
+# Steps written to storage after they run, and read back instead of rerun (with their
+# upstream steps) while the checkpoint exists. Everything else stays in memory.
+DEFAULT_CHECKPOINTS = ("combined_series", "geographies", "children_flows")
+DEFAULT_TARGETS = ("geographies", "children_flows", "denominator", "rollup_cubes")
+
+# ----------------------------- Steps -----------------------------
+# Each step takes the run and its upstream results, and returns an Arrow table, a dict
+# of Arrow tables, or (for steps that are never checkpointed) any other object.
+def raw_workbooks(run):
+    """Step1: keys of the ONS workbooks under RAW_PREFIX, downloading new or revised releases first with scrape=True"""
+    if run.options.get("scrape"):
+        scrape_releases(run.storage)
+    return run.storage.list(RAW_PREFIX, suffixes=(".xlsx", ".xls"))
+
+def scrape_releases(storage):
+    """Step1's conditional, concurrent download of every release, into storage instead of the step1 bucket"""
+    import step1_ons_scraper as step1
+    session = step1.make_session(step1.MAX_WORKERS)
+    results = step1.fetch_releases(session, step1.release_urls(session), storage, RAW_PREFIX)
+    print(f"⬇️ {sum(r['status'] == 'downloaded' for r in results)} releases downloaded, "
+          f"{sum(r['status'] == 'unchanged' for r in results)} unchanged")
+    return results
+
+def cleaned_releases(run, raw_workbooks):
+    """Step2: each workbook's detailed estimates as a long-format table, by release name"""
+    from step2_clean_data import release_year
+    tables = {}
+    with stage("clean") as clean:
+        for key in raw_workbooks:
+            print(f"Cleaning {key}...")
+            with run.storage.local_path(key) as path:
+                year = release_year(key.rsplit("/", 1)[-1])
+                batches = [to_long_format(batch, year=year) for batch in read_detailed_estimates(path)]
+            tables[release_name(key)] = pa.Table.from_batches(batches, schema=LONG_SCHEMA)
+            clean.add_rows(tables[release_name(key)].num_rows)
+    return tables
+
+def new_series(run, cleaned_releases):
+    """Step3: every cleaned release in one table"""
+    return pa.concat_tables(cleaned_releases[name] for name in sorted(cleaned_releases))
+
+def combined_series(run, new_series):
+    """Step4: recoded old series plus the new series, without self-flows, sorted by year and codes"""
+    import step4_combine_series as step4
+    old_series = step4.load_recoded_old_series(run.storage.uri(RECODE_CACHE_PREFIX), run.options.get("backseries_uri"))
+    return step4.combine_frames([old_series, new_series])
+
+def geographies(run, combined_series):
+    """Step5: LAD gross flows and the region, country and inner/outer London rollups"""
+    import step5_converting_geographies as step5
+    results = step5.convert_geographies(ds.dataset(combined_series), step5.load_hierarchies())
+    return {name: to_arrow(df) for name, df in step5.output_tables(results).items()}
+
+def denominator(run):
+    """Step6: the population store under DENOMINATOR_PREFIX, downloaded and built if missing"""
+    import step6_downloading_denominator as step6
+    from denominator_store import STORE_PATH, DenominatorStore
+    keys = [f"{DENOMINATOR_PREFIX}{os.path.basename(path)}" for path in (step6.POPULATION_PATH, STORE_PATH)]
+    if isinstance(run.storage, LocalStorage):
+        return DenominatorStore(step6.main(*(run.storage.uri(key) for key in keys)))
+
+    # The store is memory-mapped, so on S3 both files are kept in a local copy and uploaded when they change
+    paths = [os.path.join(TMP_DIR, *key.split("/")) for key in keys]
+    modified = {}
+    for key, path in zip(keys, paths):
+        if not os.path.exists(path) and run.storage.exists(key):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with run.storage.local_path(key) as stored:
+                shutil.copyfile(stored, path)
+        modified[key] = os.path.getmtime(path) if os.path.exists(path) else None
+    step6.main(*paths)
+    for key, path in zip(keys, paths):
+        if os.path.getmtime(path) != modified[key]:
+            run.storage.put_file(path, key)
+    return DenominatorStore(paths[1])
+
+def children_flows(run, combined_series):
+    """Step7: in/out/net flows by age, long and wide"""
+    import step7_create_borough_children_flows as step7
+    net, wide = step7.build_children_flows(
+        ds.dataset(combined_series), step7.load_hierarchies(),
+        min_age=run.options.get("min_age", step7.MIN_CHILD_AGE), max_age=run.options.get("max_age", step7.MAX_CHILD_AGE),
+    )
+    return {"in_out_net_flows": to_arrow(net), "domestic_flows_children": to_arrow(wide)}
+
+def rollup_cubes(run, combined_series):
+    """Query cubes over the combined series, written under the cubes prefix; returns their manifest"""
+    import step5_converting_geographies as step5
+    from rollup_cubes import build_cubes
+    return build_cubes(ds.dataset(combined_series), run.storage, step5.load_hierarchies())
+
+# name: (upstream steps, function)
+STEPS = {
+    "raw_workbooks": ((), raw_workbooks),
+    "cleaned_releases": (("raw_workbooks",), cleaned_releases),
+    "new_series": (("cleaned_releases",), new_series),
+    "combined_series": (("new_series",), combined_series),
+    "geographies": (("combined_series",), geographies),
+    "denominator": ((), denominator),
+    "children_flows": (("combined_series",), children_flows),
+    "rollup_cubes": (("combined_series",), rollup_cubes),
+}
+
+def to_arrow(df):
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+def result_rows(result):
+    if isinstance(result, pa.Table):
+        return result.num_rows
+    if isinstance(result, dict):
+        return sum(result_rows(value) for value in result.values())
+    return 0
+
+# ----------------------------- Runner -----------------------------
+class PipelineRunner:
+    """Runs the steps some targets need, in dependency order, in one process.
+
+    Results are handed to downstream steps in memory and released once no
+    remaining step needs them. Steps listed in ``checkpoints`` are written
+    under CHECKPOINT_PREFIX; a later run reads an existing checkpoint back
+    instead of running that step and everything upstream of it, unless the
+    step is in ``force``. Options (scrape, backseries_uri, min_age, max_age)
+    are passed through to the steps.
+    """
+
+    def __init__(self, storage, checkpoints=DEFAULT_CHECKPOINTS, steps=None, **options):
+        self.storage = storage
+        self.checkpoints = set(checkpoints)
+        self.steps = steps or STEPS
+        self.options = options
+
+    def plan(self, targets, force=()):
+        """[(step, "load" or "run")] in execution order"""
+        planned = {}
+
+        def visit(name):
+            if name in planned:
+                return
+            if name in self.checkpoints and name not in force and self.has_checkpoint(name):
+                planned[name] = "load"
+                return
+            for upstream in self.steps[name][0]:
+                visit(upstream)
+            planned[name] = "run"
+
+        for target in targets:
+            visit(target)
+        return list(planned.items())
+
+    def run(self, targets=DEFAULT_TARGETS, force=()):
+        """Run the plan for targets and return their results, by step name"""
+        plan = self.plan(targets, force)
+        consumers = {name: sum(name in self.steps[step][0] for step, action in plan if action == "run")
+                     for name, _ in plan}
+        results = {}
+        with StageRecorder("pipeline") as perf:
+            for name, action in plan:
+                with perf.stage(name) as current:
+                    if action == "load":
+                        print(f"♻️ {name}: reading checkpoint")
+                        results[name] = self.load_checkpoint(name)
+                    else:
+                        print(f"▶️ {name}")
+                        upstream = self.steps[name][0]
+                        results[name] = self.steps[name][1](self, **{u: results[u] for u in upstream})
+                        for u in upstream:
+                            consumers[u] -= 1
+                            if not consumers[u] and u not in targets:
+                                del results[u]
+                        if name in self.checkpoints:
+                            current.add_bytes_out(self.save_checkpoint(name, results[name]))
+                    current.add_rows(result_rows(results[name]))
+        return {name: results[name] for name in targets}
+
+    def checkpoint_key(self, name, part=None):
+        return f"{CHECKPOINT_PREFIX}{name}.parquet" if part is None else f"{CHECKPOINT_PREFIX}{name}/{part}.parquet"
+
+    def has_checkpoint(self, name):
+        return self.storage.exists(self.checkpoint_key(name)) or bool(self.storage.list(f"{CHECKPOINT_PREFIX}{name}/"))
+
+    def save_checkpoint(self, name, result):
+        """Write a table, or each table of a dict, to storage. Returns the bytes written."""
+        if isinstance(result, pa.Table):
+            print(f"💾 Checkpointing {name} to {self.storage.uri(self.checkpoint_key(name))}")
+            return self.storage.write_table(result, self.checkpoint_key(name))
+        if isinstance(result, dict) and all(isinstance(table, pa.Table) for table in result.values()):
+            print(f"💾 Checkpointing {name} ({len(result)} tables) to {self.storage.uri(f'{CHECKPOINT_PREFIX}{name}/')}")
+            return sum(self.storage.write_table(table, self.checkpoint_key(name, part)) for part, table in result.items())
+        raise ValueError(f"Step {name} does not return Arrow tables and cannot be checkpointed")
+
+    def load_checkpoint(self, name):
+        if self.storage.exists(self.checkpoint_key(name)):
+            return self.storage.read_table(self.checkpoint_key(name))
+        prefix = f"{CHECKPOINT_PREFIX}{name}/"
+        return {key[len(prefix):-len(".parquet")]: self.storage.read_table(key)
+                for key in self.storage.list(prefix, suffixes=(".parquet",))}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run pipeline steps 1-7 in one process")
+    parser.add_argument("--root", default=PIPELINE_ROOT, help="local directory or s3://bucket/prefix/")
+    parser.add_argument("--targets", nargs="+", choices=list(STEPS), default=list(DEFAULT_TARGETS))
+    parser.add_argument("--checkpoints", nargs="*", choices=list(STEPS), default=list(DEFAULT_CHECKPOINTS))
+    parser.add_argument("--force", nargs="*", choices=list(STEPS), default=[], help="rerun despite a checkpoint")
+    parser.add_argument("--scrape", action="store_true", help="download new or revised ONS releases first")
+    parser.add_argument("--backseries-uri", help="zipped backseries Parquet, s3:// or local")
+    parser.add_argument("--min-age", type=int)
+    parser.add_argument("--max-age", type=int)
+    args = parser.parse_args()
+
+    options = {name: value for name, value in (("scrape", args.scrape), ("backseries_uri", args.backseries_uri),
+                                               ("min_age", args.min_age), ("max_age", args.max_age))
+               if value is not None}
+    runner = PipelineRunner(make_storage(args.root), checkpoints=args.checkpoints, **options)
+    for name, result in runner.run(args.targets, force=args.force).items():
+        print(f"✅ {name}: {result_rows(result)} rows")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import importlib.metadata
+import importlib.util
+import pandas as pd
+from botocore.exceptions import ClientError
+from storage import is_not_found, list_objects, parse_s3_path
+
+# Bump when the cached artifact's layout changes so old entries stop matching
+CACHE_FORMAT_VERSION = 2
+
+# Sources kept after a rebuild: the current key's entries plus those of the most recently written other keys
+MAX_CACHE_ENTRIES = 3
+
+# Separates a key from the year range of one of its entries ("<key>_y<first>-<last>")
+YEARS_SEPARATOR = "_y"
+
+def recoded_series_key(source_etag, recode_from_year, recode_to_year, max_year, columns, value_precision=None):
+    """Content address of a recoded old series: changes whenever any input to the recode changes.
+
+    Year shards store their own years under entry_key(key, years), so they
+    recode in parallel; eviction works per key, so they never evict each other.
+    """
+    parts = {
+        "format": CACHE_FORMAT_VERSION,
+        "source_etag": source_etag,
+        "recode_from_year": recode_from_year,
+        "recode_to_year": recode_to_year,
+        "max_year": max_year,
+        "columns": list(columns),
+        "value_precision": value_precision,
+        "gsscoder": gsscoder_lookup_version(),
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+def entry_key(key, years=None):
+    """Name of the entry holding key's rows for years (the whole series if None)"""
+    if years is None:
+        return key
+    years = sorted(years)
+    if years != list(range(years[0], years[-1] + 1)):
+        return f"{key}{YEARS_SEPARATOR}{hashlib.sha256(json.dumps(years).encode('utf-8')).hexdigest()[:12]}"
+    return f"{key}{YEARS_SEPARATOR}{years[0]}-{years[-1]}"
+
+def series_key(entry):
+    """The key an entry belongs to"""
+    return entry.split(YEARS_SEPARATOR)[0]
+
+def gsscoder_lookup_version():
+    """gsscoder_python version plus a hash of its bundled lookup files, if they can be found"""
+    try:
+        version = importlib.metadata.version("gsscoder_python")
+    except importlib.metadata.PackageNotFoundError:
+        version = "unknown"
+
+    spec = importlib.util.find_spec("gsscoder_python")
+    lookups_dir = os.path.join(os.path.dirname(spec.origin), "lookups") if spec and spec.origin else None
+    if not lookups_dir or not os.path.isdir(lookups_dir):
+        return version
+
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(lookups_dir)):
+        with open(os.path.join(lookups_dir, name), "rb") as f:
+            digest.update(name.encode("utf-8"))
+            digest.update(hashlib.sha256(f.read()).digest())
+    return f"{version}+{digest.hexdigest()[:12]}"
+
+def source_etag(uri, s3_client):
+    """ETag of an s3:// object, or size and mtime of a local file"""
+    if uri.startswith("s3://"):
+        bucket, key = parse_s3_path(uri)
+        return s3_client.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+    stat = os.stat(uri)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+def make_cache_store(location, s3_client, tmp_dir="/tmp"):
+    """Cache store for an s3://bucket/prefix/ URI or a local directory"""
+    if location.startswith("s3://"):
+        bucket, prefix = parse_s3_path(location)
+        return S3CacheStore(bucket, prefix, s3_client, tmp_dir)
+    return LocalCacheStore(location)
+
+def load_or_build(store, key, build, max_entries=MAX_CACHE_ENTRIES, years=None):
+    """Return the cached DataFrame for key (only its rows in years, if given), or build, store and return it.
+
+    With years, build must return just those years; they are stored as
+    their own entry, so each year shard recodes only its slice on a miss.
+    A whole-series entry for key also serves any years. After a rebuild,
+    the entries of keys other than the newest max_entries (always
+    including key) are evicted.
+    """
+    entry = entry_key(key, years)
+    path = store.load(entry)
+    if path is None and years is not None:
+        path = store.load(key)
+    if path is not None:
+        print(f"♻️ Cache hit for recoded old series ({entry})")
+        return pd.read_parquet(path, filters=[("year", "in", list(years))] if years is not None else None)
+
+    print(f"🧮 Cache miss for recoded old series ({entry}), rebuilding...")
+    df = build()
+    store.save(entry, df)
+    evict(store, key, max_entries)
+    return df
+
+def evict(store, current_key, max_entries=MAX_CACHE_ENTRIES):
+    """Delete the entries of stale keys, keeping current_key's and those of the most recently written other keys"""
+    written = {}
+    for entry, mtime in store.entries():
+        written[series_key(entry)] = max(mtime, written.get(series_key(entry), mtime))
+    others = sorted((key for key in written if key != current_key), key=written.get, reverse=True)
+    stale = set(others[max(max_entries - 1, 0):])
+    for entry, _ in store.entries():
+        if series_key(entry) in stale:
+            print(f"🗑️ Evicting stale cache entry {entry}")
+            store.delete(entry)
+
+class LocalCacheStore:
+    """Cache entries as <key>.parquet files in a local directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.parquet")
+
+    def load(self, key):
+        path = self.path(key)
+        return path if os.path.exists(path) else None
+
+    def save(self, key, df):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.path(key)}.{os.getpid()}.tmp"  # concurrent shards may write the same entry
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self.path(key))
+
+    def entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [(entry.name[:-len(".parquet")], entry.stat().st_mtime)
+                for entry in os.scandir(self.directory) if entry.name.endswith(".parquet")]
+
+    def delete(self, key):
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+class S3CacheStore:
+    """Cache entries as s3://bucket/prefix/<key>.parquet objects, read through a local temp copy"""
+
+    def __init__(self, bucket, prefix, s3_client, tmp_dir="/tmp"):
+        self.bucket = bucket
+        self.prefix = prefix if not prefix or prefix.endswith("/") else f"{prefix}/"
+        self.s3 = s3_client
+        self.tmp_dir = tmp_dir
+
+    def object_key(self, key):
+        return f"{self.prefix}{key}.parquet"
+
+    def local_path(self, key):
+        return os.path.join(self.tmp_dir, f"recode_cache_{key}.parquet")
+
+    def load(self, key):
+        local_path = self.local_path(key)
+        if os.path.exists(local_path):  # still on disk from a warm invocation
+            return local_path
+        try:
+            self.s3.download_file(self.bucket, self.object_key(key), local_path)
+        except ClientError as e:
+            if is_not_found(e):
+                return None
+            raise
+        return local_path
+
+    def save(self, key, df):
+        local_path = self.local_path(key)
+        df.to_parquet(f"{local_path}.{os.getpid()}.tmp", index=False)
+        os.replace(f"{local_path}.{os.getpid()}.tmp", local_path)
+        self.s3.upload_file(local_path, self.bucket, self.object_key(key))
+
+    def entries(self):
+        entries = []
+        for obj in list_objects(self.s3, self.bucket, self.prefix, suffixes=(".parquet",)):
+            name = obj["Key"][len(self.prefix):]
+            if "/" not in name:
+                entries.append((name[:-len(".parquet")], obj["LastModified"].timestamp()))
+        return entries
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+        local_path = self.local_path(key)
+        if os.path.exists(local_path):
+            os.remove(local_path)
@@ -0,0 +1,321 @@
+import argparse
+import io
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flow_scan import iter_year_partitions, open_flows
+from flow_schema import GSS_CODE_TYPE, SEX_TYPE
+from instrumentation import StageRecorder, stage
+from od_aggregation import DENSE_CELL_LIMIT, TOTAL_CODE, append_missing, encode_flows, parent_index
+from storage import TMP_DIR, make_storage
+
+# Where cubes are written under a storage root, and the manifest FlowCubes reads to choose between them
+FLOWS_PATH = "data/processed/domestic_od_flows/"
+CUBES_ROOT = "data/processed"
+CUBE_PREFIX = "cubes/"
+MANIFEST_NAME = "_cubes.json"
+
+# Geography levels: "lad" is the flows' own codes, "all" sums every area into TOTAL_CODE,
+# any other level is a hierarchy (step5's region, country, inner_outer).
+LAD = "lad"
+ALL = "all"
+
+# Age detail, from finest to coarsest. Bands are AGE_BAND_WIDTH years wide with an open top band.
+AGE_DETAIL = ("single", "band", "all")
+AGE_BAND_WIDTH = 5
+AGE_BAND_TOP = 90
+AGE_BAND_TYPE = pa.dictionary(pa.int8(), pa.string())
+
+# (origin level, destination level, age detail, by sex). The first cube is the full series; the
+# others are the slices dashboards ask for, so most queries read a few thousand rows instead.
+DEFAULT_CUBES = [
+    (LAD, LAD, "single", True),
+    (LAD, LAD, "band", False),
+    (LAD, LAD, "all", False),
+    (ALL, LAD, "single", True),
+    (LAD, ALL, "single", True),
+    (ALL, LAD, "band", False),
+    (LAD, ALL, "band", False),
+    ("region", "region", "single", True),
+    ("region", "region", "all", False),
+    (ALL, "region", "single", True),
+    ("region", ALL, "single", True),
+    ("country", "country", "single", True),
+    ("inner_outer", "inner_outer", "single", True),
+]
+
+# Cubes are sorted by (year, gss_in, gss_out), so row-group min/max statistics and the page index
+# skip most of a file for a year or code filter; bloom filters answer "is this code here at all".
+ROW_GROUP_SIZE = 128 * 1024
+BLOOM_FILTER_FPP = 0.01
+LAD_CODE_COUNT = 400  # LADs in any one year plus codes retired since 2001, for sizing the LAD bloom filters
+CUBE_WRITE_OPTIONS = {"compression": "zstd", "write_page_index": True, "write_statistics": True}
+
+def cube_name(spec):
+    origin, destination, ages, by_sex = spec
+    return f"{origin}_to_{destination}_{ages}_ages" + ("_by_sex" if by_sex else "")
+
+def age_bands():
+    """Band labels, in age order"""
+    return [f"{low}-{low + AGE_BAND_WIDTH - 1}" for low in range(0, AGE_BAND_TOP, AGE_BAND_WIDTH)] + [f"{AGE_BAND_TOP}+"]
+
+def age_band_index(ages):
+    """Position in age_bands() of each age"""
+    return np.minimum(np.asarray(ages, dtype=np.int64), AGE_BAND_TOP) // AGE_BAND_WIDTH
+
+def cube_schema(spec):
+    _, _, ages, by_sex = spec
+    fields = [("year", pa.int16()), ("gss_in", GSS_CODE_TYPE), ("gss_out", GSS_CODE_TYPE)]
+    if ages == "single":
+        fields.append(("age", pa.uint8()))
+    elif ages == "band":
+        fields.append(("age_band", AGE_BAND_TYPE))
+    if by_sex:
+        fields.append(("sex", SEX_TYPE))
+    return pa.schema(fields + [("value", pa.float64())])
+
+# ----------------------------- Materialization -----------------------------
+class EncodedPartition:
+    """One partition of flows factorized once and shared by every cube built from it"""
+
+    def __init__(self, df, hierarchies):
+        self.flows = encode_flows(df, col_age="age")
+        self.sex_index, self.sexes = pd.factorize(df["sex"], sort=True)
+        self.hierarchies = hierarchies
+        self.levels = {}
+
+    def level(self, name):
+        """(per-code parent position, sorted labels) for a geography level, computed once per partition"""
+        if name not in self.levels:
+            codes = self.flows.codes
+            if name == ALL:
+                self.levels[name] = (np.zeros(len(codes), dtype=np.int64), pd.Index([TOTAL_CODE]))
+            else:
+                self.levels[name] = parent_index(codes, None if name == LAD else self.hierarchies[name])
+        return self.levels[name]
+
+    def ages(self, detail):
+        """(per-row age position, labels) for an age detail"""
+        flows = self.flows
+        if detail == "single":
+            return flows.age_index, flows.ages
+        if detail == "band":
+            bands = append_missing(age_band_index(flows.ages))
+            return bands[flows.age_index], pd.Index(age_bands())
+        return np.zeros(len(flows.values), dtype=np.int64), pd.Index([None])
+
+def cube_table(partition, spec):
+    """Sum one partition into the cells of a cube, in (year, gss_in, gss_out, age, sex) order.
+
+    Rows with an unmapped end are dropped, as in od_matrix. Cells are reduced
+    with np.bincount while the cube's cell space is small enough to hold
+    densely, and with np.unique otherwise.
+    """
+    origin, destination, ages, by_sex = spec
+    flows = partition.flows
+    out_index, out_labels = partition.level(origin)
+    in_index, in_labels = partition.level(destination)
+    p_out, p_in = append_missing(out_index)[flows.out_index], append_missing(in_index)[flows.in_index]
+    age_index, age_labels = partition.ages(ages)
+    sex_index, sexes = (partition.sex_index, partition.sexes) if by_sex else (np.zeros_like(p_in), pd.Index([None]))
+    keep = (p_in >= 0) & (p_out >= 0) & (flows.year_index >= 0) & (age_index >= 0) & (sex_index >= 0)
+
+    shape = (len(flows.years), len(in_labels), len(out_labels), len(age_labels), len(sexes))
+    cell = np.ravel_multi_index((flows.year_index[keep], p_in[keep], p_out[keep], age_index[keep], sex_index[keep]), shape)
+    size = int(np.prod(shape))
+    if size <= DENSE_CELL_LIMIT:
+        sums = np.bincount(cell, weights=flows.values[keep], minlength=size)
+        present = np.flatnonzero(np.bincount(cell, minlength=size))
+        sums = sums[present]
+    else:
+        present, inverse = np.unique(cell, return_inverse=True)
+        sums = np.bincount(inverse, weights=flows.values[keep], minlength=len(present))
+    year, gss_in, gss_out, age, sex = np.unravel_index(present, shape)
+
+    schema = cube_schema(spec)
+    columns = {
+        "year": pa.array(flows.years.to_numpy()[year], type=pa.int16()),
+        "gss_in": dictionary_column(gss_in, in_labels),
+        "gss_out": dictionary_column(gss_out, out_labels),
+        "age": pa.array(age_labels.to_numpy()[age], type=pa.uint8()) if ages == "single" else None,
+        "age_band": dictionary_column(age, age_labels, AGE_BAND_TYPE) if ages == "band" else None,
+        "sex": dictionary_column(sex, sexes, SEX_TYPE) if by_sex else None,
+        "value": pa.array(sums, type=pa.float64()),
+    }
+    return pa.Table.from_arrays([columns[name] for name in schema.names], schema=schema)
+
+def dictionary_column(positions, labels, type=GSS_CODE_TYPE):
+    """Dictionary array over labels without materializing a string per row"""
+    return pa.DictionaryArray.from_arrays(pa.array(positions, type=type.index_type),
+                                          pa.array(np.asarray(labels, dtype=object), type=pa.string()))
+
+def bloom_filter_options(spec, hierarchies):
+    """Bloom filters on the GSS columns, sized for the number of distinct codes at each level"""
+    def ndv(level):
+        if level == ALL:
+            return 1
+        return LAD_CODE_COUNT if level == LAD else hierarchies[level].nunique()
+    origin, destination = spec[0], spec[1]
+    return {"gss_in": {"ndv": ndv(destination), "fpp": BLOOM_FILTER_FPP},
+            "gss_out": {"ndv": ndv(origin), "fpp": BLOOM_FILTER_FPP}}
+
+def build_cubes(dataset, storage, hierarchies, specs=DEFAULT_CUBES, prefix=CUBE_PREFIX, years=None):
+    """Materialize each cube in specs under prefix, one year of flows at a time, and write the manifest.
+
+    Every cube is streamed through its own ParquetWriter, so memory holds one
+    year of flows plus the cells of that year. Returns the manifest.
+    """
+    entries = {cube_name(spec): {"origin": spec[0], "destination": spec[1], "ages": spec[2], "sex": spec[3],
+                                 "key": f"{prefix}{cube_name(spec)}.parquet", "rows": 0}
+               for spec in specs}
+    columns = ["gss_in", "gss_out", "sex", "year", "age", "value"]
+    with tempfile.TemporaryDirectory(dir=TMP_DIR) as tmp:
+        writers = {}
+        try:
+            for year, df in iter_year_partitions(dataset, columns=columns, years=years):
+                print(f"🧊 Building cubes for {year if year is not None else 'all years'} ({len(df)} flows)...")
+                with stage("cubes") as cubes:
+                    partition = EncodedPartition(df, hierarchies)
+                    for spec in specs:
+                        name = cube_name(spec)
+                        table = cube_table(partition, spec)
+                        if name not in writers:
+                            writers[name] = pq.ParquetWriter(
+                                os.path.join(tmp, f"{name}.parquet"), table.schema,
+                                sorting_columns=[pq.SortingColumn(i) for i in range(3)],
+                                bloom_filter_options=bloom_filter_options(spec, hierarchies), **CUBE_WRITE_OPTIONS)
+                        writers[name].write_table(table, row_group_size=ROW_GROUP_SIZE)
+                        entries[name]["rows"] += table.num_rows
+                    cubes.add_rows(len(df))
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        with stage("upload") as upload:
+            for name, entry in entries.items():
+                path = os.path.join(tmp, f"{name}.parquet")
+                if name not in writers:  # no flows at all: an empty cube, so queries still resolve
+                    pq.write_table(cube_schema((entry["origin"], entry["destination"], entry["ages"], entry["sex"])).empty_table(), path)
+                storage.put_file(path, entry["key"])
+                upload.add_bytes_out(os.path.getsize(path))
+
+    manifest = {"age_band_width": AGE_BAND_WIDTH, "age_band_top": AGE_BAND_TOP, "cubes": entries}
+    storage.put_fileobj(io.BytesIO(json.dumps(manifest, indent=2).encode()), f"{prefix}{MANIFEST_NAME}")
+    print(f"✅ {len(entries)} cubes written to {storage.uri(prefix)}")
+    return manifest
+
+# ----------------------------- Query API -----------------------------
+class FlowCubes:
+    """Answers flow queries from the smallest materialized cube that holds the detail asked for.
+
+    A cube can serve a query when each end is at the query's level (or is
+    at LAD level and the query sums that end over "all"), its ages are at least as fine as
+    needed, and it keeps sex if the query splits by sex. Filters are pushed
+    into the Parquet read, then the remaining detail is summed away.
+    """
+
+    def __init__(self, storage, prefix=CUBE_PREFIX):
+        self.storage = storage
+        with storage.local_path(f"{prefix}{MANIFEST_NAME}") as path, open(path) as f:
+            self.manifest = json.load(f)
+        self.cubes = self.manifest["cubes"]
+
+    def choose(self, origin=ALL, destination=ALL, ages="all", by_sex=False):
+        """Name of the smallest cube that can answer at these levels, age detail and sex split"""
+        def ends_serve(cube_level, level):
+            # Hierarchy cubes drop flows whose end is unmapped, so only LAD ends can be summed to "all"
+            return cube_level == level or (level == ALL and cube_level == LAD)
+        def serves(entry):
+            return ends_serve(entry["origin"], origin) and ends_serve(entry["destination"], destination) \
+                and AGE_DETAIL.index(entry["ages"]) <= AGE_DETAIL.index(ages) \
+                and (entry["sex"] or not by_sex)
+        candidates = [name for name, entry in self.cubes.items() if serves(entry)]
+        if not candidates:
+            raise ValueError(f"No cube holds {origin} to {destination} flows by {ages} ages"
+                             + (" and sex" if by_sex else ""))
+        # Prefer cubes already at the query's levels, so less is summed after the read
+        return min(candidates, key=lambda name: (self.cubes[name]["rows"],
+                                                 self.cubes[name]["origin"] != origin,
+                                                 self.cubes[name]["destination"] != destination))
+
+    def query(self, origin=ALL, destination=ALL, years=None, origin_codes=None, destination_codes=None,
+              by_age=None, age_range=None, by_sex=False):
+        """Flows summed to the requested levels as a DataFrame, sorted by year, gss_in, gss_out.
+
+        years and the code lists restrict the slice; by_age is None (sum over
+        ages), "single" or "band"; age_range is an inclusive (min, max).
+        """
+        ages = self.age_detail(by_age, age_range)
+        name = self.choose(origin, destination, ages, by_sex)
+        entry = self.cubes[name]
+        print(f"🔎 Reading {name} ({entry['rows']} rows)")
+
+        filters = []
+        if years is not None:
+            filters.append(("year", "in", [int(year) for year in years]))
+        if destination_codes is not None and destination != ALL:
+            filters.append(("gss_in", "in", list(destination_codes)))
+        if origin_codes is not None and origin != ALL:
+            filters.append(("gss_out", "in", list(origin_codes)))
+        if age_range is not None and entry["ages"] == "single":
+            filters += [("age", ">=", age_range[0]), ("age", "<=", age_range[1])]
+        elif age_range is not None:
+            filters.append(("age_band", "in", [label for i, label in enumerate(age_bands())
+                                               if age_range[0] <= i * AGE_BAND_WIDTH <= age_range[1]]))
+        df = self.storage.read_table(entry["key"], filters=filters or None).to_pandas()
+
+        for column, level, cube_level in (("gss_in", destination, entry["destination"]), ("gss_out", origin, entry["origin"])):
+            if level == ALL and cube_level != ALL:
+                df[column] = TOTAL_CODE
+        if by_age == "band" and entry["ages"] == "single":
+            df["age_band"] = np.asarray(age_bands(), dtype=object)[age_band_index(df["age"])]
+        keys = ["year", "gss_in", "gss_out"] + {"single": ["age"], "band": ["age_band"]}.get(by_age, []) \
+            + (["sex"] if by_sex else [])
+        result = df.groupby(keys, observed=True, sort=False)["value"].sum().reset_index()
+        if by_age == "band":
+            result["age_band"] = pd.Categorical(result["age_band"], categories=age_bands(), ordered=True)
+        for column in ("gss_in", "gss_out", "sex"):
+            if column in result:
+                result[column] = result[column].astype(str)
+        return result.sort_values(keys).reset_index(drop=True)
+
+    def age_detail(self, by_age, age_range):
+        """Coarsest age detail that can group by by_age and filter to age_range"""
+        if by_age == "single":
+            return "single"
+        if by_age not in (None, "band"):
+            raise ValueError(f"by_age must be None, 'single' or 'band', not {by_age!r}")
+        if age_range is not None:
+            low, high = age_range
+            on_band_edges = low % AGE_BAND_WIDTH == 0 and low <= AGE_BAND_TOP \
+                and ((high + 1) % AGE_BAND_WIDTH == 0 or high >= AGE_BAND_TOP)
+            if not on_band_edges:
+                return "single"
+        if by_age == "band" or age_range is not None:
+            return "band"
+        return "all"
+
+    def flows_into(self, codes, years=None, level=LAD, by_age=None, by_sex=False, age_range=None):
+        """Inflows to each area in codes from everywhere, e.g. flows into a borough by age for a span of years"""
+        return self.query(ALL, level, years=years, destination_codes=codes, by_age=by_age, age_range=age_range, by_sex=by_sex)
+
+    def flows_out_of(self, codes, years=None, level=LAD, by_age=None, by_sex=False, age_range=None):
+        """Outflows from each area in codes to everywhere"""
+        return self.query(level, ALL, years=years, origin_codes=codes, by_age=by_age, age_range=age_range, by_sex=by_sex)
+
+def main(flows_path=FLOWS_PATH, root=CUBES_ROOT, years=None):
+    from step5_converting_geographies import load_hierarchies
+    with StageRecorder("rollup_cubes"):
+        build_cubes(open_flows(flows_path), make_storage(root), load_hierarchies(), years=years)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Materialize rollup cubes over the final OD flows")
+    parser.add_argument("--flows", default=FLOWS_PATH, help="step4 output dataset, s3:// or local")
+    parser.add_argument("--root", default=CUBES_ROOT, help="local directory or s3://bucket/prefix/ to write cubes/ under")
+    parser.add_argument("--years", nargs="*", type=int)
+    args = parser.parse_args()
+    main(args.flows, args.root, args.years)
@@ -0,0 +1,69 @@
+import json
+from botocore.exceptions import ClientError
+from storage import is_not_found, parse_s3_path
+
+# Shared record of which ONS releases each step has processed; override with event["run_manifest_uri"]
+RUN_MANIFEST_URI = "s3://dpa-population-projection-data/population_mid_year_estimates/ons_data/_run_manifest.json"
+
+# Entry fields, keyed by release file name without extension (e.g. detailedestimates2023on2023las):
+#   raw_key, raw_etag          step1: the raw workbook in S3
+#   cleaned_key, cleaned_etag  step2: its cleaned output
+#   cleaned_from               step2: raw_etag that was cleaned
+#   combined_from, years       step3: cleaned_etag appended to the combined file, and the years it holds
+#   published_from             step4: combined_from written to the year= partitions
+STAGE_INPUTS = {
+    # stage: (field holding the stage's current input, field recording the input it last processed)
+    "clean": ("raw_etag", "cleaned_from"),
+    "combine": ("cleaned_etag", "combined_from"),
+    "publish": ("combined_from", "published_from"),
+}
+
+def release_name(key):
+    """Release name shared by a raw workbook and its cleaned outputs: the file name without extension"""
+    return key.rsplit("/", 1)[-1].rsplit(".", 1)[0].replace("2021and2023", "2023")
+
+def load_run_manifest(s3_client, uri=RUN_MANIFEST_URI):
+    bucket, key = parse_s3_path(uri)
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if is_not_found(e):
+            return {"releases": {}}
+        raise
+    return json.loads(obj["Body"].read())
+
+def save_run_manifest(s3_client, manifest, uri=RUN_MANIFEST_URI):
+    bucket, key = parse_s3_path(uri)
+    print(f"📝 Writing run manifest to {uri}")
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"),
+                         ContentType="application/json")
+
+def object_etag(s3_client, bucket, key):
+    return s3_client.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+
+def pending_releases(manifest, stage):
+    """Names of releases whose input to stage changed since the stage last processed them"""
+    current, processed = STAGE_INPUTS[stage]
+    return sorted(name for name, entry in manifest["releases"].items()
+                  if entry.get(current) and entry.get(current) != entry.get(processed))
+
+def entry(manifest, key):
+    return manifest["releases"].setdefault(release_name(key), {})
+
+def record_release(manifest, raw_key, raw_etag):
+    entry(manifest, raw_key).update(raw_key=raw_key, raw_etag=raw_etag)
+
+def mark_cleaned(manifest, raw_key, raw_etag, cleaned_key, cleaned_etag):
+    entry(manifest, raw_key).update(raw_key=raw_key, raw_etag=raw_etag, cleaned_from=raw_etag,
+                                    cleaned_key=cleaned_key, cleaned_etag=cleaned_etag)
+
+def mark_combined(manifest, cleaned_key, cleaned_etag, years):
+    entry(manifest, cleaned_key).update(cleaned_key=cleaned_key, cleaned_etag=cleaned_etag,
+                                        combined_from=cleaned_etag, years=sorted(years))
+
+def mark_published(manifest, names):
+    for name in names:
+        manifest["releases"][name]["published_from"] = manifest["releases"][name]["combined_from"]
+
+def affected_years(manifest, names):
+    return sorted({year for name in names for year in manifest["releases"][name].get("years", [])})
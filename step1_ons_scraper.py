@@ -1,59 +1,137 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin
 from bs4 import BeautifulSoup
-#import boto3  # Commented out for local testing
-import os
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from instrumentation import CountingReader, StageRecorder
+from storage import S3Storage, s3_client
+from run_manifest import RUN_MANIFEST_URI, load_run_manifest, record_release, save_run_manifest
 
-s3 = boto3.client('s3')  # Commented out for local testing
-bucket_name = 'dpa-population-projection-data'  # Commented out for local testing
+s3 = s3_client()
+bucket_name = 'dpa-population-projection-data'
 
-def lambda_handler(event=None, context=None):
-    print("Starting ONS data scraping...")
+BASE_URL = "https://www.ons.gov.uk/peoplepopulationandcommunity/populationandmigration/populationestimates/datasets/internalmigrationinenglandandwales/"
+RAW_PREFIX = "population_mid_year_estimates/ons_data/1_raw/"
 
-    base_url = "https://www.ons.gov.uk/peoplepopulationandcommunity/populationandmigration/populationestimates/datasets/internalmigrationinenglandandwales/"
-    print(f"Fetching base page: {base_url}")
-    response = requests.get(base_url)
-    soup = BeautifulSoup(response.text, 'html.parser')
+# Downloads run concurrently over one pooled HTTP session
+MAX_WORKERS = 8
+REQUEST_TIMEOUT = 60
 
-    print("Parsing download links...")
-    links = [a['href'] for a in soup.find_all('a', href=True) if 'detailedinternalmigrationestimates' in a['href']]
-    print(f"Found {len(links)} relevant links.")
+# Response bodies are streamed straight into S3 multipart uploads, never to disk
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+)
 
-    download_links = []
+# S3 object metadata holding the validators of the ONS response we stored
+ETAG_METADATA = "source-etag"
+LAST_MODIFIED_METADATA = "source-last-modified"
 
-    # Create test_data directory if it doesn't exist
-    os.makedirs("test_data", exist_ok=True)
+def lambda_handler(event=None, context=None):
+    print("Starting ONS data scraping...")
 
-    for link in links:
-        full_url = f"https://www.ons.gov.uk{link}"
-        filename = full_url.split("/")[-1]
-        local_path = f"test_data/{filename}"
+    with StageRecorder("step1_ons_scraper") as perf:
+        session = make_session(MAX_WORKERS)
 
-        print(f"Downloading file: {full_url}")
-        r = requests.get(full_url)
-        with open(local_path, "wb") as f:
-            f.write(r.content)
-        print(f"Saved to local path: {local_path}")
+        with perf.stage("list_releases") as stage:
+            urls = release_urls(session)
+            stage.add_rows(len(urls))
 
-        s3_key = f"population_mid_year_estimates/ons_data/1_raw/{filename}"
-        print(f"Uploading to S3: s3://{bucket_name}/{s3_key}")
-        s3.upload_file(local_path, bucket_name, s3_key)
-        s3_uri = f"s3://{bucket_name}/{s3_key}"
-        download_links.append(s3_uri)
+        with perf.stage("download_upload") as stage:
+            storage = S3Storage(bucket_name, client=s3, transfer_config=TRANSFER_CONFIG)
+            results = fetch_releases(session, urls, storage)
+            stage.add_rows(sum(r["status"] == "downloaded" for r in results))
+            stage.add_bytes_out(sum(r.get("bytes", 0) for r in results))
 
-        # Instead, use local file path
-        download_links.append(local_path)
+        # Record every release's S3 ETag, so later steps can tell which ones are new
+        with perf.stage("run_manifest"):
+            manifest_uri = (event or {}).get("run_manifest_uri", RUN_MANIFEST_URI)
+            manifest = load_run_manifest(s3, manifest_uri)
+            for r in results:
+                record_release(manifest, r["s3_key"], r["etag"])
+            save_run_manifest(s3, manifest, manifest_uri)
 
-    print("All downloads saved successfully.")
+    new_releases = [r["s3_uri"] for r in results if r["status"] == "downloaded"]
+    unchanged = [r["s3_uri"] for r in results if r["status"] == "unchanged"]
+    print(f"All downloads complete: {len(new_releases)} new or updated, {len(unchanged)} unchanged.")
 
     return {
         "statusCode": 200,
-        "download_links": download_links
+        "download_links": [r["s3_uri"] for r in results],
+        "new_releases": new_releases,
+        "unchanged": unchanged,
     }
 
+def release_urls(session):
+    """Download links of every detailed estimates release on the ONS dataset page"""
+    print(f"Fetching base page: {BASE_URL}")
+    response = session.get(BASE_URL, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    soup = BeautifulSoup(response.text, 'html.parser')
+
+    print("Parsing download links...")
+    links = [a['href'] for a in soup.find_all('a', href=True) if 'detailedinternalmigrationestimates' in a['href']]
+    urls = list(dict.fromkeys(urljoin(BASE_URL, link) for link in links))
+    print(f"Found {len(urls)} relevant links.")
+    return urls
+
+def make_session(pool_size):
+    """requests session whose connection pool is large enough for every worker"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def fetch_releases(session, urls, storage, prefix=RAW_PREFIX):
+    """fetch_release for every url over a thread pool sharing the session's connection pool"""
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        return list(pool.map(lambda url: fetch_release(session, url, storage, prefix), urls))
+
+def fetch_release(session, url, storage, prefix=RAW_PREFIX):
+    """Conditionally download one release straight into storage (S3 or a local directory).
+
+    The ETag/Last-Modified of the copy already stored are sent as
+    If-None-Match/If-Modified-Since, so a release we already have costs a
+    304 instead of a full download.
+    """
+    filename = url.split("/")[-1]
+    s3_key = f"{prefix}{filename}"
+    s3_uri = storage.uri(s3_key)
+
+    stored = storage.head(s3_key) or {}
+    headers = conditional_headers(stored.get("metadata", {}))
+    with session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as r:
+        if r.status_code == 304:
+            print(f"Unchanged, skipping: {url}")
+            return {"status": "unchanged", "s3_uri": s3_uri, "s3_key": s3_key, "etag": stored["etag"]}
+        r.raise_for_status()
+
+        metadata = {}
+        if r.headers.get("ETag"):
+            metadata[ETAG_METADATA] = r.headers["ETag"]
+        if r.headers.get("Last-Modified"):
+            metadata[LAST_MODIFIED_METADATA] = r.headers["Last-Modified"]
+
+        print(f"Streaming {url} to {s3_uri}")
+        r.raw.decode_content = True
+        body = CountingReader(r.raw)
+        storage.put_fileobj(body, s3_key, metadata=metadata)
+
+    return {"status": "downloaded", "s3_uri": s3_uri, "s3_key": s3_key, "bytes": body.bytes_read,
+            "etag": storage.head(s3_key)["etag"]}
+
+def conditional_headers(metadata):
+    headers = {}
+    if metadata.get(ETAG_METADATA):
+        headers["If-None-Match"] = metadata[ETAG_METADATA]
+    if metadata.get(LAST_MODIFIED_METADATA):
+        headers["If-Modified-Since"] = metadata[LAST_MODIFIED_METADATA]
+    return headers
+
 # Run locally
 if __name__ == "__main__":
     result = lambda_handler()
     print(result)
-
-
-
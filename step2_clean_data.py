@@ -1,76 +1,208 @@
-import pandas as pd
-import boto3
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
 import os
+import re
+import json
+from instrumentation import StageRecorder
+from run_manifest import (RUN_MANIFEST_URI, load_run_manifest, mark_cleaned, object_etag, pending_releases,
+                          release_name, save_run_manifest)
+from ons_workbook_reader import LONG_SCHEMA, read_detailed_estimates, to_long_format
+from storage import list_objects, parse_s3_path, s3_client
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-s3 = boto3.client('s3')
+s3 = s3_client()
+
+# Written next to the cleaned files; records the ETag and size of every source workbook cleaned
+MANIFEST_NAME = "_manifest.json"
+
+# "csv" keeps the wide sheet layout; "parquet" writes long OD rows (gss_out, gss_in, sex, year, age, value)
+OUTPUT_FORMATS = ("csv", "parquet")
 
 def handler(event, context):
     print("Starting clean_data Lambda function...")
 
     input_path = event.get("input_path")
     output_path = event.get("output_path")
+    output_format = event.get("output_format", "csv")
     if not input_path or not output_path:
         print("Missing 'input_path' or 'output_path' in event.")
         return {"status": "error", "message": "input_path and output_path are required"}
+    if output_format not in OUTPUT_FORMATS:
+        return {"status": "error", "message": f"output_format must be one of {OUTPUT_FORMATS}"}
 
-    # Parse bucket and prefix from input_path
-    if not input_path.startswith("s3://"):
-        raise ValueError("input_path must start with s3://")
-    path_parts = input_path[5:].split("/", 1)
-    bucket = path_parts[0]
-    prefix = path_parts[1] if len(path_parts) > 1 else ""
-
-    # Parse output bucket and prefix similarly
-    if not output_path.startswith("s3://"):
-        raise ValueError("output_path must start with s3://")
-    out_parts = output_path[5:].split("/", 1)
-    out_bucket = out_parts[0]
-    out_prefix = out_parts[1] if len(out_parts) > 1 else ""
+    bucket, prefix = parse_s3_path(input_path)
+    out_bucket, out_prefix = parse_s3_path(output_path)
 
     print(f"Input Bucket: {bucket}, Prefix: {prefix}")
     print(f"Output Bucket: {out_bucket}, Prefix: {out_prefix}")
 
-    # List all files under prefix
-    print(f"Listing objects in bucket '{bucket}' with prefix '{prefix}'...")
-    paginator = s3.get_paginator('list_objects_v2')
-    pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
-
-    files = []
-    for page in pages:
-        for obj in page.get('Contents', []):
-            key = obj['Key']
-            if key.endswith(".xlsx") or key.endswith(".xls"):
-                files.append(key)
-
-    if not files:
-        print("No Excel files found to process.")
-        return {"status": "no files"}
-
-    print(f"Found {len(files)} files to process.")
-
-    for key in files:
-        filename = key.split("/")[-1]
-        tmp_path = f"/tmp/{filename}"
-
-        print(f"\nDownloading {key} from bucket {bucket}...")
-        s3.download_file(bucket, key, tmp_path)
-
-        print(f"Reading Excel file {tmp_path}...")
-        df = pd.read_excel(tmp_path, sheet_name=4)
-
-        print("Cleaning data (dropping NA rows)...")
-        df_clean = df.dropna()
-
-        # Rename file if it includes "2021and2023"
-        clean_filename = filename.replace('2021and2023', '2023').replace('.xlsx', '.csv').replace('.xls', '.csv')
-        clean_key = f"{out_prefix}{clean_filename}"
-        clean_tmp_path = f"/tmp/clean_{clean_filename}"
-        df_clean.to_csv(clean_tmp_path, index=False)
-
-        print(f"Uploading cleaned file to {out_bucket}/{clean_key} ...")
-        s3.upload_file(clean_tmp_path, out_bucket, clean_key)
-
-        print(f"✅ Finished processing {filename}")
+    with StageRecorder("step2_clean_data") as perf:
+        # List all files under prefix
+        with perf.stage("list") as stage:
+            print(f"Listing objects in bucket '{bucket}' with prefix '{prefix}'...")
+            files = [{"key": obj['Key'], "etag": obj['ETag'], "size": obj['Size']}
+                     for obj in list_objects(s3, bucket, prefix, suffixes=(".xlsx", ".xls"))]
+            stage.add_rows(len(files))
+
+        if not files:
+            print("No Excel files found to process.")
+            return {"status": "no files"}
+
+        print(f"Found {len(files)} files.")
+
+        # Skip workbooks whose ETag and size match the last successful clean. In incremental
+        # mode, clean only the releases the run manifest marks as new since they were last cleaned.
+        manifest_key = f"{out_prefix}{MANIFEST_NAME}"
+        manifest = {} if event.get("force") else load_manifest(out_bucket, manifest_key)
+        run_manifest_uri = event.get("run_manifest_uri", RUN_MANIFEST_URI)
+        run_manifest = load_run_manifest(s3, run_manifest_uri)
+        if event.get("incremental"):
+            new_releases = set(pending_releases(run_manifest, "clean"))
+            pending = [f for f in files if release_name(f['key']) in new_releases]
+        else:
+            pending = [f for f in files if not is_unchanged(f, manifest, output_format)]
+        skipped = len(files) - len(pending)
+        if skipped:
+            print(f"Skipping {skipped} unchanged files.")
+
+        if not pending:
+            print("All files already cleaned.")
+            return {"status": "done", "files_processed": 0, "files_skipped": skipped}
+
+        max_workers = min(len(pending), int(event.get("max_workers") or os.cpu_count() or 1))
+        print(f"Cleaning {len(pending)} files with {max_workers} workers...")
+
+        failed = []
+        with perf.stage("clean") as stage:
+            for source, result in run_pool(pending, out_bucket, out_prefix, bucket, output_format, max_workers):
+                if isinstance(result, Exception):
+                    print(f"❌ Failed to process {source['key']}: {result}")
+                    failed.append(source['key'])
+                    continue
+                stage.add_rows(result["rows"])
+                stage.add_bytes_in(source['size'])
+                stage.add_bytes_out(result["bytes_out"])
+                manifest[source['key']] = {
+                    "etag": source['etag'],
+                    "size": source['size'],
+                    "output_key": result["key"],
+                    "output_format": output_format,
+                }
+                mark_cleaned(run_manifest, source['key'], source['etag'].strip('"'), result["key"], result["etag"])
+
+        with perf.stage("save_manifest"):
+            save_manifest(out_bucket, manifest_key, manifest)
+            save_run_manifest(s3, run_manifest, run_manifest_uri)
+
+    processed = len(pending) - len(failed)
+    if failed:
+        print(f"{len(failed)} files failed.")
+        return {"status": "error", "files_processed": processed, "files_skipped": skipped, "failed": failed}
 
     print("All files processed.")
-    return {"status": "done", "files_processed": len(files)}
+    return {"status": "done", "files_processed": processed, "files_skipped": skipped}
+
+def run_pool(pending, out_bucket, out_prefix, bucket, output_format, max_workers):
+    """Clean files concurrently, yielding (source, clean_file result or exception) as each finishes.
+
+    Excel parsing is CPU bound, so a process pool is used. Lambda has no
+    /dev/shm for multiprocessing semaphores, in which case this falls back
+    to threads.
+    """
+    try:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    except OSError as e:
+        print(f"Process pool unavailable ({e}), falling back to threads.")
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    with executor:
+        futures = {
+            executor.submit(clean_file, bucket, source['key'], out_bucket, out_prefix, output_format): source
+            for source in pending
+        }
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
+def clean_file(bucket, key, out_bucket, out_prefix, output_format="csv"):
+    """Download one workbook, clean its detailed estimates sheet and upload it.
+
+    Returns the output key and ETag, with the rows and bytes written for the stage report.
+    """
+    client = s3_client()  # one per worker process
+    filename = key.split("/")[-1]
+    tmp_path = f"/tmp/{filename}"
+
+    print(f"\nDownloading {key} from bucket {bucket}...")
+    client.download_file(bucket, key, tmp_path)
+
+    # Rename file if it includes "2021and2023"
+    clean_filename = filename.replace('2021and2023', '2023').replace('.xlsx', f'.{output_format}').replace('.xls', f'.{output_format}')
+    clean_key = f"{out_prefix}{clean_filename}"
+    clean_tmp_path = f"/tmp/clean_{clean_filename}"
+
+    # Stream sheet 4 row by row; incomplete (NA) rows are dropped as they are read
+    print(f"Reading and cleaning Excel file {tmp_path}...")
+    batches = read_detailed_estimates(tmp_path)
+    if output_format == "parquet":
+        rows = write_long_parquet(batches, clean_tmp_path, release_year(filename))
+    else:
+        rows = write_csv(batches, clean_tmp_path)
+    print(f"Wrote {rows} rows.")
+
+    print(f"Uploading cleaned file to {out_bucket}/{clean_key} ...")
+    bytes_out = os.path.getsize(clean_tmp_path)
+    client.upload_file(clean_tmp_path, out_bucket, clean_key)
+
+    os.remove(tmp_path)
+    os.remove(clean_tmp_path)
+
+    print(f"✅ Finished processing {filename}")
+    return {"key": clean_key, "etag": object_etag(client, out_bucket, clean_key), "rows": rows, "bytes_out": bytes_out}
+
+def write_csv(batches, path):
+    """Write the cleaned wide sheet as CSV. Returns the number of rows written."""
+    rows = 0
+    with pv.CSVWriter(path, batches.schema, write_options=pv.WriteOptions(quoting_style="needed")) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+def write_long_parquet(batches, path, year=None):
+    """Melt the cleaned sheet to long OD rows and write them as Parquet. Returns the number of rows written."""
+    rows = 0
+    with pq.ParquetWriter(path, LONG_SCHEMA) as writer:
+        for batch in batches:
+            long_batch = to_long_format(batch, year=year)
+            writer.write_batch(long_batch)
+            rows += long_batch.num_rows
+    return rows
+
+def release_year(filename):
+    """Estimates year from an ONS file name, e.g. detailedestimates2022on2023las.xlsx -> 2022"""
+    match = re.search(r"(20\d{2})", filename)
+    return int(match.group(1)) if match else None
+
+def is_unchanged(source, manifest, output_format="csv"):
+    """True if the manifest holds the same ETag and size for this source key, cleaned to the same format"""
+    entry = manifest.get(source['key'])
+    return (bool(entry)
+            and entry.get("etag") == source['etag']
+            and entry.get("size") == source['size']
+            and entry.get("output_format", "csv") == output_format)
+
+def load_manifest(bucket, key):
+    """Read the cleaning manifest, or an empty one if it does not exist yet"""
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return {}
+    return json.loads(obj['Body'].read())
+
+def save_manifest(bucket, key, manifest):
+    print(f"Writing manifest to {bucket}/{key}")
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest, indent=2).encode("utf-8"),
+                  ContentType="application/json")
@@ -1,18 +1,39 @@
-import boto3
-import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
 import os
+from botocore.exceptions import ClientError
+from flow_schema import conform_schema
+from instrumentation import StageRecorder
+from storage import is_not_found, list_objects, parse_s3_path, s3_client
+from run_manifest import (RUN_MANIFEST_URI, load_run_manifest, mark_combined, pending_releases, release_name,
+                          save_run_manifest)
 
-s3 = boto3.client('s3')
+s3 = s3_client()
+
+# Rows per Parquet row group in the combined output (override with event["row_group_size"])
+ROW_GROUP_SIZE = 250_000
+
+# Identifier columns keep their inferred type; every other numeric column is a flow count
+KEY_COLUMNS = ("outla", "inla", "sex", "year", "age")
+
+# Step2 writes wide .csv files, or long-format .parquet files with output_format="parquet"
+INPUT_FORMATS = ("csv", "parquet")
 
 def handler(event, context):
     print("Starting combine_cleaned_data Lambda function...")
 
     input_path = event.get("input_path")  # e.g., s3://bucket/population_mid_year_estimates/ons_data/2_cleaned_data/
     output_path = event.get("output_path")  # e.g., s3://bucket/population_mid_year_estimates/ons_data/cleaned_data_combined/3_cleaned_data_combined.parquet
+    row_group_size = int(event.get("row_group_size", ROW_GROUP_SIZE))
+    input_format = event.get("input_format", "csv")
 
     if not input_path or not output_path:
         print("Missing 'input_path' or 'output_path' in event.")
         return {"status": "error", "message": "input_path and output_path are required"}
+    if input_format not in INPUT_FORMATS:
+        return {"status": "error", "message": f"input_format must be one of {INPUT_FORMATS}"}
 
     # Parse S3 paths
     in_bucket, in_prefix = parse_s3_path(input_path)
@@ -21,50 +42,206 @@ def handler(event, context):
     print(f"Input Bucket: {in_bucket}, Prefix: {in_prefix}")
     print(f"Output Bucket: {out_bucket}, Key: {out_key}")
 
-    # List files
-    all_files = []
-    paginator = s3.get_paginator('list_objects_v2')
-    for page in paginator.paginate(Bucket=in_bucket, Prefix=in_prefix):
-        for obj in page.get('Contents', []):
-            key = obj['Key']
-            if key.endswith(".csv"):
-                all_files.append(key)
+    with StageRecorder("step3_combine_clean_data") as perf:
+        # List files
+        with perf.stage("list") as stage:
+            all_files = [{"key": obj['Key'], "etag": obj['ETag'].strip('"')}
+                         for obj in list_objects(s3, in_bucket, in_prefix, suffixes=(f".{input_format}",))]
+            stage.add_rows(len(all_files))
 
-    if not all_files:
-        print("No .csv files found.")
-        return {"status": "no files"}
+        if not all_files:
+            print(f"No .{input_format} files found.")
+            return {"status": "no files"}
 
-    print(f"Found {len(all_files)} files to combine.")
+        print(f"Found {len(all_files)} files to combine.")
 
-    combined_df = pd.DataFrame()
+        # In incremental mode only the releases cleaned since the last combine are read; their
+        # years replace the matching rows of the previous combined file, which is copied through.
+        run_manifest_uri = event.get("run_manifest_uri", RUN_MANIFEST_URI)
+        run_manifest = load_run_manifest(s3, run_manifest_uri)
+        files, previous_path = all_files, None
+        if event.get("incremental"):
+            new_releases = set(pending_releases(run_manifest, "combine"))
+            files = [f for f in all_files if release_name(f['key']) in new_releases]
+            if not files:
+                print("No newly cleaned releases to combine.")
+                return {"status": "up to date", "files_combined": 0}
+            previous_path = download_previous(out_bucket, out_key)
+            if previous_path is None:
+                print("No previous combined file, combining every release.")
+                files = all_files
+        print(f"Combining {len(files)} files ({'incremental' if previous_path else 'full'}).")
 
-    for key in all_files:
-        print(f"Processing file: {key}")
-        local_path = f"/tmp/{os.path.basename(key)}"
-        s3.download_file(in_bucket, key, local_path)
-        df = pd.read_csv(local_path)
-        df.columns = df.columns.str.lower()  # column headers to lowercase
-        combined_df = pd.concat([combined_df, df], ignore_index=True)
+        # Stream every file into one open ParquetWriter so only a single file's
+        # batches are held in memory at any point, however many releases there are.
+        output_local_path = "/tmp/new_series_lad.parquet"
+        with perf.stage("combine") as stage:
+            rows_written, years_by_key = combine_files(
+                files, in_bucket, input_format, output_local_path, row_group_size, stage, previous_path
+            )
 
-    # Save combined file
-    output_local_path = "/tmp/new_series_lad.csv"
-    combined_df.to_parquet(output_local_path, index=False)
+        if rows_written is None:
+            print(f"No rows found in the .{input_format} files.")
+            return {"status": "no rows"}
 
-    print(f"Uploading combined file to S3: {out_bucket}/{out_key}")
-    s3.upload_file(output_local_path, out_bucket, out_key)
+        print(f"Combined {rows_written} rows.")
+
+        with perf.stage("upload") as stage:
+            print(f"Uploading combined file to S3: {out_bucket}/{out_key}")
+            stage.add_bytes_out(os.path.getsize(output_local_path))
+            s3.upload_file(output_local_path, out_bucket, out_key)
+            os.remove(output_local_path)
+
+        for source in files:
+            mark_combined(run_manifest, source['key'], source['etag'], years_by_key[source['key']])
+        save_run_manifest(s3, run_manifest, run_manifest_uri)
 
     print("✅ Combined file successfully uploaded.")
     return {
         "status": "done",
-        "files_combined": len(all_files),
+        "files_combined": len(files),
+        "mode": "incremental" if previous_path else "full",
+        "rows_combined": rows_written,
         "output_file": f"s3://{out_bucket}/{out_key}"
     }
 
-def parse_s3_path(s3_path):
-    """Parse an S3 path into bucket and key/prefix"""
-    if not s3_path.startswith("s3://"):
-        raise ValueError("S3 path must start with s3://")
-    parts = s3_path[5:].split("/", 1)
-    bucket = parts[0]
-    key = parts[1] if len(parts) > 1 else ""
-    return bucket, key
+def combine_files(files, in_bucket, input_format, output_local_path, row_group_size, stage, previous_path=None):
+    """Stream files into one Parquet file, followed by previous_path's rows for every other year.
+
+    Returns the rows written (None if there were none) and the years found in each file.
+    """
+    writer = None
+    schema = None
+    rows_written = 0
+    years_by_key = {}
+    # Batches are buffered until a full row group is available: CSV blocks and Parquet batches
+    # are far smaller than row_group_size, and each write_batch call would close a row group.
+    pending = []
+    pending_rows = 0
+
+    def write(batch):
+        nonlocal writer, schema, rows_written, pending_rows
+        if writer is None:
+            schema = conform_schema(pq.read_schema(previous_path) if previous_path else combined_schema(batch.schema))
+            writer = pq.ParquetWriter(output_local_path, schema)
+        batch = align_batch(batch, schema)
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        rows_written += batch.num_rows
+        if pending_rows >= row_group_size:
+            flush(final=False)
+
+    def flush(final=True):
+        nonlocal pending_rows
+        table = pa.Table.from_batches(pending, schema=schema)
+        full_rows = table.num_rows if final else table.num_rows - table.num_rows % row_group_size
+        if full_rows:
+            writer.write_table(table.slice(0, full_rows), row_group_size=row_group_size)
+        pending[:] = table.slice(full_rows).to_batches()
+        pending_rows = table.num_rows - full_rows
+
+    try:
+        for source in files:
+            key = source['key']
+            print(f"Processing file: {key}")
+            local_path = f"/tmp/{os.path.basename(key)}"
+            s3.download_file(in_bucket, key, local_path)
+            stage.add_bytes_in(os.path.getsize(local_path))
+
+            years_by_key[key] = set()
+            read_batches = iter_parquet_batches if input_format == "parquet" else iter_csv_batches
+            for batch in read_batches(local_path):
+                years_by_key[key].update(batch_years(batch))
+                write(batch)
+
+            os.remove(local_path)
+
+        if previous_path:
+            # A changed file whose years can't be read would leave its release's old rows in place
+            # next to the revised ones, so incremental mode refuses it rather than duplicating them.
+            unknown = sorted(key for key, years in years_by_key.items() if not years)
+            if unknown:
+                raise ValueError(f"No years found in changed files {unknown}; run a full combine (incremental=False)")
+            replaced = sorted(set().union(*years_by_key.values()))
+            print(f"Copying the previous combined rows outside years {replaced}")
+            for batch in iter_parquet_batches(previous_path):
+                if "year" in batch.schema.names:
+                    year = batch.column("year")
+                    batch = batch.filter(pc.invert(pc.is_in(year, value_set=pa.array(replaced, type=year.type))))
+                write(batch)
+            os.remove(previous_path)
+        if writer is not None:
+            flush()
+    finally:
+        if writer is not None:
+            writer.close()
+
+    stage.add_rows(rows_written)
+    return (rows_written if writer is not None else None), years_by_key
+
+def download_previous(bucket, key):
+    """Download the current combined file for an incremental run, or None if there is none yet"""
+    local_path = "/tmp/previous_new_series_lad.parquet"
+    try:
+        s3.download_file(bucket, key, local_path)
+    except ClientError as e:
+        if is_not_found(e):
+            return None
+        raise
+    return local_path
+
+def batch_years(batch):
+    if "year" not in batch.schema.names:
+        return set()
+    return {int(year) for year in pc.unique(batch.column("year")).to_pylist() if year is not None}
+
+def iter_csv_batches(local_path):
+    """Yield record batches from a CSV file with lowercase column names"""
+    # Types are inferred from the first block only, so count columns are read
+    # as float64 up front rather than failing on a decimal further down the file.
+    with pv.open_csv(local_path) as probe:
+        inferred = probe.schema
+    column_types = {field.name: pa.float64() for field in inferred if is_count_column(field)}
+
+    reader = pv.open_csv(local_path, convert_options=pv.ConvertOptions(column_types=column_types))
+    names = [name.lower() for name in reader.schema.names]  # column headers to lowercase
+    for batch in reader:
+        yield pa.RecordBatch.from_arrays(batch.columns, names=names)
+
+def iter_parquet_batches(local_path):
+    """Yield record batches from a Parquet file with lowercase column names"""
+    parquet_file = pq.ParquetFile(local_path)
+    names = [name.lower() for name in parquet_file.schema_arrow.names]
+    for batch in parquet_file.iter_batches():
+        yield pa.RecordBatch.from_arrays(batch.columns, names=names)
+
+def is_count_column(field):
+    """True for integer flow-count columns, i.e. anything that is not an identifier"""
+    return field.name.lower() not in KEY_COLUMNS and pa.types.is_integer(field.type)
+
+def combined_schema(schema):
+    """Output schema for the combined file, taken from the first file read.
+
+    Integer count columns are widened to float64 so releases that carry
+    fractional estimates can be appended without a lossy cast. Long OD
+    columns are then given their compact flow_schema types by the caller.
+    """
+    return pa.schema([
+        field.with_type(pa.float64()) if is_count_column(field) else field
+        for field in schema
+    ])
+
+def align_batch(batch, schema):
+    """Reorder and cast a batch to the combined schema, filling missing columns with nulls"""
+    extra = set(batch.schema.names) - set(schema.names)
+    if extra:
+        print(f"⚠️ Dropping columns not in the combined schema: {sorted(extra)}")
+
+    arrays = []
+    for field in schema:
+        index = batch.schema.get_field_index(field.name)
+        if index == -1:
+            arrays.append(pa.nulls(batch.num_rows, type=field.type))
+        else:
+            arrays.append(batch.column(index).cast(field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
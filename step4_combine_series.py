@@ -1,18 +1,28 @@
-import boto3
-import pandas as pd
 import os
 import zipfile
 import tempfile
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
 import shutil
-from gsscoder_python import recode_gss
-from smart_open import open as smart_open  # Avoid conflict with built-in open
+import struct
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from flow_schema import VALUE_PRECISION, conform, conform_frame, sort_key, to_flow_table
+from instrumentation import StageRecorder, stage
+from od_recoder import recode_od
+from run_manifest import (RUN_MANIFEST_URI, affected_years, load_run_manifest, mark_published, pending_releases,
+                          save_run_manifest)
+from recode_cache import load_or_build, make_cache_store, recoded_series_key, source_etag
+from storage import list_objects, s3_client
 import io
 
 # ----------------------------- Configuration -----------------------------
-s3 = boto3.client('s3')
-s3_resource = boto3.resource('s3')
+# S3 calls go through storage.s3_client() inside each function, never a module-level client:
+# year shards fork worker processes, and a client must not cross a fork.
 
 # Constants
 S3_PARQUET_ZIP_S3_URI = "s3://dpa-population-projection-data/population_mid_year_estimates/modelled-population-backseries/origin_destination_2002_to_2020.parquet.zip"
@@ -20,102 +30,307 @@ S3_NEW_SERIES_PATH = "population_mid_year_estimates/ons_data/cleaned_data_combin
 OUTPUT_PARQUET_PREFIX = "population_mid_year_estimates/ons_data/4_clean_old_and_new_combined_series.parquet"
 TMP_DIR = "/tmp"
 
+START_YR_OLD_SERIES = 2002  # first year of the modelled backseries
 START_YR_NEW_SERIES = 2012
 GSS_OLD_YEAR = 2021
 GSS_NEW_YEAR = 2023
 BUCKET_NAME = "dpa-population-projection-data"
 
+# Only these columns of the old series are read; the year filter is pushed down to row groups
+OLD_SERIES_COLUMNS = ["gss_in", "gss_out", "year", "age", "sex", "value"]
+ZIP_COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Recoded old series, keyed by the backseries ETag, recode years and gsscoder lookup version.
+# An s3:// prefix or a local directory; override with event["recode_cache_uri"].
+RECODE_CACHE_URI = "s3://dpa-population-projection-data/population_mid_year_estimates/ons_data/cache/recoded_old_series/"
+
+# Output write. "direct" writes the partitioned dataset straight to S3 through pyarrow's
+# S3 filesystem; "staged" writes it once to a temp directory and uploads the files concurrently.
+WRITE_MODE = "direct"
+SORT_COLUMNS = ["year", "gss_in", "gss_out"]  # sorted within each year so Athena can prune row groups
+MAX_ROWS_PER_GROUP = 500_000
+MIN_ROWS_PER_GROUP = 100_000
+WRITE_STATISTICS = True  # or a list of column names
+PARQUET_COMPRESSION = "snappy"
+UPLOAD_WORKERS = 8
+UPLOAD_CONFIG = TransferConfig(multipart_threshold=16 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024, max_concurrency=4)
+
 def handler(event, context):
     print("🚀 Starting combine_series Lambda...")
+    s3 = s3_client()
 
-    # 1. Stream and unzip old series parquet from S3
-    print("📥 Streaming ZIP from S3 using smart_open...")
-    with smart_open(S3_PARQUET_ZIP_S3_URI, 'rb') as s3_stream:
-        zip_bytes = io.BytesIO(s3_stream.read())
+    with StageRecorder("step4_combine_series") as perf:
+        # Incremental runs rewrite only the year= partitions of releases combined since the last
+        # publish. Those years all come from the new series, so the old series is not needed.
+        run_manifest_uri = event.get("run_manifest_uri", RUN_MANIFEST_URI)
+        run_manifest = load_run_manifest(s3, run_manifest_uri)
+        releases = pending_releases(run_manifest, "publish")
+        only_years = None
+        if event.get("incremental"):
+            if not releases:
+                print("✅ No newly combined releases, nothing to publish.")
+                return {"status": "up to date", "years_written": 0}
+            only_years = affected_years(run_manifest, releases)
+            if not only_years or min(only_years) < START_YR_NEW_SERIES:
+                print("⚠️ Releases touch old-series years, rebuilding every partition.")
+                only_years = None
+            else:
+                print(f"🔁 Incremental run for years {only_years} ({len(releases)} releases)")
 
-    with zipfile.ZipFile(zip_bytes) as z:
-        # Assume first file inside is the Parquet file
-        parquet_name = z.namelist()[0]
-        print(f"📦 Unzipping and reading {parquet_name}")
-        with z.open(parquet_name) as f:
-            df_old = pd.read_parquet(f)
+        # 1-2. Load the recoded old series from the cache, or read and recode it on a miss
+        frames = []
+        if only_years is None:
+            frames.append(load_recoded_old_series(event.get("recode_cache_uri", RECODE_CACHE_URI)))
 
-    df_old = df_old[df_old['year'] < START_YR_NEW_SERIES]
-    print(f"✅ Loaded old series shape: {df_old.shape}")
+        # 3. Load new series from S3 (only the affected years in an incremental run)
+        with perf.stage("download_new_series") as stage:
+            new_series_path = os.path.join(TMP_DIR, "new_series.parquet")
+            print(f"📥 Downloading new series from S3: {S3_NEW_SERIES_PATH}")
+            s3.download_file(BUCKET_NAME, S3_NEW_SERIES_PATH, new_series_path)
+            stage.add_bytes_in(os.path.getsize(new_series_path))
+            new_series = conform(pq.read_table(new_series_path, filters=[("year", "in", only_years)] if only_years else None))
+            stage.add_rows(new_series.num_rows)
+        print(f"✅ Loaded new series: {new_series.num_rows} rows")
+        frames.append(new_series)
+        del new_series
 
-    # 2. Recode gss_in
-    df_in_gss = df_old[df_old['gss_in'].str.contains("E0|W0")]
-    df_not_in_gss = df_old[~df_old['gss_in'].str.contains("E0|W0")]
-    
-    #df_in_gss = recode_gss(df_in_gss, "gss_in", "value", GSS_OLD_YEAR, GSS_NEW_YEAR)
-    #view full function recode_gss
-    print(f"🔄 Recoding gss_in from year {GSS_OLD_YEAR} to {GSS_NEW_YEAR}...")
-    df_in_gss = recode_gss(
-        df_in=df_in_gss,
-        col_code='gss_in',
-        col_data='value',
-        fun='sum',
-        recode_from_year=GSS_OLD_YEAR,
-        recode_to_year=GSS_NEW_YEAR,
+        # 4-5. Combine, filter and sort, then write the dataset partitioned by year in one
+        # pass; only the partitions present in the table are replaced
+        table = combine_frames(frames)
+        del frames
+        years = write_partitioned(
+            table,
+            mode=event.get("write_mode", WRITE_MODE),
+            max_rows_per_group=int(event.get("max_rows_per_group", MAX_ROWS_PER_GROUP)),
+            write_statistics=event.get("write_statistics", WRITE_STATISTICS),
         )
 
-    df_old_recoded_in = pd.concat([df_in_gss, df_not_in_gss], ignore_index=True)
-
-    # 3. Recode gss_out
-    df_out_gss = df_old_recoded_in[df_old_recoded_in['gss_out'].str.contains("E0|W0")]
-    df_not_out_gss = df_old_recoded_in[~df_old_recoded_in['gss_out'].str.contains("E0|W0")]
-    
-    #df_out_gss = recode_gss(df_out_gss, "gss_out", "value", GSS_OLD_YEAR, GSS_NEW_YEAR)
-    #view full function recode_gss
-    print(f"🔄 Recoding gss_out from year {GSS_OLD_YEAR} to {GSS_NEW_YEAR}...")
-    df_out_gss = recode_gss(
-        df_in=df_out_gss,
-        col_code='gss_out',
-        col_data='value',
-        fun='sum',
-        recode_from_year=GSS_OLD_YEAR,
-        recode_to_year=GSS_NEW_YEAR,
-    )
-    
-    
-    
-    df_old_recoded = pd.concat([df_out_gss, df_not_out_gss], ignore_index=True)
+        mark_published(run_manifest, releases)
+        save_run_manifest(s3, run_manifest, run_manifest_uri)
 
+    print("✅ All done.")
+    return {"status": "done", "mode": "incremental" if only_years else "full", "years_written": len(years)}
+
+
+def load_recoded_old_series(cache_uri=RECODE_CACHE_URI, backseries_uri=None, years=None):
+    """The recoded old series (only `years`, if given) from the cache, read and recoded from the backseries on a miss"""
+    backseries_uri = backseries_uri or S3_PARQUET_ZIP_S3_URI
+    with stage("old_series") as old_series:
+        cache, cache_key = recoded_series_cache(cache_uri, backseries_uri)
+        df_old_recoded = conform_frame(load_or_build(
+            cache, cache_key, lambda: build_recoded_old_series(backseries_uri, years=years), years=years))
+        old_series.add_rows(len(df_old_recoded))
     print(f"✅ Recoded old series shape: {df_old_recoded.shape}")
+    return df_old_recoded
+
+def recoded_series_cache(cache_uri, backseries_uri):
+    """(cache store, key) of the whole recoded old series of backseries_uri"""
+    s3 = s3_client()
+    cache = make_cache_store(cache_uri, s3, TMP_DIR)
+    cache_key = recoded_series_key(
+        source_etag(backseries_uri, s3), GSS_OLD_YEAR, GSS_NEW_YEAR, START_YR_NEW_SERIES, OLD_SERIES_COLUMNS,
+        value_precision=VALUE_PRECISION,
+    )
+    return cache, cache_key
+
+def combine_frames(frames):
+    """Old and new series (DataFrames or Arrow tables) as one compact Arrow table without self-flows,
+    sorted for row-group pruning"""
+    with stage("concat") as concat:
+        tables = [to_flow_table(frame) for frame in frames]
+        table = pa.concat_tables([t.select(tables[0].column_names) for t in tables])
+        del tables
+        table = table.filter(pc.not_equal(table["gss_in"], table["gss_out"]))
+        concat.add_rows(table.num_rows)
+    print(f"🧩 Combined series after filtering: {table.num_rows} rows")
+
+    with stage("sort") as sort:
+        table = sort_for_pruning(table, SORT_COLUMNS)
+        sort.add_rows(table.num_rows)
+    return table
+
+
+# ----------------------------- Output writing -----------------------------
+def sort_for_pruning(table, columns):
+    """Sort rows by columns (GSS codes compared as text, including dictionary-encoded ones)"""
+    keys = pa.table({col: sort_key(table[col]) for col in columns})
+    return table.take(pc.sort_indices(keys, sort_keys=[(col, "ascending") for col in columns]))
+
+def write_partitioned(table, mode=WRITE_MODE, max_rows_per_group=MAX_ROWS_PER_GROUP, write_statistics=WRITE_STATISTICS):
+    """Write the combined series to OUTPUT_PARQUET_PREFIX as a hive dataset partitioned by year.
+
+    Existing year= partitions that are written are replaced. Returns the years written.
+    """
+    write_options = ds.ParquetFileFormat().make_write_options(
+        compression=PARQUET_COMPRESSION, write_statistics=write_statistics
+    )
+    write_kwargs = dict(
+        format="parquet",
+        partitioning=["year"],
+        partitioning_flavor="hive",
+        file_options=write_options,
+        basename_template="part-{i}.parquet",
+        max_rows_per_group=max_rows_per_group,
+        min_rows_per_group=min(MIN_ROWS_PER_GROUP, max_rows_per_group),
+        preserve_order=True,
+    )
+    years = pc.unique(table["year"]).to_pylist()
+
+    with stage("write") as written:
+        written.add_rows(table.num_rows)
+        # Every Parquet file written ends up in S3, directly or through the staged upload
+        write_kwargs["file_visitor"] = lambda written_file: written.add_bytes_out(written_file.size or 0)
+        write_to_destination(table, mode, write_kwargs, years)
+    return years
+
+def write_to_destination(table, mode, write_kwargs, years):
+    """Run ds.write_dataset straight to S3 ("direct") or via a temp directory and concurrent upload ("staged")"""
+    if mode == "direct":
+        base_dir = f"{BUCKET_NAME}/{OUTPUT_PARQUET_PREFIX}"
+        print(f"⬆️ Writing {table.num_rows} rows for {len(years)} years to s3://{base_dir}")
+        ds.write_dataset(table, base_dir, filesystem=pafs.S3FileSystem(),
+                         existing_data_behavior="delete_matching", **write_kwargs)
+        return
+
+    if mode != "staged":
+        raise ValueError(f"Unknown write mode: {mode}")
 
-    # 4. Load new series from S3
-    tmp_csv_path = os.path.join(TMP_DIR, "new_series.csv")
-    print(f"📥 Downloading new series from S3: {S3_NEW_SERIES_PATH}")
-    s3.download_file(BUCKET_NAME, S3_NEW_SERIES_PATH, tmp_csv_path)
-    #new_df = pd.read_csv(tmp_csv_path)
-    new_df = pd.read_parquet(tmp_csv_path)
-    print(f"✅ Loaded new series shape: {new_df.shape}")
-
-    # 5. Combine and filter
-    df_combined = pd.concat([df_old_recoded, new_df], ignore_index=True)
-    df_combined = df_combined[df_combined['gss_in'] != df_combined['gss_out']]
-    print(f"🧩 Combined series shape after filtering: {df_combined.shape}")
-
-    # 6. Partition and write Parquet by year
-    grouped = df_combined.groupby("year")
-    for year, group in grouped:
-        table = pa.Table.from_pandas(group)
-        output_path = os.path.join(TMP_DIR, f"parquet_year_{year}")
-        pq.write_to_dataset(table, root_path=output_path, partition_cols=["year"])
-
-        for root, _, files in os.walk(output_path):
+    with tempfile.TemporaryDirectory(dir=TMP_DIR) as staging_dir:
+        print(f"💾 Writing {table.num_rows} rows for {len(years)} years to {staging_dir}")
+        ds.write_dataset(table, staging_dir, existing_data_behavior="overwrite_or_ignore", **write_kwargs)
+
+        uploads = []
+        for root, _, files in os.walk(staging_dir):
             for file in files:
-                if file.endswith(".parquet"):
-                    s3_key = os.path.join(
-                        OUTPUT_PARQUET_PREFIX,
-                        f"year={year}",
-                        file
-                    )
-                    local_file_path = os.path.join(root, file)
-                    print(f"⬆️ Uploading {local_file_path} to s3://{BUCKET_NAME}/{s3_key}")
-                    s3.upload_file(local_file_path, BUCKET_NAME, s3_key)
+                local_file_path = os.path.join(root, file)
+                relative = os.path.relpath(local_file_path, staging_dir).replace(os.sep, "/")
+                uploads.append((local_file_path, f"{OUTPUT_PARQUET_PREFIX}/{relative}"))
 
-    print("✅ All done.")
-    return {"status": "done", "years_written": grouped.ngroups}
+        print(f"⬆️ Uploading {len(uploads)} files to s3://{BUCKET_NAME}/{OUTPUT_PARQUET_PREFIX}")
+        s3 = s3_client()
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+            list(pool.map(lambda upload: s3.upload_file(upload[0], BUCKET_NAME, upload[1], Config=UPLOAD_CONFIG), uploads))
+
+    delete_stale_objects({os.path.dirname(key) for _, key in uploads}, {key for _, key in uploads})
+
+def delete_stale_objects(partition_prefixes, keep_keys):
+    """Remove objects left in the rewritten year= partitions by an earlier, larger write"""
+    s3 = s3_client()
+    for prefix in partition_prefixes:
+        for obj in list_objects(s3, BUCKET_NAME, f"{prefix}/"):
+            if obj['Key'] not in keep_keys:
+                print(f"🗑️ Removing stale s3://{BUCKET_NAME}/{obj['Key']}")
+                s3.delete_object(Bucket=BUCKET_NAME, Key=obj['Key'])
+
+
+# ----------------------------- Old series loading -----------------------------
+def build_recoded_old_series(backseries_uri=None, years=None):
+    """Read the old series before START_YR_NEW_SERIES (only `years`, if given) and recode it to GSS_NEW_YEAR geography"""
+    # 1. Read only the old-series rows and columns we keep, via ranged reads into the ZIP
+    backseries_uri = backseries_uri or S3_PARQUET_ZIP_S3_URI
+    print(f"📥 Opening {backseries_uri} for ranged reads...")
+    with stage("read_old_series") as read:
+        df_old = load_old_series(backseries_uri, max_year=START_YR_NEW_SERIES, years=years)
+        read.add_rows(len(df_old))
+    print(f"✅ Loaded old series shape: {df_old.shape}")
+
+    # 2. Recode gss_in and gss_out together in a single pass
+    print(f"🔄 Recoding gss_in and gss_out from year {GSS_OLD_YEAR} to {GSS_NEW_YEAR}...")
+    with stage("recode") as recode:
+        df_recoded = recode_od(df_old, GSS_OLD_YEAR, GSS_NEW_YEAR)
+        recode.add_rows(len(df_recoded))
+    return df_recoded
+
+def load_old_series(uri, max_year, columns=OLD_SERIES_COLUMNS, years=None):
+    """Read the rows with year < max_year (and in years, if given) from the zipped backseries Parquet at uri (s3:// or local).
+
+    The archive is opened as a seekable file, so only the ZIP directory and
+    the Parquet footer and row groups that survive the year filter are read,
+    and only for the requested columns.
+    """
+    if "://" in uri:
+        filesystem, path = pafs.FileSystem.from_uri(uri)
+    else:
+        filesystem, path = pafs.LocalFileSystem(), os.path.abspath(uri)
+
+    with filesystem.open_input_file(path) as archive, zipfile.ZipFile(archive) as z:
+        # Assume first file inside is the Parquet file
+        info = z.infolist()[0]
+        print(f"📦 Reading {info.filename} ({info.file_size / 1e6:.0f} MB uncompressed)")
+        with open_zip_member(archive, z, info) as source:
+            dataset = parquet_dataset(source)
+            keep = [c for c in columns if c in dataset.schema.names]
+            year_filter = ds.field("year") < max_year
+            if years is not None:
+                year_filter &= ds.field("year").isin(list(years))
+            table = dataset.to_table(columns=keep, filter=year_filter)
+    return conform(table).to_pandas()
+
+@contextmanager
+def open_zip_member(archive, z, info):
+    """Yield a seekable source for a ZIP member's bytes.
+
+    A stored member is read in place through a window onto the archive. A
+    compressed member cannot be seeked, so it is stream-inflated to a temp
+    file in chunks and its path yielded instead.
+    """
+    if info.compress_type == zipfile.ZIP_STORED:
+        yield pa.PythonFile(ZipMemberFile(archive, member_data_offset(archive, info), info.file_size), mode="r")
+        return
+
+    with tempfile.NamedTemporaryFile(dir=TMP_DIR, suffix=".parquet") as tmp:
+        with z.open(info) as member:
+            shutil.copyfileobj(member, tmp, ZIP_COPY_CHUNK_SIZE)
+        tmp.flush()
+        yield tmp.name
+
+def member_data_offset(archive, info):
+    """Offset of a member's data: its local header is 30 bytes plus variable-length name and extra fields"""
+    archive.seek(info.header_offset)
+    header = archive.read(30)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+def parquet_dataset(source):
+    """pyarrow dataset over a Parquet file path or an open file"""
+    if isinstance(source, str):
+        return ds.dataset(source, format="parquet")
+    parquet_format = ds.ParquetFileFormat()
+    fragment = parquet_format.make_fragment(source)
+    return ds.FileSystemDataset([fragment], fragment.physical_schema, parquet_format)
+
+class ZipMemberFile(io.RawIOBase):
+    """Read-only, seekable window onto the bytes of a stored ZIP member"""
+
+    def __init__(self, archive, offset, size):
+        self.archive = archive
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
 
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self.position
+        elif whence == io.SEEK_END:
+            position += self.size
+        self.position = min(max(position, 0), self.size)
+        return self.position
 
+    def readinto(self, buffer):
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+        self.archive.seek(self.offset + self.position)
+        data = self.archive.read(length)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
@@ -1,18 +1,16 @@
 import pandas as pd
-import pyarrow.dataset as ds
 import os
+from instrumentation import StageRecorder, stage
+from flow_scan import iter_year_partitions, open_flows
+from geography_registry import load_registry, read_lookup
+from od_aggregation import aggregate_geographies, concat_results
 
-# File paths (local or S3-mounts)
+# File paths (local or S3-mounts); the lookups are read through geography_registry
 FLOWS_PATH = "data/processed/domestic_od_flows/"
-LOOKUP_REGION = "lookups/lookup_lad_rgn_ctry.csv"
-LOOKUP_COUNTRY = "lookups/lookup_lad_ctry.csv"
-LOOKUP_INNER_OUTER = "lookups/lookup_lad_inner_outer_london.csv"
+OUTPUT_DIR = "data/processed"
 
-# Load Parquet dataset
-dataset = ds.dataset(FLOWS_PATH, format="parquet", partitioning="hive")
-
-# Convert to DataFrame
-df = dataset.to_table().to_pandas()
+# The only columns step5 reads from the flows
+FLOW_COLUMNS = ["gss_in", "gss_out", "year", "value"]
 
 # --- 1. Create gross flows ---
 def create_gross_flows(df, rounding=1):
@@ -25,11 +23,9 @@ def create_gross_flows(df, rounding=1):
     merged["outflow"] = merged["outflow"].round(rounding)
     return merged
 
-lad_gross_flows = create_gross_flows(df)
-
 # --- 2. Region Aggregation ---
 def aggregate_to_region(df, lookup_path, name="region"):
-    lookup = pd.read_csv(lookup_path)
+    lookup = read_lookup(lookup_path)
     df = df.merge(lookup, left_on='gss_in', right_on='lad_code')
     df['region_in'] = df[name]
     df = df.merge(lookup, left_on='gss_out', right_on='lad_code')
@@ -40,25 +36,61 @@ def aggregate_to_region(df, lookup_path, name="region"):
     agg.columns = ['gss_in', 'gss_out', 'year', 'value']
     return agg
 
-region_od_data = aggregate_to_region(df, LOOKUP_REGION, name="region_code")
-country_od_data = aggregate_to_region(df, LOOKUP_COUNTRY, name="country_code")
-inner_outer_od_data = aggregate_to_region(df, LOOKUP_INNER_OUTER, name="io_london")
+# create_gross_flows and aggregate_to_region are the merge-based reference
+# (see benchmarks/bench_od_aggregation.py); convert_geographies uses the
+# integer-coded engine in od_aggregation, which builds every geography from
+# one encoding of the flows.
+def load_hierarchies():
+    registry = load_registry()
+    return {level: registry.hierarchy(level) for level in ("region", "country", "inner_outer")}
+
+def convert_geographies(dataset, hierarchies, years=None, rounding=1):
+    """LAD gross flows plus OD and gross flows for each hierarchy, from a lazy flows dataset.
+
+    Each year partition is scanned on its own with only FLOW_COLUMNS read,
+    so memory holds one year of flows at a time.
+    """
+    parts = []
+    with stage("aggregate") as aggregate:
+        for year, df in iter_year_partitions(dataset, columns=FLOW_COLUMNS, years=years):
+            print(f"Aggregating year {year}: {len(df)} rows")
+            aggregate.add_rows(len(df))
+            parts.append(aggregate_geographies(df, hierarchies, rounding=rounding))
+        return concat_results(parts)
+
+def combine_gross_flows(results):
+    """England, region and inner/outer London gross flows in one table"""
+    country_gross_flows = results["country"]["gross"]
+    region_gross_flows = results["region"]["gross"]
+    inner_outer_gross_flows = results["inner_outer"]["gross"]
+    return pd.concat([
+        country_gross_flows[country_gross_flows['gss_code'] == "E92000001"],  # England only
+        region_gross_flows,
+        inner_outer_gross_flows[inner_outer_gross_flows['gss_code'] != "other"]
+    ])
+
+def output_tables(results):
+    """The tables step5 saves, by output name"""
+    return {
+        "lad_gross_flows": results["lad_gross"],
+        "region_od_series": results["region"]["od"],
+        "ctry_od_series": results["country"]["od"],
+        "inner_outer_london_od_data": results["inner_outer"]["od"],
+        "ctry_region_gross_flows": combine_gross_flows(results),
+    }
 
-# --- 3. Gross flows by aggregation ---
-region_gross_flows = create_gross_flows(region_od_data)
-country_gross_flows = create_gross_flows(country_od_data)
-inner_outer_gross_flows = create_gross_flows(inner_outer_od_data)
+def main(flows_path=FLOWS_PATH, output_dir=OUTPUT_DIR, years=None):
+    with StageRecorder("step5_converting_geographies") as perf:
+        # Lazy Parquet dataset: partitions are read one at a time by convert_geographies
+        dataset = open_flows(flows_path)
+        results = convert_geographies(dataset, load_hierarchies(), years=years)
 
-# --- 4. Combine country + region + Inner/Outer flows ---
-final_gross = pd.concat([
-    country_gross_flows[country_gross_flows['gss_code'] == "E92000001"],  # England only
-    region_gross_flows,
-    inner_outer_gross_flows[inner_outer_gross_flows['gss_code'] != "other"]
-])
+        # Save (optional)
+        with perf.stage("write") as write:
+            for name, df in output_tables(results).items():
+                df.to_parquet(os.path.join(output_dir, f"{name}.parquet"), index=False)
+                write.add_rows(len(df))
+    return results
 
-# Save (optional)
-lad_gross_flows.to_parquet("data/processed/lad_gross_flows.parquet", index=False)
-region_od_data.to_parquet("data/processed/region_od_series.parquet", index=False)
-country_od_data.to_parquet("data/processed/ctry_od_series.parquet", index=False)
-inner_outer_od_data.to_parquet("data/processed/inner_outer_london_od_data.parquet", index=False)
-final_gross.to_parquet("data/processed/ctry_region_gross_flows.parquet", index=False)
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import os
 import urllib.request
+from denominator_store import STORE_PATH, ensure_store
+from instrumentation import StageRecorder
 
 # Define the local path and remote URL
 POPULATION_PATH = "data/processed/population_coc.rds"
@@ -8,13 +10,24 @@ URL_POPULATION = (
     "2b07a39b-ba63-403a-a3fc-5456518ca785/full_modelled_estimates_series_EW%282023_geog%29.rds"
 )
 
-# Create the folder if it doesn't exist
-os.makedirs(os.path.dirname(POPULATION_PATH), exist_ok=True)
+def main(population_path=POPULATION_PATH, store_path=STORE_PATH):
+    """Download the population estimates if missing and build their Parquet store. Returns the store path."""
+    with StageRecorder("step6_downloading_denominator") as perf:
+        # Create the folder if it doesn't exist
+        os.makedirs(os.path.dirname(population_path), exist_ok=True)
 
-# Download the file if it doesn't already exist
-if not os.path.exists(POPULATION_PATH):
-    print("Downloading modelled population estimates...")
-    urllib.request.urlretrieve(URL_POPULATION, POPULATION_PATH)
-    print(f"Saved to {POPULATION_PATH}")
-else:
-    print("Population file already exists. Skipping download.")
\ No newline at end of file
+        # Download the file if it doesn't already exist
+        with perf.stage("download"):
+            if not os.path.exists(population_path):
+                print("Downloading modelled population estimates...")
+                urllib.request.urlretrieve(URL_POPULATION, population_path)
+                print(f"Saved to {population_path}")
+            else:
+                print("Population file already exists. Skipping download.")
+
+        # Columnar copy for the flow steps; only rebuilt when the download changes
+        with perf.stage("build_store"):
+            return ensure_store(population_path, store_path)
+
+if __name__ == "__main__":
+    main()
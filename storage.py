@@ -0,0 +1,194 @@
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+import boto3
+import pyarrow.parquet as pq
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# One S3 client per process, shared by every step. The pool is large enough for the
+# concurrent transfers the steps run (step2 workers, step4 uploads, TransferConfig threads).
+S3_CONFIG = Config(max_pool_connections=32, retries={"max_attempts": 5, "mode": "standard"})
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=16 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024, max_concurrency=4)
+TMP_DIR = "/tmp"
+
+# A client must not be reused across a fork, so they are kept per process id
+_clients = {}
+
+def s3_client():
+    """The pooled S3 client for the current process"""
+    pid = os.getpid()
+    if pid not in _clients:
+        _clients[pid] = boto3.client('s3', config=S3_CONFIG)
+    return _clients[pid]
+
+def parse_s3_path(s3_path):
+    """Parse an S3 path into bucket and key/prefix"""
+    if not s3_path.startswith("s3://"):
+        raise ValueError("S3 path must start with s3://")
+    parts = s3_path[5:].split("/", 1)
+    bucket = parts[0]
+    key = parts[1] if len(parts) > 1 else ""
+    return bucket, key
+
+def list_objects(client, bucket, prefix, suffixes=None):
+    """Yield the list_objects_v2 entries under prefix, optionally only keys ending in one of suffixes"""
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if suffixes is None or obj['Key'].endswith(tuple(suffixes)):
+                yield obj
+
+def is_not_found(error):
+    return error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound")
+
+# LocalStorage keeps an object's user metadata (S3's x-amz-meta-*) in a sidecar file next to it
+METADATA_SUFFIX = ".metadata.json"
+
+def make_storage(location, client=None):
+    """Storage rooted at an s3://bucket/prefix/ URI or a local directory"""
+    if location.startswith("s3://"):
+        bucket, prefix = parse_s3_path(location)
+        return S3Storage(bucket, prefix, client or s3_client())
+    return LocalStorage(location)
+
+class LocalStorage:
+    """Objects as files under a local directory; keys are '/'-separated relative paths"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def uri(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def exists(self, key):
+        return os.path.exists(self.uri(key))
+
+    def head(self, key):
+        """{"etag", "metadata"} of the object, or None if there is none; the ETag is its size and mtime"""
+        path = self.uri(key)
+        if not os.path.exists(path):
+            return None
+        metadata = {}
+        if os.path.exists(f"{path}{METADATA_SUFFIX}"):
+            with open(f"{path}{METADATA_SUFFIX}") as f:
+                metadata = json.load(f)
+        stat = os.stat(path)
+        return {"etag": f"{stat.st_size}-{stat.st_mtime_ns}", "metadata": metadata}
+
+    def list(self, prefix="", suffixes=None):
+        """Keys under prefix, sorted"""
+        keys = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, "/")
+                if key.startswith(prefix) and (suffixes is None or key.endswith(tuple(suffixes))):
+                    keys.append(key)
+        return sorted(keys)
+
+    @contextmanager
+    def local_path(self, key):
+        """Yield a local path holding the object's bytes"""
+        yield self.uri(key)
+
+    def put_fileobj(self, fileobj, key, metadata=None):
+        path = self.uri(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            shutil.copyfileobj(fileobj, f)
+        os.replace(f"{path}.tmp", path)
+        if metadata is not None:
+            with open(f"{path}{METADATA_SUFFIX}", "w") as f:
+                json.dump(metadata, f)
+
+    def put_file(self, local_path, key):
+        path = self.uri(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(local_path, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+
+    def copy(self, source_key, key):
+        self.put_file(self.uri(source_key), key)
+
+    def delete(self, key):
+        os.remove(self.uri(key))
+
+    def read_table(self, key, columns=None, filters=None):
+        return pq.read_table(self.uri(key), columns=columns, filters=filters, memory_map=True)
+
+    def write_table(self, table, key, **write_options):
+        """Write table as Parquet at key, replacing any previous object. Returns the bytes written."""
+        path = self.uri(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(table, f"{path}.tmp", **write_options)
+        os.replace(f"{path}.tmp", path)
+        return os.path.getsize(path)
+
+class S3Storage:
+    """Objects under s3://bucket/prefix/, moved with the pooled boto3 client"""
+
+    def __init__(self, bucket, prefix="", client=None, transfer_config=TRANSFER_CONFIG):
+        self.bucket = bucket
+        self.prefix = prefix if not prefix or prefix.endswith("/") else f"{prefix}/"
+        self.s3 = client or s3_client()
+        self.transfer_config = transfer_config
+
+    def uri(self, key):
+        return f"s3://{self.bucket}/{self.prefix}{key}"
+
+    def exists(self, key):
+        return self.head(key) is not None
+
+    def head(self, key):
+        """{"etag", "metadata"} of the object, or None if there is none"""
+        try:
+            response = self.s3.head_object(Bucket=self.bucket, Key=f"{self.prefix}{key}")
+        except ClientError as e:
+            if is_not_found(e):
+                return None
+            raise
+        return {"etag": response["ETag"].strip('"'), "metadata": response.get("Metadata", {})}
+
+    def list(self, prefix="", suffixes=None):
+        """Keys under prefix, sorted"""
+        return sorted(obj['Key'][len(self.prefix):]
+                      for obj in list_objects(self.s3, self.bucket, f"{self.prefix}{prefix}", suffixes))
+
+    @contextmanager
+    def local_path(self, key):
+        """Download the object to a temp file, yield its path and remove it afterwards"""
+        with tempfile.TemporaryDirectory(dir=TMP_DIR) as tmp:
+            path = os.path.join(tmp, key.rsplit("/", 1)[-1])
+            self.s3.download_file(self.bucket, f"{self.prefix}{key}", path, Config=self.transfer_config)
+            yield path
+
+    def put_fileobj(self, fileobj, key, metadata=None):
+        extra_args = {"Metadata": metadata} if metadata is not None else None
+        self.s3.upload_fileobj(fileobj, self.bucket, f"{self.prefix}{key}", ExtraArgs=extra_args,
+                               Config=self.transfer_config)
+
+    def put_file(self, local_path, key):
+        self.s3.upload_file(local_path, self.bucket, f"{self.prefix}{key}", Config=self.transfer_config)
+
+    def copy(self, source_key, key):
+        """Server-side copy within the bucket"""
+        self.s3.copy({"Bucket": self.bucket, "Key": f"{self.prefix}{source_key}"}, self.bucket, f"{self.prefix}{key}",
+                     Config=self.transfer_config)
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=f"{self.prefix}{key}")
+
+    def read_table(self, key, columns=None, filters=None):
+        with self.local_path(key) as path:
+            return pq.read_table(path, columns=columns, filters=filters)
+
+    def write_table(self, table, key, **write_options):
+        """Write table as Parquet at key through a temp file and a multipart upload. Returns the bytes written."""
+        with tempfile.TemporaryDirectory(dir=TMP_DIR) as tmp:
+            path = os.path.join(tmp, key.rsplit("/", 1)[-1])
+            pq.write_table(table, path, **write_options)
+            self.s3.upload_file(path, self.bucket, f"{self.prefix}{key}", Config=self.transfer_config)
+            return os.path.getsize(path)
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from denominator_store import DenominatorStore, KEY_COLUMNS, ensure_store, migration_rates
+
+CODES = ["E09000001", "E09000002", "E09000003", "E06000001"]
+
+def population(seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame([(code, year, age, sex) for code in CODES for year in range(2015, 2024)
+                       for age in range(91) for sex in ("female", "male")], columns=KEY_COLUMNS)
+    df["popn"] = rng.random(len(df)) * 1000
+    return df.sample(frac=1, random_state=seed, ignore_index=True)
+
+def make_source(tmp_path, content=b"rds"):
+    source = tmp_path / "population_coc.rds"
+    source.write_bytes(content)
+    return str(source)
+
+def test_store_is_sorted_and_only_rebuilt_when_source_changes(tmp_path):
+    source, path = make_source(tmp_path), str(tmp_path / "population.parquet")
+    calls = []
+
+    def read_source(_):
+        calls.append(1)
+        return population()
+
+    ensure_store(source, path, read_source)
+    ensure_store(source, path, read_source)
+    assert len(calls) == 1
+
+    stored = pq.read_table(path).to_pandas()
+    pd.testing.assert_frame_equal(stored, stored.sort_values(KEY_COLUMNS, ignore_index=True))
+
+    make_source(tmp_path, b"rdx")  # same size, different hash
+    ensure_store(source, path, read_source)
+    assert len(calls) == 2
+
+def test_lookup_reads_only_matching_rows(tmp_path):
+    path = ensure_store(make_source(tmp_path), str(tmp_path / "population.parquet"), lambda _: population())
+    expected = population()
+    expected = expected[(expected["gss_code"] == "E09000002") & (expected["year"] == 2020) & (expected["age"] < 5)]
+
+    result = DenominatorStore(path).lookup(gss_codes=["E09000002"], years=[2020], ages=range(5))
+
+    pd.testing.assert_frame_equal(result, expected.sort_values(KEY_COLUMNS, ignore_index=True), check_dtype=False)
+
+def test_migration_rates_join_on_renamed_keys_and_sum_over_sex(tmp_path):
+    path = ensure_store(make_source(tmp_path), str(tmp_path / "population.parquet"), lambda _: population())
+    flows = pd.DataFrame({"gss_in": ["E09000001", "E06000001", "W06000001"],
+                          "year": [2016, 2023, 2016], "age": [0, 15, 0], "value": [12.0, 3.0, 1.0]})
+
+    rates = migration_rates(flows, DenominatorStore(path), on=("gss_code", "year", "age"),
+                            left_on=("gss_in", "year", "age"))
+
+    pop = population().groupby(["gss_code", "year", "age"])["popn"].sum()
+    assert list(rates.columns) == ["gss_in", "year", "age", "value", "popn", "rate"]
+    assert np.isclose(rates["rate"][0], 12.0 / pop[("E09000001", 2016, 0)])
+    assert np.isclose(rates["rate"][1], 3.0 / pop[("E06000001", 2023, 15)])
+    assert np.isnan(rates["rate"][2])
@@ -0,0 +1,68 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from flow_scan import iter_year_partitions, open_flows, partition_years, scan_flows
+from flow_schema import conform_frame
+from od_aggregation import aggregate_geographies, directional_flows, encode_flows, hierarchy_map, wide_by_age
+from step5_converting_geographies import convert_geographies
+from step7_create_borough_children_flows import build_children_flows
+from test_od_aggregation import IO_LOOKUP, REGION_LOOKUP, flows
+
+def write_flows(df, path):
+    ds.write_dataset(pa.Table.from_pandas(df, preserve_index=False), path, format="parquet",
+                     partitioning=["year"], partitioning_flavor="hive")
+    return open_flows(str(path))
+
+def test_filters_and_projection_are_pushed_into_the_scan(tmp_path):
+    df = flows()
+    dataset = write_flows(df, tmp_path / "flows")
+
+    table = scan_flows(dataset, columns=["gss_in", "age", "value"], years=[2010, 2011], max_age=15,
+                       codes_in=["E09000001"]).to_table()
+
+    expected = df[df["year"].isin([2010, 2011]) & (df["age"] <= 15) & (df["gss_in"] == "E09000001")]
+    assert table.column_names == ["gss_in", "age", "value"]
+    assert table.num_rows == len(expected)
+    assert sorted(table["value"].to_pylist()) == sorted(expected["value"])
+
+def test_iter_year_partitions_yields_one_year_at_a_time(tmp_path):
+    df = flows()
+    dataset = write_flows(df, tmp_path / "flows")
+
+    assert partition_years(dataset) == sorted(df["year"].unique())
+    for year, part in iter_year_partitions(dataset, columns=["year", "value"], years=[2003, 2020]):
+        assert set(part["year"]) == {year}
+        assert len(part) == (df["year"] == year).sum()
+
+def test_convert_geographies_matches_eager_aggregation(tmp_path):
+    df = flows()
+    dataset = write_flows(df, tmp_path / "flows")
+    hierarchies = {
+        "region": hierarchy_map(REGION_LOOKUP, "region_code"),
+        "inner_outer": hierarchy_map(IO_LOOKUP, "io_london"),
+    }
+
+    result = convert_geographies(dataset, hierarchies)
+    expected = aggregate_geographies(conform_frame(df), hierarchies)  # the scan reads values at flow_schema precision
+
+    pd.testing.assert_frame_equal(result["lad_gross"], expected["lad_gross"], check_dtype=False)
+    for name in hierarchies:
+        for kind in ("od", "gross"):
+            pd.testing.assert_frame_equal(result[name][kind], expected[name][kind], check_dtype=False)
+
+def test_children_flows_year_by_year_match_a_single_pass(tmp_path):
+    df = flows()
+    dataset = write_flows(df, tmp_path / "flows")
+    hierarchies = {
+        "region": hierarchy_map(REGION_LOOKUP, "region_code"),
+        "inner_outer": hierarchy_map(IO_LOOKUP[IO_LOOKUP["io_london"] != "other"], "io_london"),
+    }
+
+    net, wide = build_children_flows(dataset, hierarchies, min_age=0, max_age=15)
+
+    children = conform_frame(df[df["age"] <= 15])
+    expected = directional_flows(encode_flows(children, col_age="age"), hierarchies)
+    expected = expected.sort_values(["gss_code", "origin_destination_code", "year", "age"], ignore_index=True)
+    pd.testing.assert_frame_equal(net, expected, check_dtype=False)
+    pd.testing.assert_frame_equal(wide, wide_by_age(expected, ages=range(16)), check_dtype=False)
@@ -0,0 +1,71 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pytest
+
+from flow_schema import FLOW_SCHEMA, conform, conform_frame, flow_schema, sort_key
+from ons_workbook_reader import LONG_SCHEMA, to_long_format
+
+def raw_flows():
+    return pa.table({
+        "gss_in": ["E09000002", "E06000001", "E09000002"],
+        "gss_out": ["E09000001", "W06000001", "E06000001"],
+        "year": pa.array([2012.0, 2012.0, 2013.0]),
+        "age": pa.array([0, 15, 90], type=pa.int64()),
+        "sex": ["female", "male", "female"],
+        "value": [1.5, 2.0, 3.25],
+        "note": ["a", "b", "c"],
+    })
+
+def test_conform_casts_flow_columns_and_keeps_others():
+    table = conform(raw_flows())
+
+    assert table.column_names == ["gss_in", "gss_out", "year", "age", "sex", "value", "note"]
+    for name in FLOW_SCHEMA.names:
+        assert table.schema.field(name).type == FLOW_SCHEMA.field(name).type
+    assert table.schema.field("note").type == pa.string()
+    assert table["gss_in"].to_pylist() == ["E09000002", "E06000001", "E09000002"]
+    assert table["year"].to_pylist() == [2012, 2012, 2013]
+    assert conform(table) is table
+
+@pytest.mark.parametrize("column, values", [("age", [0, 15, 300]), ("year", [2012.5, 2012.0, 2013.0])])
+def test_conform_refuses_lossy_casts(column, values):
+    table = raw_flows()
+    table = table.set_column(table.schema.get_field_index(column), column, pa.array(values))
+    with pytest.raises(pa.ArrowInvalid):
+        conform(table)
+
+def test_value_precision_is_configurable():
+    assert FLOW_SCHEMA.field("value").type == pa.float64()  # modelled values are kept exactly by default
+    assert conform(raw_flows(), precision="float64").schema.field("value").type == pa.float64()
+    assert flow_schema("float32").field("value").type == pa.float32()
+
+def test_float32_values_round_within_single_precision():
+    modelled = pa.table({"value": pa.array([0.1234567891, 1234.56789012, 9876543.21])})
+    narrowed = conform(modelled, precision="float32")["value"].to_numpy().astype(float)
+    assert narrowed.tolist() != modelled["value"].to_pylist()  # float32 is lossy for modelled values...
+    assert abs(narrowed / modelled["value"].to_numpy() - 1).max() < 2 ** -24  # ...within half a float32 ulp
+
+def test_conform_frame_is_compact_and_keeps_the_index():
+    df = raw_flows().to_pandas().set_index(pd.Index([10, 20, 30]))
+    compact = conform_frame(df)
+
+    assert compact["gss_in"].dtype == "category" and compact["sex"].dtype == "category"
+    assert compact["age"].dtype == "uint8" and compact["year"].dtype == "int16"
+    assert list(compact.index) == [10, 20, 30]
+    assert list(compact["gss_out"]) == list(df["gss_out"])
+
+    tiled = pd.concat([df] * 1000, ignore_index=True)
+    assert conform_frame(tiled).memory_usage(deep=True).sum() < tiled.memory_usage(deep=True).sum() / 3
+    assert conform_frame(tiled, precision="float32").memory_usage(deep=True).sum() < tiled.memory_usage(deep=True).sum() / 4
+
+def test_sort_key_orders_dictionary_columns_by_text():
+    column = pa.chunked_array([pa.array(["b", "a", "c"]).dictionary_encode(), pa.array(["a", "z"]).dictionary_encode()])
+    order = pc.sort_indices(pa.table({"key": sort_key(column)}), sort_keys=[("key", "ascending")])
+    assert column.take(order).to_pylist() == ["a", "a", "b", "c", "z"]
+
+def test_workbook_rows_come_out_in_the_flow_schema():
+    batch = pa.RecordBatch.from_pydict({"OutLA": ["E09000001"], "InLA": ["E09000002"], "Sex": ["F"], "Year": [2022],
+                                        "Age_0": [1.0], "Age_1": [0.0]})
+    assert LONG_SCHEMA == FLOW_SCHEMA
+    assert to_long_format(batch).schema == FLOW_SCHEMA
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import geography_registry
+from od_aggregation import aggregate_geographies, hierarchy_map, parent_index
+from test_od_aggregation import IO_LOOKUP, REGION_LOOKUP, flows
+
+COUNTRY_LOOKUP = pd.DataFrame({"lad_code": REGION_LOOKUP["lad_code"],
+                               "country_code": REGION_LOOKUP["lad_code"].str[0] + "92000001"})
+
+@pytest.fixture
+def lookups(tmp_path, monkeypatch):
+    paths = {}
+    for name, lookup in (("region", REGION_LOOKUP), ("country", COUNTRY_LOOKUP), ("inner_outer", IO_LOOKUP)):
+        paths[name] = tmp_path / f"{name}.csv"
+        lookup.to_csv(paths[name], index=False)
+    monkeypatch.setattr(geography_registry, "LOOKUP_REGION", str(paths["region"]))
+    monkeypatch.setattr(geography_registry, "LOOKUP_COUNTRY", str(paths["country"]))
+    monkeypatch.setattr(geography_registry, "LOOKUP_INNER_OUTER", str(paths["inner_outer"]))
+    monkeypatch.setattr(geography_registry, "_registries", {})
+    return paths
+
+def test_registry_maps_codes_like_the_lookups(lookups):
+    registry = geography_registry.load_registry()
+
+    for level, lookup, column in (("region", REGION_LOOKUP, "region_code"), ("inner_outer", IO_LOOKUP, "io_london")):
+        codes = pd.Index(["W06000001", "E09000003", "E07000999", "E09000001"])
+        index, parents = registry.parent_index(codes, level)
+        expected_index, expected_parents = parent_index(codes, hierarchy_map(lookup, column))
+        assert list(parents[index[index >= 0]]) == list(expected_parents[expected_index[expected_index >= 0]])
+        assert (index < 0).tolist() == (expected_index < 0).tolist()
+
+    index, parents = registry.hierarchy("inner_outer", exclude=("other",)).parent_index(["E09000002", "XX", "E06000001"])
+    assert index[0] >= 0 and parents[index[0]] == "E13000002" and list(index[1:]) == [-1, -1]
+    assert "other" not in set(parents)
+
+def test_aggregation_over_the_registry_matches_the_lookups(lookups):
+    registry = geography_registry.load_registry()
+    df = flows()
+    expected = aggregate_geographies(df, {"region": hierarchy_map(REGION_LOOKUP, "region_code"),
+                                          "inner_outer": hierarchy_map(IO_LOOKUP, "io_london")})
+    result = aggregate_geographies(df, {"region": registry.hierarchy("region"), "inner_outer": registry.hierarchy("inner_outer")})
+
+    for name in ("region", "inner_outer"):
+        for kind in ("od", "gross"):
+            pd.testing.assert_frame_equal(result[name][kind], expected[name][kind])
+
+def test_artifact_is_compiled_once_and_reused(lookups, monkeypatch):
+    first = geography_registry.load_registry()
+    table = pa.ipc.open_file(geography_registry.registry_path()).read_all()
+    assert table.schema.metadata[b"registry_format"] == str(geography_registry.REGISTRY_FORMAT_VERSION).encode()
+    assert pa.types.is_dictionary(table.schema.field("region").type)
+    assert table.schema.field("gss_class").type == geography_registry.CLASS_TYPE
+
+    def no_csv(*args, **kwargs):
+        raise AssertionError("lookups should not be parsed again")
+
+    monkeypatch.setattr(pd, "read_csv", no_csv)
+    assert geography_registry.load_registry() is first  # warm invocation: the module-level registry
+    monkeypatch.setattr(geography_registry, "_registries", {})
+    assert geography_registry.load_registry().codes.equals(first.codes)  # cold start: the artifact
+
+def test_changed_lookup_is_recompiled(lookups, monkeypatch):
+    geography_registry.load_registry()
+    IO_LOOKUP.assign(io_london="E13000001").to_csv(lookups["inner_outer"], index=False)
+    assert list(geography_registry.load_registry().hierarchy("inner_outer").parents) == ["E13000001"]
+
+def test_recodable_classes_match_the_e0_w0_filter(lookups, monkeypatch):
+    codes = pd.Series(["E07000026", "E09000001", "W06000001", "E12000007", "E92000001", "S92000003", "W92000004", None])
+    expected = codes.str.contains("E0|W0", na=False).tolist()
+    assert geography_registry.is_recodable(codes).tolist() == expected
+    assert geography_registry.is_recodable(np.array([], dtype=object)).tolist() == []
+
+    registry = geography_registry.load_registry()
+    checked = []
+    prefix_recodable = geography_registry.prefix_recodable
+    monkeypatch.setattr(geography_registry, "prefix_recodable", lambda c: checked.extend(c) or prefix_recodable(c))
+    assert geography_registry.is_recodable(codes).tolist() == expected
+    assert checked and not set(checked) & set(registry.codes)  # registry codes are classified through the code index
+
+def test_recodable_falls_back_to_prefixes_without_a_registry(tmp_path, monkeypatch):
+    monkeypatch.setattr(geography_registry, "LOOKUP_REGION", str(tmp_path / "missing.csv"))
+    codes = pd.Series(["E06000001", "E12000007", "W06000001", None])
+    assert geography_registry.available_registry() is None
+    assert geography_registry.is_recodable(codes).tolist() == [True, False, True, False]
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+import instrumentation
+from instrumentation import StageRecorder, stage
+
+def test_local_run_writes_a_json_report(tmp_path, monkeypatch):
+    monkeypatch.delenv("AWS_LAMBDA_FUNCTION_NAME", raising=False)
+    monkeypatch.setattr(instrumentation, "REPORT_DIR", str(tmp_path))
+
+    with StageRecorder("step9") as perf:
+        with perf.stage("download") as download:
+            download.add_bytes_in(2048)
+            download.add_rows(10)
+        with stage("write") as write:  # attaches to the running recorder
+            write.add_bytes_out(512)
+
+    with open(perf.report_path) as f:
+        report = json.load(f)
+    assert report["pipeline"] == "step9"
+    assert [s["stage"] for s in report["stages"]] == ["download", "write"]
+    assert report["stages"][0]["s3_bytes_in"] == 2048 and report["stages"][0]["rows"] == 10
+    assert report["stages"][1]["s3_bytes_out"] == 512
+    assert all(s["duration_ms"] >= 0 and s["peak_rss_mb"] > 0 for s in report["stages"])
+
+def test_lambda_run_prints_embedded_metric_format(monkeypatch, capsys):
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "step9")
+
+    with pytest.raises(ValueError):
+        with StageRecorder("step9") as perf:
+            with perf.stage("recode") as recode:
+                recode.add_rows(5)
+                raise ValueError("bad code")
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+    assert len(records) == 1
+    record = records[0]
+    metrics = record["_aws"]["CloudWatchMetrics"][0]
+    assert metrics["Namespace"] == instrumentation.METRIC_NAMESPACE
+    assert metrics["Dimensions"] == [["Pipeline", "Stage"]]
+    assert {m["Name"] for m in metrics["Metrics"]} == set(instrumentation.METRIC_UNITS)
+    assert record["Stage"] == "recode" and record["rows"] == 5
+    assert record["Error"] == "ValueError: bad code"
+
+def test_stage_outside_a_recorder_is_a_no_op():
+    with stage("anything") as unrecorded:
+        unrecorded.add_rows(3)
+    assert unrecorded.rows == 3
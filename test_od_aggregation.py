@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+from od_aggregation import (aggregate_geographies, directional_flows, encode_flows, gross_flows, hierarchy_map,
+                            od_matrix, wide_by_age)
+from step5_converting_geographies import aggregate_to_region, create_gross_flows
+
+LADS = ["E09000001", "E09000002", "E09000003", "E06000001", "E07000026", "W06000001", "S12000033"]
+REGION_LOOKUP = pd.DataFrame({
+    "lad_code": ["E09000001", "E09000002", "E09000003", "E06000001", "E07000026", "W06000001"],
+    "region_code": ["E12000007", "E12000007", "E12000007", "E12000001", "E12000002", "W92000004"],
+})
+IO_LOOKUP = pd.DataFrame({
+    "lad_code": ["E09000001", "E09000002", "E09000003", "E06000001"],
+    "io_london": ["E13000001", "E13000002", "E13000002", "other"],
+})
+
+def flows(rows=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "gss_in": rng.choice(LADS, rows),
+        "gss_out": rng.choice(LADS, rows),
+        "year": rng.integers(2002, 2024, rows),
+        "age": rng.integers(0, 91, rows),
+        "sex": rng.choice(["female", "male"], rows),
+        "value": rng.random(rows).round(3),
+    })
+
+def merge_path(df, lookup, name, tmp_path):
+    path = tmp_path / f"{name}.csv"
+    lookup.to_csv(path, index=False)
+    return aggregate_to_region(df, path, name=name)
+
+def test_od_matrix_matches_merge_based_aggregation(tmp_path):
+    df = flows()
+    for lookup, name in [(REGION_LOOKUP, "region_code"), (IO_LOOKUP, "io_london")]:
+        expected = merge_path(df, lookup, name, tmp_path)
+        result = od_matrix(encode_flows(df), hierarchy_map(lookup, name))
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+def test_gross_flows_match_create_gross_flows(tmp_path):
+    df = flows()
+    encoded = encode_flows(df)
+
+    pd.testing.assert_frame_equal(gross_flows(encoded), create_gross_flows(df), check_dtype=False)
+
+    region_od = merge_path(df, REGION_LOOKUP, "region_code", tmp_path)
+    pd.testing.assert_frame_equal(gross_flows(encoded, hierarchy_map(REGION_LOOKUP, "region_code")),
+                                  create_gross_flows(region_od), check_dtype=False)
+
+def test_aggregate_geographies_builds_every_rollup():
+    results = aggregate_geographies(flows(), {"region": hierarchy_map(REGION_LOOKUP, "region_code")})
+
+    assert set(results) == {"lad_gross", "region"}
+    assert set(results["region"]["od"]["gss_in"]) <= set(REGION_LOOKUP["region_code"])
+
+def reference_directional_flows(df, parent_map):
+    """Merge-based in/out/net flows for one hierarchy, as step7 used to build them"""
+    mapped = df.assign(gss_in=df["gss_in"].map(parent_map), gss_out=df["gss_out"].map(parent_map))
+    keys = ["age", "year"]
+    od = mapped.dropna(subset=["gss_in", "gss_out"]).groupby(["gss_in", "gss_out"] + keys)["value"].sum().reset_index()
+    tot_in = mapped.dropna(subset=["gss_in"]).groupby(["gss_in"] + keys)["value"].sum().reset_index().assign(gss_out="total")
+    tot_out = mapped.dropna(subset=["gss_out"]).groupby(["gss_out"] + keys)["value"].sum().reset_index().assign(gss_in="total")
+    all_od = pd.concat([od, tot_in, tot_out], ignore_index=True)
+
+    in_ = all_od.rename(columns={"value": "inflow"})
+    out = all_od.rename(columns={"gss_in": "gss_out", "gss_out": "gss_in", "value": "outflow"})
+    net = in_.merge(out, on=["gss_in", "gss_out"] + keys, how="outer").fillna(0)
+    net["netflow"] = net["inflow"] - net["outflow"]
+    net = net[net["gss_in"] != "total"].rename(columns={"gss_in": "gss_code", "gss_out": "origin_destination_code"})
+    return net.sort_values(["gss_code", "origin_destination_code", "year", "age"], ignore_index=True)
+
+def test_directional_flows_match_merge_based_net_flows():
+    df = flows()
+    df = df[df["age"] <= 15]
+    region = hierarchy_map(REGION_LOOKUP, "region_code")
+
+    result = directional_flows(encode_flows(df, col_age="age"), {"region": region})
+    expected = reference_directional_flows(df, region)
+
+    result = result.sort_values(["gss_code", "origin_destination_code", "year", "age"], ignore_index=True)
+    pd.testing.assert_frame_equal(result, expected[result.columns], check_dtype=False)
+
+def test_wide_by_age_matches_melt_and_pivot():
+    df = flows()
+    net = directional_flows(encode_flows(df[df["age"].between(5, 10)], col_age="age"), {
+        "region": hierarchy_map(REGION_LOOKUP, "region_code"),
+        "inner_outer": hierarchy_map(IO_LOOKUP, "io_london"),
+    })
+
+    expected = net.melt(id_vars=["gss_code", "origin_destination_code", "age", "year"],
+                        value_vars=["inflow", "outflow", "netflow"], var_name="direction", value_name="value") \
+                  .pivot_table(index=["gss_code", "origin_destination_code", "direction", "year"],
+                               columns="age", values="value", fill_value=0).reset_index()
+    expected.columns.name = None
+
+    pd.testing.assert_frame_equal(wide_by_age(net), expected, check_dtype=False)
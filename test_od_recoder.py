@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+gsscoder_python = pytest.importorskip("gsscoder_python")
+from gsscoder_python import recode_gss
+
+from flow_schema import conform_frame
+from od_recoder import recode_od
+
+GSS_OLD_YEAR = 2021
+GSS_NEW_YEAR = 2023
+
+# 2021 codes merged in 2023 (Cumbria, North Yorkshire, Somerset), unchanged LADs, and non-E0/W0 codes
+CODES = [
+    "E07000026", "E07000027", "E07000028", "E07000029", "E07000030", "E07000031",
+    "E07000163", "E07000164", "E07000187", "E07000188",
+    "E09000001", "E06000001", "W06000001", "S92000003", "N92000002",
+]
+
+def two_call_recode(df_old):
+    """The step4 recode this replaces: recode_gss on the E0/W0 rows of gss_in, then of gss_out"""
+    df_in_gss = df_old[df_old['gss_in'].str.contains("E0|W0")]
+    df_not_in_gss = df_old[~df_old['gss_in'].str.contains("E0|W0")]
+    df_in_gss = recode_gss(df_in=df_in_gss, col_code='gss_in', col_data='value', fun='sum',
+                           recode_from_year=GSS_OLD_YEAR, recode_to_year=GSS_NEW_YEAR)
+    df_old_recoded_in = pd.concat([df_in_gss, df_not_in_gss], ignore_index=True)
+
+    df_out_gss = df_old_recoded_in[df_old_recoded_in['gss_out'].str.contains("E0|W0")]
+    df_not_out_gss = df_old_recoded_in[~df_old_recoded_in['gss_out'].str.contains("E0|W0")]
+    df_out_gss = recode_gss(df_in=df_out_gss, col_code='gss_out', col_data='value', fun='sum',
+                            recode_from_year=GSS_OLD_YEAR, recode_to_year=GSS_NEW_YEAR)
+    return pd.concat([df_out_gss, df_not_out_gss], ignore_index=True)
+
+def old_series(rows=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "gss_in": rng.choice(CODES, rows),
+        "gss_out": rng.choice(CODES, rows),
+        "year": rng.integers(2002, 2012, rows),
+        "age": rng.integers(0, 91, rows),
+        "sex": rng.choice(["female", "male"], rows),
+        "value": rng.random(rows).round(3),
+    })
+    return df.drop_duplicates(["gss_in", "gss_out", "year", "age", "sex"], ignore_index=True)
+
+def sorted_rows(df):
+    keys = ["gss_in", "gss_out", "year", "age", "sex"]
+    return df.sort_values(keys).reset_index(drop=True)
+
+def test_recode_od_matches_two_recode_gss_calls():
+    df_old = old_series()
+
+    expected = two_call_recode(df_old)
+    result = recode_od(df_old, GSS_OLD_YEAR, GSS_NEW_YEAR)
+
+    assert list(result.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(sorted_rows(result), sorted_rows(expected))
+
+def test_recode_od_leaves_non_recodable_rows_untouched():
+    df_old = old_series()
+    untouched = df_old[~df_old["gss_in"].str.contains("E0|W0") & ~df_old["gss_out"].str.contains("E0|W0")]
+
+    result = recode_od(df_old, GSS_OLD_YEAR, GSS_NEW_YEAR)
+
+    pd.testing.assert_frame_equal(result.tail(len(untouched)).reset_index(drop=True),
+                                  untouched.reset_index(drop=True))
+
+def test_recode_od_keeps_compact_codes_categorical():
+    df_old = old_series()
+    compact = conform_frame(df_old)
+
+    result = recode_od(compact, GSS_OLD_YEAR, GSS_NEW_YEAR)
+
+    assert isinstance(result["gss_in"].dtype, pd.CategoricalDtype)
+    assert isinstance(result["gss_out"].dtype, pd.CategoricalDtype)
+    expected = recode_od(df_old, GSS_OLD_YEAR, GSS_NEW_YEAR)
+    pd.testing.assert_frame_equal(sorted_rows(result.astype({"gss_in": str, "gss_out": str, "sex": str})),
+                                  sorted_rows(conform_frame(expected).astype({"gss_in": str, "gss_out": str, "sex": str})))
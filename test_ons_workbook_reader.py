@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+import ons_workbook_reader
+from ons_workbook_reader import read_detailed_estimates, to_long_format
+
+ENGINES = ["openpyxl", pytest.param("calamine", marks=pytest.mark.skipif(
+    ons_workbook_reader.CalamineWorkbook is None, reason="python-calamine is not installed"))]
+
+def write_workbook(path):
+    """Detailed estimates on the fifth sheet, with blank, incomplete and footnote rows among the data"""
+    workbook = Workbook(write_only=True)
+    for i in range(4):
+        workbook.create_sheet(f"Contents {i}").append(["Notes"])
+    sheet = workbook.create_sheet("Table 4")
+    sheet.append(["OutLA", "InLA", "Sex", "Year", "Age_0", "Age_1", "Age_2"])
+    sheet.append(["E09000001", "E09000002", "F", 2012, 3, 0, 1.5])
+    sheet.append([])
+    sheet.append(["E09000002", "E09000001", "M", 2012, None, 2, 0])  # incomplete: dropped
+    sheet.append(["E09000002", "E06000001", "M", 2013, 0, 0, 0])
+    sheet.append(["E06000001", "W06000001", "F", 2013, 0.25, 7, 0])
+    sheet.append([])
+    sheet.append(["Source: Office for National Statistics"])
+    sheet.append(["Note 1", "Figures are rounded"])
+    workbook.save(path)
+    return str(path)
+
+def expected_frame(path):
+    return pd.read_excel(path, sheet_name=4).dropna().reset_index(drop=True)
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_reader_matches_read_excel_dropna(tmp_path, engine):
+    path = write_workbook(tmp_path / "estimates.xlsx")
+
+    result = read_detailed_estimates(path, engine=engine, batch_size=2).read_all().to_pandas()
+
+    pd.testing.assert_frame_equal(result, expected_frame(path), check_dtype=False)
+    assert str(result["Year"].dtype) == "int64" and str(result["Age_0"].dtype) == "float64"
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_long_format_matches_a_pandas_melt(tmp_path, engine):
+    path = write_workbook(tmp_path / "estimates.xlsx")
+    wide = expected_frame(path)
+    melted = wide.melt(id_vars=["OutLA", "InLA", "Sex", "Year"], var_name="age", value_name="value")
+    melted = melted[melted["value"] != 0]
+    expected = pd.DataFrame({
+        "gss_out": melted["OutLA"], "gss_in": melted["InLA"], "sex": melted["Sex"].map({"F": "female", "M": "male"}),
+        "year": melted["Year"].astype(int), "age": melted["age"].str[4:].astype(int), "value": melted["value"].astype(float),
+    }).sort_values(["gss_out", "gss_in", "year", "age"], ignore_index=True)
+
+    batches = [to_long_format(batch) for batch in read_detailed_estimates(path, engine=engine, batch_size=2)]
+    result = pd.concat([batch.to_pandas() for batch in batches], ignore_index=True)
+    result = result.astype({"gss_out": str, "gss_in": str, "sex": str, "year": int, "age": int})
+    result = result.sort_values(["gss_out", "gss_in", "year", "age"], ignore_index=True)
+
+    pd.testing.assert_frame_equal(result, expected)
@@ -0,0 +1,143 @@
+import io
+
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pytest
+from moto import mock_aws
+from openpyxl import Workbook
+
+import geography_registry
+import pipeline
+from storage import LocalStorage, S3Storage, parse_s3_path
+from test_step1_scraper import DATASET_PATH, RELEASES, FakeONS, ons_server  # noqa: F401 (fixture)
+
+LADS = ["E09000001", "E09000002", "E06000001", "W06000001"]
+
+@pytest.fixture(params=["local", "s3"])
+def store(request, tmp_path, monkeypatch):
+    if request.param == "local":
+        yield LocalStorage(str(tmp_path / "root"))
+        return
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="bkt")
+        yield S3Storage("bkt", "root", client)
+
+def workbook(year):
+    buffer = io.BytesIO()
+    book = Workbook(write_only=True)
+    for i in range(4):
+        book.create_sheet(f"Contents {i}").append(["Notes"])
+    sheet = book.create_sheet("Table 4")
+    sheet.append(["OutLA", "InLA", "Sex", "Year", "Age_0", "Age_1"])
+    sheet.append(["E09000001", "E06000001", "F", year, 3, 1])
+    sheet.append(["E06000001", "W06000001", "M", year, 2, 0])
+    book.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+def test_parse_s3_path():
+    assert parse_s3_path("s3://bkt/a/b.parquet") == ("bkt", "a/b.parquet")
+    assert parse_s3_path("s3://bkt") == ("bkt", "")
+    with pytest.raises(ValueError):
+        parse_s3_path("/local/path")
+
+def test_storage_round_trip(store):
+    table = pa.table({"year": [2012, 2013], "value": [1.0, 2.0]})
+    assert not store.exists("a/t.parquet")
+    store.write_table(table, "a/t.parquet")
+    store.put_fileobj(io.BytesIO(b"xlsx"), "a/w.xlsx")
+    assert store.exists("a/t.parquet")
+    assert store.list("a/") == ["a/t.parquet", "a/w.xlsx"]
+    assert store.list("a/", suffixes=(".xlsx",)) == ["a/w.xlsx"]
+    assert store.read_table("a/t.parquet", filters=[("year", "=", 2013)]).to_pydict() == {"year": [2013], "value": [2.0]}
+    with store.local_path("a/w.xlsx") as path, open(path, "rb") as f:
+        assert f.read() == b"xlsx"
+
+def test_runner_passes_tables_and_resumes_from_checkpoints(store):
+    for year in (2012, 2013):
+        store.put_fileobj(workbook(year), f"{pipeline.RAW_PREFIX}detailedestimates{year}on2021and2023las.xlsx")
+
+    runner = pipeline.PipelineRunner(store, checkpoints=["new_series"])
+    assert runner.plan(["new_series"]) == [("raw_workbooks", "run"), ("cleaned_releases", "run"), ("new_series", "run")]
+    table = runner.run(["new_series"])["new_series"]
+    assert table.schema == pipeline.LONG_SCHEMA
+    assert sorted(set(table.column("year").to_pylist())) == [2012, 2013]
+    assert table.num_rows == 6  # zero flows are dropped
+    assert store.list(pipeline.CHECKPOINT_PREFIX) == ["checkpoints/new_series.parquet"]
+
+    def fail(run, **upstream):
+        raise AssertionError("a checkpointed step and its upstream steps should not run")
+
+    resumed = pipeline.PipelineRunner(store, checkpoints=["new_series"],
+                                      steps={name: (upstream, fail) for name, (upstream, _) in pipeline.STEPS.items()})
+    assert resumed.plan(["new_series"]) == [("new_series", "load")]
+    assert resumed.run(["new_series"])["new_series"].equals(table)
+    assert resumed.plan(["new_series"], force=["new_series"])[-1] == ("new_series", "run")
+
+def test_downstream_steps_share_one_in_memory_table(tmp_path, monkeypatch):
+    lookups = {
+        "region": pd.DataFrame({"lad_code": LADS, "region_code": ["E12000007", "E12000007", "E12000001", "W92000004"],
+                                "country_code": ["E92000001"] * 3 + ["W92000004"]}),
+        "country": pd.DataFrame({"lad_code": LADS, "country_code": ["E92000001"] * 3 + ["W92000004"]}),
+        "inner_outer": pd.DataFrame({"lad_code": LADS, "io_london": ["E13000001", "E13000002", "other", "other"]}),
+    }
+    for name, lookup in lookups.items():
+        lookup.to_csv(tmp_path / f"{name}.csv", index=False)
+    monkeypatch.setattr(geography_registry, "LOOKUP_REGION", str(tmp_path / "region.csv"))
+    monkeypatch.setattr(geography_registry, "LOOKUP_COUNTRY", str(tmp_path / "country.csv"))
+    monkeypatch.setattr(geography_registry, "LOOKUP_INNER_OUTER", str(tmp_path / "inner_outer.csv"))
+
+    combined = pa.table({
+        "gss_in": ["E09000002", "E06000001", "E09000001"], "gss_out": ["E09000001", "E09000001", "W06000001"],
+        "sex": ["female", "male", "female"], "year": [2012, 2012, 2013], "age": [3, 20, 5], "value": [1.0, 2.0, 4.0],
+    })
+    calls = []
+    steps = dict(pipeline.STEPS, new_series=((), lambda run: None),
+                 combined_series=(("new_series",), lambda run, new_series: calls.append(1) or combined))
+    store = LocalStorage(str(tmp_path / "root"))
+    runner = pipeline.PipelineRunner(store, checkpoints=["geographies"], steps=steps)
+
+    results = runner.run(["geographies", "children_flows"])
+
+    assert calls == [1]
+    assert set(results["geographies"]) == {"lad_gross_flows", "region_od_series", "ctry_od_series",
+                                           "inner_outer_london_od_data", "ctry_region_gross_flows"}
+    net = results["children_flows"]["in_out_net_flows"].to_pandas()
+    assert set(net["age"]) == {3, 5}  # age 20 is outside the children's band
+    assert store.list(pipeline.CHECKPOINT_PREFIX) == sorted(
+        f"checkpoints/geographies/{name}.parquet" for name in results["geographies"])
+
+def test_denominator_is_kept_under_the_pipeline_root(store, tmp_path, monkeypatch):
+    import step6_downloading_denominator as step6
+    from denominator_store import ensure_store
+    from test_denominator_store import population
+
+    monkeypatch.setattr(pipeline, "TMP_DIR", str(tmp_path / "tmp"))
+    monkeypatch.setattr(step6, "ensure_store", lambda source, path: ensure_store(source, path, lambda _: population()))
+    store.put_fileobj(io.BytesIO(b"rds"), f"{pipeline.DENOMINATOR_PREFIX}population_coc.rds")
+
+    result = pipeline.PipelineRunner(store).run(["denominator"])["denominator"]
+
+    assert store.list(pipeline.DENOMINATOR_PREFIX) == ["denominator/population_coc.parquet", "denominator/population_coc.rds"]
+    assert len(result.lookup(gss_codes=["E09000001"], years=[2020])) == 91 * 2
+
+def test_scrape_downloads_only_new_or_revised_releases(store, ons_server, monkeypatch):
+    import step1_ons_scraper as step1
+    monkeypatch.setattr(step1, "BASE_URL", ons_server + DATASET_PATH)
+    runner = pipeline.PipelineRunner(store, scrape=True)
+    names = [path.split("/")[-1] for path in RELEASES]
+
+    assert runner.run(["raw_workbooks"])["raw_workbooks"] == [f"{pipeline.RAW_PREFIX}{name}" for name in names]
+
+    revised = next(iter(RELEASES))
+    FakeONS.files[revised], FakeONS.etags[revised] = b"revised", '"v2"'  # republished under the same name
+    results = pipeline.scrape_releases(store)
+
+    assert [r["status"] for r in results] == ["downloaded", "unchanged"]
+    with store.local_path(f"{pipeline.RAW_PREFIX}{names[0]}") as path, open(path, "rb") as f:
+        assert f.read() == b"revised"
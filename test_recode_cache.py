@@ -0,0 +1,65 @@
+import os
+
+import pandas as pd
+
+from recode_cache import LocalCacheStore, entry_key, evict, load_or_build, recoded_series_key
+
+def test_key_changes_with_every_input():
+    base = recoded_series_key("etag", 2021, 2023, 2012, ["gss_in"])
+    assert base == recoded_series_key("etag", 2021, 2023, 2012, ["gss_in"])
+    assert base != recoded_series_key("etag2", 2021, 2023, 2012, ["gss_in"])
+    assert base != recoded_series_key("etag", 2021, 2024, 2012, ["gss_in"])
+    assert base != recoded_series_key("etag", 2021, 2023, 2013, ["gss_in"])
+
+def test_load_or_build_only_builds_on_a_miss(tmp_path):
+    store = LocalCacheStore(str(tmp_path))
+    calls = []
+
+    def build():
+        calls.append(1)
+        return pd.DataFrame({"gss_in": ["E06000063"], "value": [1.5]})
+
+    first = load_or_build(store, "abc", build)
+    second = load_or_build(store, "abc", build)
+
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(first, second)
+
+def test_evict_keeps_current_and_newest_entries(tmp_path):
+    store = LocalCacheStore(str(tmp_path))
+    df = pd.DataFrame({"value": [1.0]})
+    for age, key in enumerate(["newest", "older", "oldest", "current"]):
+        store.save(key, df)
+        os.utime(store.path(key), (1000 - age, 1000 - age))
+
+    evict(store, "current", max_entries=2)
+
+    assert sorted(key for key, _ in store.entries()) == ["current", "newest"]
+
+def test_year_slices_are_built_and_stored_on_their_own(tmp_path):
+    store = LocalCacheStore(str(tmp_path))
+    series = pd.DataFrame({"year": [2002, 2003, 2004], "value": [1.0, 2.0, 3.0]})
+    built = []
+
+    def build(years):
+        built.append(years)
+        return series[series["year"].isin(years)].reset_index(drop=True)
+
+    for years in ([2002], [2003, 2004], [2002]):
+        expected = series[series["year"].isin(years)].reset_index(drop=True)
+        pd.testing.assert_frame_equal(load_or_build(store, "abc", lambda: build(years), years=years), expected)
+
+    assert built == [[2002], [2003, 2004]]  # the repeated slice was a hit
+    assert sorted(key for key, _ in store.entries()) == [entry_key("abc", [2002]), entry_key("abc", [2003, 2004])]
+
+def test_evict_drops_stale_keys_with_all_their_slices(tmp_path):
+    store = LocalCacheStore(str(tmp_path))
+    df = pd.DataFrame({"value": [1.0]})
+    entries = [entry_key("old", [2002]), entry_key("old", [2003]), "older", entry_key("current", [2002])]
+    for age, entry in enumerate(entries):
+        store.save(entry, df)
+        os.utime(store.path(entry), (1000 - age, 1000 - age))
+
+    evict(store, "current", max_entries=2)
+
+    assert sorted(key for key, _ in store.entries()) == sorted(entries[:2] + entries[3:])
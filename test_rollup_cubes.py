@@ -0,0 +1,65 @@
+import pyarrow.parquet as pq
+import pytest
+
+from od_aggregation import TOTAL_CODE, hierarchy_map
+from rollup_cubes import FlowCubes, age_bands, build_cubes, cube_name
+from storage import LocalStorage
+from test_flow_scan import write_flows
+from test_od_aggregation import IO_LOOKUP, REGION_LOOKUP, flows
+
+HIERARCHIES = {
+    "region": hierarchy_map(REGION_LOOKUP, "region_code"),
+    "country": hierarchy_map(REGION_LOOKUP.assign(country_code=REGION_LOOKUP["lad_code"].str[0] + "92000001"),
+                             "country_code"),
+    "inner_outer": hierarchy_map(IO_LOOKUP, "io_london"),
+}
+
+@pytest.fixture
+def cubes(tmp_path):
+    df = flows()
+    store = LocalStorage(str(tmp_path / "root"))
+    build_cubes(write_flows(df, tmp_path / "flows"), store, HIERARCHIES)
+    return df, store, FlowCubes(store)
+
+def expected(df, keys):
+    return df.groupby(keys)["value"].sum().reset_index()
+
+def test_cubes_sum_to_the_raw_flows(cubes):
+    df, store, flow_cubes = cubes
+    full = store.read_table(flow_cubes.cubes[cube_name(("lad", "lad", "single", True))]["key"]).to_pandas()
+    assert len(full) == len(df.groupby(["year", "gss_in", "gss_out", "age", "sex"]))
+    assert full["value"].sum() == pytest.approx(expected(df, ["year"])["value"].sum())
+
+    region = df.assign(region=df["gss_in"].map(HIERARCHIES["region"])).dropna(subset=["region"])
+    result = flow_cubes.query("all", "region", by_sex=True)
+    want = expected(region, ["year", "region", "sex"])
+    assert set(result["gss_out"]) == {TOTAL_CODE}
+    assert result["gss_in"].tolist() == want["region"].tolist()
+    assert result["value"].to_numpy() == pytest.approx(want["value"].to_numpy())
+
+def test_flows_into_a_borough_reads_the_smallest_cube(cubes, capsys):
+    df, _, flow_cubes = cubes
+    result = flow_cubes.flows_into(["E09000001"], years=range(2005, 2011), by_age="single")
+
+    assert f"Reading {cube_name(('all', 'lad', 'single', True))}" in capsys.readouterr().out
+    want = expected(df[(df["gss_in"] == "E09000001") & df["year"].between(2005, 2010)], ["year", "age"])
+    assert result[["year", "age"]].values.tolist() == want[["year", "age"]].values.tolist()
+    assert result["value"].to_numpy() == pytest.approx(want["value"].to_numpy())
+
+    banded = flow_cubes.flows_into(["E09000001"], by_age="band", age_range=(0, 19))
+    assert f"Reading {cube_name(('all', 'lad', 'band', False))}" in capsys.readouterr().out
+    assert set(banded["age_band"]) == set(age_bands()[:4])
+    assert banded["value"].sum() == pytest.approx(
+        expected(df[(df["gss_in"] == "E09000001") & (df["age"] < 20)], ["year"])["value"].sum())
+
+    with pytest.raises(ValueError):
+        flow_cubes.query("country", "lad")
+
+def test_cubes_are_sorted_with_bloom_filters_on_gss_columns(cubes):
+    _, store, flow_cubes = cubes
+    metadata = pq.ParquetFile(store.uri(flow_cubes.cubes[cube_name(("lad", "lad", "single", True))]["key"])).metadata
+    row_group = metadata.row_group(0)
+    assert [column.column_index for column in row_group.sorting_columns] == [0, 1, 2]
+    names = [row_group.column(i).path_in_schema for i in range(row_group.num_columns)]
+    for name in ("gss_in", "gss_out"):
+        assert row_group.column(names.index(name)).to_dict().get("bloom_filter_offset") is not None
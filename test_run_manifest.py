@@ -0,0 +1,137 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pandas as pd
+import pytest
+from moto import mock_aws
+from openpyxl import Workbook
+
+import storage
+import step2_clean_data
+import step3_combine_clean_data
+from run_manifest import load_run_manifest, pending_releases, record_release, release_name, save_run_manifest
+
+BUCKET = "bkt"
+MANIFEST_URI = f"s3://{BUCKET}/_run_manifest.json"
+RAW = "raw/"
+CLEANED = "cleaned/"
+COMBINED_KEY = "combined/combined.parquet"
+EVENT = {"run_manifest_uri": MANIFEST_URI, "incremental": True}
+
+def workbook_bytes(tmp_path, year, value):
+    path = tmp_path / f"{year}.xlsx"
+    workbook = Workbook(write_only=True)
+    for i in range(4):
+        workbook.create_sheet(f"Contents {i}").append(["Notes"])
+    sheet = workbook.create_sheet("Table 4")
+    sheet.append(["OutLA", "InLA", "Sex", "Year", "Age_0", "Age_1"])
+    sheet.append(["E09000001", "E09000002", "F", year, value, 1])
+    sheet.append(["E09000002", "E09000001", "M", year, 2, value])
+    workbook.save(path)
+    return path.read_bytes()
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        for module in (step2_clean_data, step3_combine_clean_data):
+            monkeypatch.setattr(module, "s3", client)
+        monkeypatch.setattr(storage, "_clients", {os.getpid(): client})
+        monkeypatch.setattr(step2_clean_data, "ProcessPoolExecutor", ThreadPoolExecutor)  # moto state is per process
+        yield client
+
+def publish_release(client, tmp_path, year, value):
+    """What step1 does for a new or revised release: upload it and record its ETag"""
+    key = f"{RAW}detailedestimates{year}on2021and2023las.xlsx"
+    etag = client.put_object(Bucket=BUCKET, Key=key, Body=workbook_bytes(tmp_path, year, value))["ETag"].strip('"')
+    manifest = load_run_manifest(client, MANIFEST_URI)
+    record_release(manifest, key, etag)
+    save_run_manifest(client, manifest, MANIFEST_URI)
+
+def run_steps(client):
+    cleaned = step2_clean_data.handler({**EVENT, "input_path": f"s3://{BUCKET}/{RAW}",
+                                        "output_path": f"s3://{BUCKET}/{CLEANED}", "output_format": "parquet"}, None)
+    combined = step3_combine_clean_data.handler({**EVENT, "input_path": f"s3://{BUCKET}/{CLEANED}",
+                                                 "output_path": f"s3://{BUCKET}/{COMBINED_KEY}",
+                                                 "input_format": "parquet"}, None)
+    return cleaned, combined
+
+def combined_rows(client, tmp_path):
+    path = tmp_path / "combined.parquet"
+    client.download_file(BUCKET, COMBINED_KEY, str(path))
+    return pd.read_parquet(path)
+
+def test_release_names_match_across_steps():
+    assert release_name("raw/detailedestimates2012on2021and2023las.xlsx") == "detailedestimates2012on2023las"
+    assert release_name("cleaned/detailedestimates2012on2023las.parquet") == "detailedestimates2012on2023las"
+
+def test_only_new_releases_are_cleaned_and_combined(s3, tmp_path):
+    publish_release(s3, tmp_path, 2012, 5)
+    publish_release(s3, tmp_path, 2013, 6)
+    cleaned, combined = run_steps(s3)
+    assert cleaned["files_processed"] == 2
+    assert combined["mode"] == "full" and combined["files_combined"] == 2
+
+    # ONS revises 2013 and publishes 2014: only those two are cleaned and appended
+    publish_release(s3, tmp_path, 2013, 60)
+    publish_release(s3, tmp_path, 2014, 7)
+    cleaned, combined = run_steps(s3)
+    assert cleaned["files_processed"] == 2
+    assert combined["mode"] == "incremental" and combined["files_combined"] == 2
+
+    df = combined_rows(s3, tmp_path)
+    assert sorted(df.groupby("year").size().items()) == [(2012, 4), (2013, 4), (2014, 4)]
+    assert set(df.loc[df["year"] == 2013, "value"]) == {60.0, 1.0, 2.0}
+
+    manifest = load_run_manifest(s3, MANIFEST_URI)
+    assert pending_releases(manifest, "combine") == []
+    assert pending_releases(manifest, "publish") == [
+        "detailedestimates2012on2023las", "detailedestimates2013on2023las", "detailedestimates2014on2023las"]
+    assert manifest["releases"]["detailedestimates2014on2023las"]["years"] == [2014]
+
+def test_rerun_without_new_releases_is_a_no_op(s3, tmp_path):
+    publish_release(s3, tmp_path, 2012, 5)
+    run_steps(s3)
+    before = s3.get_object(Bucket=BUCKET, Key=COMBINED_KEY)["ETag"]
+    manifest_before = json.loads(s3.get_object(Bucket=BUCKET, Key="_run_manifest.json")["Body"].read())
+
+    cleaned, combined = run_steps(s3)
+
+    assert cleaned["files_processed"] == 0
+    assert combined["status"] == "up to date"
+    assert s3.get_object(Bucket=BUCKET, Key=COMBINED_KEY)["ETag"] == before
+    assert json.loads(s3.get_object(Bucket=BUCKET, Key="_run_manifest.json")["Body"].read()) == manifest_before
+
+def test_step4_rewrites_only_the_affected_partitions(s3, tmp_path, monkeypatch):
+    pytest.importorskip("gsscoder_python")
+    import step4_combine_series as step4
+    monkeypatch.setattr(step4, "BUCKET_NAME", BUCKET)
+    monkeypatch.setattr(step4, "S3_NEW_SERIES_PATH", COMBINED_KEY)
+    monkeypatch.setattr(step4, "OUTPUT_PARQUET_PREFIX", "published")
+    monkeypatch.setattr(step4, "TMP_DIR", str(tmp_path))
+    event = {**EVENT, "write_mode": "staged"}
+
+    def partitions():
+        listing = s3.list_objects_v2(Bucket=BUCKET, Prefix="published/")["Contents"]
+        return {obj["Key"]: obj["ETag"] for obj in listing}
+
+    publish_release(s3, tmp_path, 2012, 5)
+    publish_release(s3, tmp_path, 2013, 6)
+    run_steps(s3)
+    assert step4.handler(event, None) == {"status": "done", "mode": "incremental", "years_written": 2}
+    first = partitions()
+
+    publish_release(s3, tmp_path, 2013, 60)
+    run_steps(s3)
+    assert step4.handler(event, None)["years_written"] == 1
+    second = partitions()
+    assert set(second) == set(first)
+    assert [key for key in first if first[key] != second[key]] == ["published/year=2013/part-0.parquet"]
+
+    assert step4.handler(event, None) == {"status": "up to date", "years_written": 0}
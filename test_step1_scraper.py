@@ -1,10 +1,119 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+import pytest
+from boto3.s3.transfer import TransferConfig
+from moto import mock_aws
+
+import step1_ons_scraper
 from step1_ons_scraper import lambda_handler
 
 mock_event = {}
 mock_context = {}
 
+DATASET_PATH = "/datasets/internalmigrationinenglandandwales/"
+RELEASES = {
+    "/file?uri=/detailedinternalmigrationestimates/2022/detailedestimates2022on2023las.xlsx": b"2022" * 1000,
+    "/file?uri=/detailedinternalmigrationestimates/2023/detailedestimates2023on2023las.xlsx": b"2023" * 1000,
+}
+
+class FakeONS(BaseHTTPRequestHandler):
+    """Serves the dataset page and release files, honouring If-None-Match"""
+    files = {}
+    etags = {}
+    requests_seen = []
+
+    def do_GET(self):
+        self.requests_seen.append(self.path)
+        if self.path == DATASET_PATH:
+            links = "".join(f'<a href="{path}">release</a>' for path in self.files)
+            return self.respond(200, f"<html><body>{links}<a href='/other.xlsx'>x</a></body></html>".encode())
+        if self.path not in self.files:
+            return self.respond(404, b"")
+        etag = self.etags[self.path]
+        if self.headers.get("If-None-Match") == etag:
+            return self.respond(304, b"")
+        self.respond(200, self.files[self.path], {"ETag": etag, "Last-Modified": "Wed, 01 Oct 2025 09:30:00 GMT"})
+
+    def respond(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def ons_server():
+    FakeONS.files = dict(RELEASES)
+    FakeONS.etags = {path: '"v1"' for path in RELEASES}
+    FakeONS.requests_seen = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeONS)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=step1_ons_scraper.bucket_name)
+        monkeypatch.setattr(step1_ons_scraper, "s3", client)
+        yield client
+
+@pytest.fixture
+def scraper(ons_server, s3_bucket, monkeypatch):
+    monkeypatch.setattr(step1_ons_scraper, "BASE_URL", ons_server + DATASET_PATH)
+    return s3_bucket
+
+def raw_object(client, filename):
+    key = f"{step1_ons_scraper.RAW_PREFIX}{filename}"
+    return client.get_object(Bucket=step1_ons_scraper.bucket_name, Key=key)
+
+def test_downloads_releases_into_s3(scraper):
+    result = lambda_handler(mock_event, mock_context)
+
+    assert len(result["new_releases"]) == 2
+    assert result["unchanged"] == []
+    obj = raw_object(scraper, "detailedestimates2022on2023las.xlsx")
+    assert obj["Body"].read() == b"2022" * 1000
+    assert obj["Metadata"][step1_ons_scraper.ETAG_METADATA] == '"v1"'
+    assert not os.path.exists("test_data")
+
+def test_skips_releases_already_in_s3(scraper):
+    lambda_handler(mock_event, mock_context)
+    FakeONS.etags[next(iter(RELEASES))] = '"v2"'
+    FakeONS.files[next(iter(RELEASES))] = b"revised"
+
+    result = lambda_handler(mock_event, mock_context)
+
+    assert [uri.split("/")[-1] for uri in result["new_releases"]] == ["detailedestimates2022on2023las.xlsx"]
+    assert [uri.split("/")[-1] for uri in result["unchanged"]] == ["detailedestimates2023on2023las.xlsx"]
+    assert raw_object(scraper, "detailedestimates2022on2023las.xlsx")["Body"].read() == b"revised"
+
+def test_large_release_uses_multipart_upload(scraper, monkeypatch):
+    part_size = 5 * 1024 * 1024
+    path = next(iter(RELEASES))
+    FakeONS.files[path] = os.urandom(2 * part_size + 10)
+    monkeypatch.setattr(step1_ons_scraper, "TRANSFER_CONFIG",
+                        TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size))
+
+    lambda_handler(mock_event, mock_context)
+
+    obj = raw_object(scraper, "detailedestimates2022on2023las.xlsx")
+    assert obj["ETag"].strip('"').endswith("-3")
+    assert obj["Body"].read() == FakeONS.files[path]
+
 if __name__ == "__main__":
     result = lambda_handler(mock_event, mock_context)
     for link in result['download_links']:
         print(link)
-
@@ -1,9 +1,70 @@
 # test_clean_data.py
-from step2_clean_data import handler
-
-mock_event = {
-    "input_path": "s3://dpa-population-projection-data/population_mid_year_estimates/ons_data/raw/",
-    "output_path": "s3://dpa-population-projection-data/population_mid_year_estimates/ons_data/cleaned_data/"
-}
-result = handler(mock_event, None)
-print(result)
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import step2_clean_data
+import storage
+from step2_clean_data import MANIFEST_NAME, handler, is_unchanged
+from test_run_manifest import workbook_bytes
+
+BUCKET = "bkt"
+EVENT = {"input_path": f"s3://{BUCKET}/raw/", "output_path": f"s3://{BUCKET}/cleaned/",
+         "run_manifest_uri": f"s3://{BUCKET}/_run_manifest.json"}
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        monkeypatch.setattr(step2_clean_data, "s3", client)
+        monkeypatch.setattr(storage, "_clients", {os.getpid(): client})
+        monkeypatch.setattr(step2_clean_data, "ProcessPoolExecutor", ThreadPoolExecutor)  # moto state is per process
+        yield client
+
+def upload(client, tmp_path, year, value):
+    client.put_object(Bucket=BUCKET, Key=f"raw/detailedestimates{year}on2021and2023las.xlsx",
+                      Body=workbook_bytes(tmp_path, year, value))
+
+def test_is_unchanged_compares_etag_size_and_format():
+    source = {"key": "raw/a.xlsx", "etag": '"abc"', "size": 10}
+    manifest = {"raw/a.xlsx": {"etag": '"abc"', "size": 10, "output_format": "csv"}}
+    assert is_unchanged(source, manifest)
+    assert not is_unchanged({**source, "etag": '"abd"'}, manifest)
+    assert not is_unchanged({**source, "size": 11}, manifest)
+    assert not is_unchanged(source, manifest, output_format="parquet")
+    assert not is_unchanged({**source, "key": "raw/b.xlsx"}, manifest)
+    assert is_unchanged(source, {"raw/a.xlsx": {"etag": '"abc"', "size": 10}})  # entries from before output_format
+
+def test_unchanged_workbooks_are_skipped_until_forced_or_changed(s3, tmp_path):
+    upload(s3, tmp_path, 2012, 5)
+    upload(s3, tmp_path, 2013, 6)
+    assert handler(EVENT, None) == {"status": "done", "files_processed": 2, "files_skipped": 0}
+
+    manifest = json.loads(s3.get_object(Bucket=BUCKET, Key=f"cleaned/{MANIFEST_NAME}")["Body"].read())
+    raw = {obj["Key"]: obj for obj in s3.list_objects_v2(Bucket=BUCKET, Prefix="raw/")["Contents"]}
+    assert {key: (entry["etag"], entry["size"]) for key, entry in manifest.items()} == {
+        key: (obj["ETag"], obj["Size"]) for key, obj in raw.items()}
+
+    assert handler(EVENT, None) == {"status": "done", "files_processed": 0, "files_skipped": 2}
+    assert handler({**EVENT, "force": True}, None) == {"status": "done", "files_processed": 2, "files_skipped": 0}
+
+    upload(s3, tmp_path, 2013, 60000)  # a revised release: new ETag and size
+    assert handler(EVENT, None) == {"status": "done", "files_processed": 1, "files_skipped": 1}
+    cleaned = s3.get_object(Bucket=BUCKET, Key="cleaned/detailedestimates2013on2023las.csv")["Body"].read()
+    assert b"60000" in cleaned
+
+if __name__ == "__main__":
+    mock_event = {
+        "input_path": "s3://dpa-population-projection-data/population_mid_year_estimates/ons_data/raw/",
+        "output_path": "s3://dpa-population-projection-data/population_mid_year_estimates/ons_data/cleaned_data/"
+    }
+    result = handler(mock_event, None)
+    print(result)
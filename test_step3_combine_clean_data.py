@@ -1,8 +1,61 @@
+import boto3
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from moto import mock_aws
+
+import step3_combine_clean_data
+from instrumentation import stage
 from step3_combine_clean_data import handler
 
-event = {
-    "input_path": "s3://dpa-population-projection-data/population_mid_year_estimates/ons_data/cleaned_data/",
-    "output_path": "s3://dpa-population-projection-data/population_mid_year_estimates/ons_data/cleaned_data_combined/cleaned_data_combined.parquet"
-}
+BUCKET = "bkt"
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        monkeypatch.setattr(step3_combine_clean_data, "s3", client)
+        yield client
+
+def upload_csv(client, key, year, rows):
+    body = pd.DataFrame({"OutLA": "E09000001", "InLA": "E09000002", "Sex": "F", "Year": year,
+                         "Age_0": range(rows), "Age_1": 1}).to_csv(index=False)
+    client.put_object(Bucket=BUCKET, Key=key, Body=body.encode())
+    return {"key": key, "etag": ""}
+
+def test_small_batches_are_written_as_full_row_groups(s3, tmp_path):
+    files = [upload_csv(s3, f"cleaned/{year}.csv", year, 1000) for year in (2012, 2013, 2014)]
+    output = tmp_path / "combined.parquet"
+
+    with stage("combine") as combine:
+        rows, years = step3_combine_clean_data.combine_files(files, BUCKET, "csv", str(output), 1200, combine)
+
+    metadata = pq.ParquetFile(output).metadata
+    assert rows == 3000 and years["cleaned/2013.csv"] == {2013}
+    assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [1200, 1200, 600]
+    assert pd.read_parquet(output)["age_0"].tolist() == list(range(1000)) * 3
+
+def test_incremental_combine_refuses_files_without_years(s3, tmp_path):
+    previous = tmp_path / "previous.parquet"
+    with stage("combine") as combine:
+        step3_combine_clean_data.combine_files([upload_csv(s3, "cleaned/2012.csv", 2012, 10)], BUCKET, "csv",
+                                               str(previous), 1200, combine)
+    no_year = pd.DataFrame({"OutLA": ["E09000001"], "InLA": ["E09000002"], "Sex": ["F"], "Age_0": [5]})
+    s3.put_object(Bucket=BUCKET, Key="cleaned/revised.csv", Body=no_year.to_csv(index=False).encode())
+
+    with stage("combine") as combine, pytest.raises(ValueError, match="cleaned/revised.csv"):
+        step3_combine_clean_data.combine_files([{"key": "cleaned/revised.csv", "etag": ""}], BUCKET, "csv",
+                                               str(tmp_path / "combined.parquet"), 1200, combine, str(previous))
+    assert len(pd.read_parquet(previous)) == 10  # the previous combined file is left as it was
+
+if __name__ == "__main__":
+    event = {
+        "input_path": "s3://dpa-population-projection-data/population_mid_year_estimates/ons_data/cleaned_data/",
+        "output_path": "s3://dpa-population-projection-data/population_mid_year_estimates/ons_data/cleaned_data_combined/cleaned_data_combined.parquet"
+    }
 
-handler(event, None)
+    handler(event, None)
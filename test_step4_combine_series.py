@@ -1,4 +1,139 @@
+import io
+import os
+import shutil
+import zipfile
+
+import boto3
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+import pytest
+from moto import mock_aws
+
+pytest.importorskip("gsscoder_python")
+
+import step4_combine_series as step4
+import storage
+from flow_schema import to_flow_table
 from step4_combine_series import handler
+from test_od_aggregation import flows
+
+def write_archive(path, compression, payload=None):
+    """ZIP holding one backseries Parquet member whose local header carries an extra field"""
+    buffer = io.BytesIO()
+    pq.write_table(to_flow_table(flows()), buffer, row_group_size=500)
+    info = zipfile.ZipInfo("origin_destination.parquet")
+    info.compress_type = compression
+    info.extra = b"\xca\xfe\x04\x00abcd"  # unknown 4-byte extra field, skipped by member_data_offset
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr(info, payload if payload is not None else buffer.getvalue())
+    return str(path)
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_zip_member_bytes_match_zipfile(tmp_path, monkeypatch, compression):
+    monkeypatch.setattr(step4, "TMP_DIR", str(tmp_path))
+    path = write_archive(tmp_path / "backseries.zip", compression)
+
+    with open(path, "rb") as archive, zipfile.ZipFile(archive) as z:
+        info = z.infolist()[0]
+        expected = z.read(info)
+        with step4.open_zip_member(archive, z, info) as source:
+            if compression == zipfile.ZIP_STORED:
+                assert source.read() == expected
+                source.seek(-100, io.SEEK_END)
+                assert source.read(60) == expected[-100:-40]
+                source.seek(10)
+                assert source.read(5) == expected[10:15]
+            else:  # the fallback inflates the member to a temp file
+                assert isinstance(source, str)
+                with open(source, "rb") as f:
+                    assert f.read() == expected
+
+def test_zip_member_file_reads_like_a_file(tmp_path):
+    payload = bytes(range(256)) * 40
+    path = write_archive(tmp_path / "stored.zip", zipfile.ZIP_STORED, payload)
+
+    with open(path, "rb") as archive, zipfile.ZipFile(archive) as z:
+        info = z.infolist()[0]
+        member = step4.ZipMemberFile(archive, step4.member_data_offset(archive, info), info.file_size)
+        assert member.read(3) == payload[:3] and member.tell() == 3
+        member.seek(5, io.SEEK_CUR)
+        assert member.read(4) == payload[8:12]
+        assert member.seek(info.file_size + 50) == info.file_size and member.read() == b""
+        member.seek(0)
+        assert member.read() == z.read(info)
+
+def test_stored_and_deflated_archives_load_the_same_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(step4, "TMP_DIR", str(tmp_path))
+    stored = step4.load_old_series(write_archive(tmp_path / "stored.zip", zipfile.ZIP_STORED), max_year=2012)
+    deflated = step4.load_old_series(write_archive(tmp_path / "deflated.zip", zipfile.ZIP_DEFLATED), max_year=2012)
+
+    assert len(stored) and stored["year"].max() < 2012
+    assert stored.equals(deflated)
+
+BUCKET = "bkt"
+
+@pytest.fixture
+def destination(monkeypatch, tmp_path):
+    """The S3 output: moto for the staged upload, a local directory behind pafs.S3FileSystem for direct writes"""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(step4, "TMP_DIR", str(tmp_path))
+    monkeypatch.setattr(step4, "BUCKET_NAME", BUCKET)
+    (tmp_path / "direct").mkdir()
+    monkeypatch.setattr(step4.pafs, "S3FileSystem",
+                        lambda: pafs.SubTreeFileSystem(str(tmp_path / "direct"), pafs.LocalFileSystem()))
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        monkeypatch.setattr(storage, "_clients", {os.getpid(): client})
+        yield client
+
+def published_files(client, tmp_path, mode):
+    """{year= partition/file: local path} of the output, downloading the staged upload from moto"""
+    base = tmp_path / "direct" / BUCKET / step4.OUTPUT_PARQUET_PREFIX
+    if mode == "staged":
+        base = tmp_path / "staged_output"
+        shutil.rmtree(base, ignore_errors=True)
+        for obj in client.list_objects_v2(Bucket=BUCKET, Prefix=f"{step4.OUTPUT_PARQUET_PREFIX}/").get("Contents", []):
+            path = base / obj["Key"][len(step4.OUTPUT_PARQUET_PREFIX) + 1:]
+            path.parent.mkdir(parents=True, exist_ok=True)
+            client.download_file(BUCKET, obj["Key"], str(path))
+    return {str(path.relative_to(base)): path for path in sorted(base.rglob("*.parquet"))}
+
+def add_stale_file(client, tmp_path, mode, relative):
+    """A leftover file in a partition, as an earlier write with more files would leave"""
+    if mode == "staged":
+        client.put_object(Bucket=BUCKET, Key=f"{step4.OUTPUT_PARQUET_PREFIX}/{relative}", Body=b"stale")
+    else:
+        (tmp_path / "direct" / BUCKET / step4.OUTPUT_PARQUET_PREFIX / relative).write_bytes(b"stale")
+
+@pytest.mark.parametrize("mode", ["direct", "staged"])
+def test_write_partitioned_replaces_year_partitions_of_sorted_row_groups(destination, tmp_path, mode):
+    table = step4.combine_frames([to_flow_table(flows())])
+
+    assert step4.write_partitioned(table, mode=mode, max_rows_per_group=40) == sorted(set(table["year"].to_pylist()))
+
+    files = published_files(destination, tmp_path, mode)
+    assert sorted({name.split("/")[0] for name in files}) == [f"year={year}" for year in sorted(set(table["year"].to_pylist()))]
+    for name, path in files.items():
+        metadata = pq.ParquetFile(path).metadata
+        assert max(metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)) <= 40
+        for i in range(metadata.num_row_groups):
+            group = pq.ParquetFile(path).read_row_group(i, columns=["gss_in", "gss_out"]).to_pandas().astype(str)
+            keys = list(zip(group["gss_in"], group["gss_out"]))
+            assert keys == sorted(keys), name
+    assert ds.dataset(str(files["year=2010/part-0.parquet"])).count_rows() == len(table.filter(ds.field("year") == 2010))
+
+    add_stale_file(destination, tmp_path, mode, "year=2010/part-9.parquet")
+    revised = table.filter(ds.field("year") == 2010).slice(0, 5)
+    assert step4.write_partitioned(revised, mode=mode, max_rows_per_group=40) == [2010]
+
+    rewritten = published_files(destination, tmp_path, mode)
+    assert [name for name in rewritten if name.startswith("year=2010/")] == ["year=2010/part-0.parquet"]
+    assert pq.read_table(rewritten["year=2010/part-0.parquet"]).num_rows == 5
+    assert set(rewritten) == set(files)  # other years are left as they were
 
 if __name__ == "__main__":
     # Simulated AWS Lambda event
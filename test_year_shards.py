@@ -0,0 +1,123 @@
+import json
+import zipfile
+
+import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+
+pytest.importorskip("gsscoder_python")
+
+import geography_registry
+import step4_combine_series as step4
+import step5_converting_geographies as step5
+import year_shards
+from flow_scan import open_flows
+from flow_schema import to_flow_table
+from test_od_aggregation import IO_LOOKUP, REGION_LOOKUP, flows
+
+NEW_YEARS = [2012, 2013, 2014, 2015]
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    lookups = {
+        "region": REGION_LOOKUP.assign(country_code=REGION_LOOKUP["lad_code"].str[0] + "92000001"),
+        "country": REGION_LOOKUP.assign(country_code=REGION_LOOKUP["lad_code"].str[0] + "92000001"),
+        "inner_outer": IO_LOOKUP,
+    }
+    for name, lookup in lookups.items():
+        lookup.to_csv(tmp_path / f"{name}.csv", index=False)
+    monkeypatch.setattr(geography_registry, "LOOKUP_REGION", str(tmp_path / "region.csv"))
+    monkeypatch.setattr(geography_registry, "LOOKUP_COUNTRY", str(tmp_path / "country.csv"))
+    monkeypatch.setattr(geography_registry, "LOOKUP_INNER_OUTER", str(tmp_path / "inner_outer.csv"))
+    return tmp_path / "root"
+
+def write_new_series(root, df):
+    path = root / step4.S3_NEW_SERIES_PATH
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(to_flow_table(df), path)
+
+def write_backseries(path, df):
+    pq.write_table(to_flow_table(df), path.with_suffix(""))
+    with zipfile.ZipFile(path, "w") as z:
+        z.write(path.with_suffix(""), "backseries.parquet")
+    return str(path)
+
+def new_series(seed=0):
+    df = flows(seed=seed)
+    return df.assign(year=2012 + df["year"] % len(NEW_YEARS))
+
+def test_plan_gives_self_contained_map_tasks(root):
+    write_new_series(root, new_series())
+    manifest = year_shards.plan_shards(str(root), years_per_shard=3)
+
+    assert [task["years"] for task in manifest["tasks"]] == [
+        [2002, 2003, 2004], [2005, 2006, 2007], [2008, 2009, 2010], [2011], [2012, 2013, 2014], [2015]]
+    assert manifest["tasks"][0]["stages"] == ["recode", "combine", "aggregate"]
+    assert manifest["tasks"][-1]["stages"] == ["combine", "aggregate"]
+    for task in manifest["tasks"]:
+        assert {"root", "staging_prefix", "new_series_key", "backseries_uri"} <= set(task)
+    saved = json.loads((root / manifest["staging_prefix"] / "_tasks.json").read_text())
+    assert saved == json.loads(json.dumps(manifest))
+
+def test_sharded_run_matches_a_single_pass(root):
+    df = new_series()
+    write_new_series(root, df)
+
+    manifest = year_shards.plan_shards(str(root), years=NEW_YEARS)
+    assert year_shards.run_local(manifest, workers=2)["years_written"] == len(NEW_YEARS)
+
+    combined = step4.combine_frames([to_flow_table(df)])
+    published = open_flows(str(root / step4.OUTPUT_PARQUET_PREFIX)).to_table()
+    assert published.num_rows == combined.num_rows
+    assert sorted(published["value"].to_pylist()) == sorted(combined["value"].to_pylist())
+
+    expected = step5.output_tables(step5.convert_geographies(ds.dataset(combined), step5.load_hierarchies()))
+    for name, table in expected.items():
+        result = pd.read_parquet(root / year_shards.GEOGRAPHY_OUTPUT_PREFIX / f"{name}.parquet")
+        pd.testing.assert_frame_equal(result.reset_index(drop=True), table.reset_index(drop=True), check_dtype=False)
+    assert not list((root / year_shards.STAGING_PREFIX).rglob("*.parquet"))
+
+def test_rerunning_one_year_keeps_the_other_years(root):
+    write_new_series(root, new_series())
+    year_shards.run_local(year_shards.plan_shards(str(root), years=NEW_YEARS), workers=2)
+    before = pd.read_parquet(root / year_shards.GEOGRAPHY_OUTPUT_PREFIX / "lad_gross_flows.parquet")
+
+    revised = new_series(seed=1)
+    write_new_series(root, revised)
+    year_shards.run_local(year_shards.plan_shards(str(root), years=[2013]), workers=1)
+
+    after = pd.read_parquet(root / year_shards.GEOGRAPHY_OUTPUT_PREFIX / "lad_gross_flows.parquet")
+    pd.testing.assert_frame_equal(after[after["year"] != 2013].reset_index(drop=True),
+                                  before[before["year"] != 2013].reset_index(drop=True))
+    published = open_flows(str(root / step4.OUTPUT_PARQUET_PREFIX)).to_table(filter=ds.field("year") == 2013)
+    assert published.num_rows == step4.combine_frames([to_flow_table(revised[revised["year"] == 2013])]).num_rows
+
+def test_merge_waits_for_every_shard(root):
+    write_new_series(root, new_series())
+    manifest = year_shards.plan_shards(str(root), years=NEW_YEARS)
+    year_shards.run_shard(manifest["tasks"][0])
+    with pytest.raises(RuntimeError, match="2013"):
+        year_shards.merge_shards(manifest)
+
+def test_second_sharded_run_hits_the_recode_cache(root, tmp_path):
+    write_new_series(root, new_series())
+    backseries_uri = write_backseries(tmp_path / "backseries.parquet.zip", flows())
+    cache_dir = tmp_path / "recode_cache"
+
+    def sharded_run():
+        manifest = year_shards.plan_shards(str(root), years=[2009, 2010, 2011, 2012], backseries_uri=backseries_uri,
+                                           recode_cache_uri=str(cache_dir))
+        year_shards.run_local(manifest, workers=2)
+        return {entry.name: entry.stat().st_mtime_ns for entry in cache_dir.iterdir()}
+
+    first = sharded_run()
+    second = sharded_run()
+
+    # each backseries shard recoded and stored only its own year, and the second run rewrote or evicted nothing
+    assert len(first) == 3 and second == first
+    for name in first:
+        assert len(set(pd.read_parquet(cache_dir / name)["year"])) == 1
+    published = open_flows(str(root / step4.OUTPUT_PARQUET_PREFIX)).to_table(filter=ds.field("year") == 2010)
+    expected = step4.load_recoded_old_series(str(cache_dir), backseries_uri, years=[2010])
+    assert published.num_rows == step4.combine_frames([expected]).num_rows
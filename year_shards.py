@@ -0,0 +1,275 @@
+import argparse
+import io
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+import step4_combine_series as step4
+import step5_converting_geographies as step5
+from flow_scan import iter_year_partitions
+from flow_schema import conform
+from instrumentation import StageRecorder
+from od_aggregation import aggregate_geographies, concat_results
+from run_manifest import RUN_MANIFEST_URI, affected_years, load_run_manifest, mark_published, pending_releases, save_run_manifest
+from storage import make_storage, s3_client
+
+# Storage root every key below is relative to: the bucket for Lambda runs, a local directory otherwise
+SHARD_ROOT = f"s3://{step4.BUCKET_NAME}/"
+# Shard outputs are staged under STAGING_PREFIX/<run_id>/ until the merge publishes them
+STAGING_PREFIX = "population_mid_year_estimates/ons_data/shards/"
+# step5's per-year rollups, kept so an incremental run re-aggregates only its own years
+GEOGRAPHY_PARTS_PREFIX = "population_mid_year_estimates/ons_data/5_geographies_by_year/"
+GEOGRAPHY_OUTPUT_PREFIX = "population_mid_year_estimates/ons_data/5_geographies/"
+
+# One year per shard keeps a shard's memory to one year of flows; raise it to trade
+# parallelism for fewer invocations on short series.
+YEARS_PER_SHARD = 1
+SHARD_WORKERS = os.cpu_count() or 1
+
+# ----------------------------- Planning -----------------------------
+def series_years(storage, new_series_key=step4.S3_NEW_SERIES_PATH):
+    """Backseries years before the new series, plus the years in the new series (read from its year column only)"""
+    new_years = pc.unique(read_parquet(storage.uri(new_series_key), columns=["year"])["year"]).to_pylist()
+    return list(range(step4.START_YR_OLD_SERIES, step4.START_YR_NEW_SERIES)) + sorted(new_years)
+
+def shard_years(years, years_per_shard=YEARS_PER_SHARD):
+    """Split sorted years into runs of at most years_per_shard, never mixing backseries and new-series years"""
+    shards = []
+    for year in sorted(set(years)):
+        current = shards[-1] if shards else None
+        if current and len(current) < years_per_shard and is_old_year(current[0]) == is_old_year(year):
+            current.append(year)
+        else:
+            shards.append([year])
+    return shards
+
+def is_old_year(year):
+    return year < step4.START_YR_NEW_SERIES
+
+def plan_shards(root=SHARD_ROOT, years=None, years_per_shard=YEARS_PER_SHARD, run_manifest_uri=None,
+                incremental=False, backseries_uri=None, recode_cache_uri=None):
+    """Task manifest for a sharded step4/step5 run, also saved under the run's staging prefix.
+
+    Each entry of "tasks" is a self-contained event for run_shard, so the
+    list can be handed as is to a Step Functions Map state (ItemsPath
+    "$.tasks") or to run_local. Backseries shards recode, combine and
+    aggregate; new-series shards combine and aggregate.
+    """
+    storage = make_storage(root)
+    releases = []
+    mode = "full"
+    if run_manifest_uri:
+        run_manifest = load_run_manifest(s3_client(), run_manifest_uri)
+        releases = pending_releases(run_manifest, "publish")
+        if incremental:
+            touched = affected_years(run_manifest, releases)
+            if not releases:
+                print("✅ No newly combined releases, nothing to shard.")
+                years = []
+            elif min(touched, default=0) >= step4.START_YR_NEW_SERIES:
+                print(f"🔁 Incremental run for years {touched} ({len(releases)} releases)")
+                years, mode = touched, "incremental"
+            else:
+                print("⚠️ Releases touch old-series years, sharding every year.")
+                years = None
+    if years is None:
+        years = series_years(storage)
+
+    run_id = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+    staging_prefix = f"{STAGING_PREFIX}{run_id}/"
+    shared = {
+        "run_id": run_id, "root": root, "staging_prefix": staging_prefix,
+        "backseries_uri": backseries_uri or step4.S3_PARQUET_ZIP_S3_URI,
+        "recode_cache_uri": recode_cache_uri or step4.RECODE_CACHE_URI,
+        "new_series_key": step4.S3_NEW_SERIES_PATH,
+    }
+    tasks = [
+        dict(shared, shard=f"{chunk[0]}-{chunk[-1]}" if len(chunk) > 1 else str(chunk[0]), years=chunk,
+             stages=(["recode"] if is_old_year(chunk[0]) else []) + ["combine", "aggregate"])
+        for chunk in shard_years(years, years_per_shard)
+    ]
+    manifest = dict(shared, mode=mode, years=sorted(set(years)), releases=releases,
+                    run_manifest_uri=run_manifest_uri, tasks=tasks)
+    storage.put_fileobj(io.BytesIO(json.dumps(manifest, indent=2).encode()), f"{staging_prefix}_tasks.json")
+    print(f"🗂️ Planned {len(tasks)} shards for {len(manifest['years'])} years under {storage.uri(staging_prefix)}")
+    return manifest
+
+# ----------------------------- Shards -----------------------------
+def read_parquet(uri, columns=None, filters=None):
+    """Read a Parquet file at an s3:// URI or local path with ranged reads, so only the needed row groups move"""
+    if "://" in uri:
+        filesystem, path = pafs.FileSystem.from_uri(uri)
+    else:
+        filesystem, path = pafs.LocalFileSystem(), os.path.abspath(uri)
+    return pq.read_table(path, columns=columns, filters=filters, filesystem=filesystem)
+
+def run_shard(task):
+    """Recode, combine and aggregate the years of one task, staging a year= partition and step5 rollups per year"""
+    storage = make_storage(task["root"])
+    years = task["years"]
+    prefix = task["staging_prefix"]
+    print(f"🧱 Shard {task['shard']}: {task['stages']} for {years}")
+
+    with StageRecorder("year_shard") as perf:
+        frames = []
+        if "recode" in task["stages"]:
+            frames.append(step4.load_recoded_old_series(task["recode_cache_uri"], task["backseries_uri"], years=years))
+        else:
+            with perf.stage("read_new_series") as read:
+                frames.append(conform(read_parquet(storage.uri(task["new_series_key"]), filters=[("year", "in", years)])))
+                read.add_rows(frames[-1].num_rows)
+        table = step4.combine_frames(frames)
+        del frames
+
+        with perf.stage("stage_partitions") as staged:
+            for year in years:
+                part = table.filter(pc.equal(table["year"], year)).drop_columns(["year"])
+                staged.add_bytes_out(storage.write_table(
+                    part, f"{prefix}flows/year={year}/part-0.parquet", compression=step4.PARQUET_COMPRESSION,
+                    row_group_size=step4.MAX_ROWS_PER_GROUP, write_statistics=step4.WRITE_STATISTICS,
+                ))
+            staged.add_rows(table.num_rows)
+
+        if "aggregate" in task["stages"]:
+            hierarchies = step5.load_hierarchies()
+            with perf.stage("aggregate") as aggregate:
+                for year, df in iter_year_partitions(ds.dataset(table), columns=step5.FLOW_COLUMNS):
+                    aggregate.add_rows(len(df))
+                    for piece, frame in result_pieces(aggregate_geographies(df, hierarchies)).items():
+                        storage.write_table(pa.Table.from_pandas(frame, preserve_index=False),
+                                            f"{prefix}geographies/year={year}/{piece}.parquet")
+
+    summary = {"shard": task["shard"], "years": years, "rows": table.num_rows}
+    storage.put_fileobj(io.BytesIO(json.dumps(summary).encode()), f"{prefix}_done/{task['shard']}.json")
+    return summary
+
+def result_pieces(result):
+    """Flatten aggregate_geographies output to {piece name: DataFrame}"""
+    pieces = {"lad_gross": result["lad_gross"]}
+    for name, tables in result.items():
+        if name != "lad_gross":
+            pieces.update({f"{name}__{kind}": frame for kind, frame in tables.items()})
+    return pieces
+
+def result_from_pieces(pieces):
+    """Inverse of result_pieces"""
+    result = {}
+    for piece, frame in pieces.items():
+        name, _, kind = piece.partition("__")
+        if kind:
+            result.setdefault(name, {})[kind] = frame
+        else:
+            result[name] = frame
+    return result
+
+# ----------------------------- Merge -----------------------------
+def merge_shards(manifest):
+    """Publish every staged shard once all of them have finished, then rebuild step5's outputs.
+
+    Year partitions replace the published ones (and any stale files in
+    them); step5's outputs are reassembled from the per-year rollups of all
+    years, so an incremental run only recomputed its own.
+    """
+    storage = make_storage(manifest["root"])
+    prefix = manifest["staging_prefix"]
+    finished = {key.rsplit("/", 1)[-1][:-len(".json")] for key in storage.list(f"{prefix}_done/")}
+    missing = sorted({task["shard"] for task in manifest["tasks"]} - finished)
+    if missing:
+        raise RuntimeError(f"Shards not finished: {missing}")
+
+    with StageRecorder("year_shards_merge") as perf:
+        with perf.stage("publish_flows") as published:
+            published.add_rows(publish_partitions(storage, f"{prefix}flows/", f"{step4.OUTPUT_PARQUET_PREFIX}/"))
+        if any("aggregate" in task["stages"] for task in manifest["tasks"]):
+            with perf.stage("publish_geographies"):
+                publish_partitions(storage, f"{prefix}geographies/", GEOGRAPHY_PARTS_PREFIX)
+            with perf.stage("assemble_geographies") as assemble:
+                for name, df in step5.output_tables(load_geography_parts(storage)).items():
+                    assemble.add_bytes_out(storage.write_table(pa.Table.from_pandas(df, preserve_index=False),
+                                                               f"{GEOGRAPHY_OUTPUT_PREFIX}{name}.parquet"))
+                    assemble.add_rows(len(df))
+
+        if manifest.get("run_manifest_uri") and manifest["releases"]:
+            run_manifest = load_run_manifest(s3_client(), manifest["run_manifest_uri"])
+            mark_published(run_manifest, manifest["releases"])
+            save_run_manifest(s3_client(), run_manifest, manifest["run_manifest_uri"])
+
+        for key in storage.list(prefix):
+            storage.delete(key)
+    print(f"✅ Merged {len(manifest['tasks'])} shards")
+    return {"status": "done", "mode": manifest["mode"], "shards": len(manifest["tasks"]), "years_written": len(manifest["years"])}
+
+def publish_partitions(storage, source_prefix, target_prefix):
+    """Copy staged year=/ files under target_prefix, removing files an earlier write left in those partitions.
+    Returns the number of files published."""
+    staged = storage.list(source_prefix)
+    targets = {f"{target_prefix}{key[len(source_prefix):]}" for key in staged}
+    for key in staged:
+        storage.copy(key, f"{target_prefix}{key[len(source_prefix):]}")
+    for partition in {target.rsplit("/", 1)[0] for target in targets}:
+        for key in storage.list(f"{partition}/"):
+            if key not in targets:
+                print(f"🗑️ Removing stale {storage.uri(key)}")
+                storage.delete(key)
+    return len(staged)
+
+def load_geography_parts(storage):
+    """concat_results of the per-year rollups kept under GEOGRAPHY_PARTS_PREFIX"""
+    by_year = {}
+    for key in storage.list(GEOGRAPHY_PARTS_PREFIX, suffixes=(".parquet",)):
+        partition, piece = key[len(GEOGRAPHY_PARTS_PREFIX):].split("/")
+        by_year.setdefault(partition, {})[piece[:-len(".parquet")]] = storage.read_table(key).to_pandas()
+    return concat_results([result_from_pieces(by_year[year]) for year in sorted(by_year)])
+
+# ----------------------------- Execution -----------------------------
+def run_local(manifest, workers=SHARD_WORKERS):
+    """Run every shard of a manifest on a local process pool, then merge"""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for summary in pool.map(run_shard, manifest["tasks"]):
+            print(f"✅ Shard {summary['shard']}: {summary['rows']} rows")
+    return merge_shards(manifest)
+
+def plan_handler(event, context):
+    """Step Functions entry: the task manifest, whose "tasks" feed a Map state running shard_handler"""
+    manifest = plan_shards(
+        root=event.get("root", SHARD_ROOT),
+        years=event.get("years"),
+        years_per_shard=int(event.get("years_per_shard", YEARS_PER_SHARD)),
+        run_manifest_uri=event.get("run_manifest_uri", RUN_MANIFEST_URI),
+        incremental=event.get("incremental", False),
+        backseries_uri=event.get("backseries_uri"),
+        recode_cache_uri=event.get("recode_cache_uri"),
+    )
+    return manifest
+
+def shard_handler(event, context):
+    return run_shard(event)
+
+def merge_handler(event, context):
+    """Merge after the Map state; event is the planned manifest (Map results can sit under any other key)"""
+    return merge_shards(event)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run steps 4 and 5 as per-year shards on a local process pool")
+    parser.add_argument("--root", default=SHARD_ROOT, help="local directory or s3://bucket/ holding the step3 output")
+    parser.add_argument("--years", nargs="*", type=int)
+    parser.add_argument("--years-per-shard", type=int, default=YEARS_PER_SHARD)
+    parser.add_argument("--workers", type=int, default=SHARD_WORKERS)
+    parser.add_argument("--run-manifest-uri", help="record published releases in this run manifest")
+    parser.add_argument("--incremental", action="store_true", help="shard only the years of newly combined releases")
+    parser.add_argument("--backseries-uri")
+    args = parser.parse_args()
+
+    manifest = plan_shards(args.root, args.years, args.years_per_shard, args.run_manifest_uri, args.incremental,
+                           args.backseries_uri)
+    if manifest["tasks"]:
+        print(run_local(manifest, args.workers))
+
+if __name__ == "__main__":
+    main()